@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from fingerprints import AMP_THRESH, make_fingerprint, make_packed_fingerprint
+from index import FingerprintIndex, legacy_fingerprints_to_arrays
+from instrumentation import collect, merge
+from search import MINIMUM_SCORE, TOP_K, load_titles, score_tracks
+
+
+_index = None
+
+
+def identify_files(audio_files, index_file, metadata_file, output,
+    workers = 1, top_k = TOP_K, amp_thresh = AMP_THRESH):
+
+    '''identify_files: identifies many audio files in one process. The index
+    is memory-mapped once in each worker (the pages are shared through the
+    operating system cache), the files are fingerprinted and matched in a
+    pool of processes and the results are written as JSON lines, in the
+    order of audio_files.
+
+    Args:
+        audio_files: list of audio files in .wav
+        index_file: path of the binary index file
+        metadata_file: path of the metadata .csv file
+        output: file object where the JSON lines are written
+        workers: number of processes
+        top_k: number of tracks in the ranking of each file
+        amp_thresh: minimum amplitude value for a point to be considered
+            a candidate peak
+
+    Returns:
+        The number of files identified with a score of at least
+        MINIMUM_SCORE.
+    '''
+
+    titles = load_titles(metadata_file)
+    n_matches = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_index,
+        initargs=(index_file,)) as executor:
+        results = executor.map(partial(collect, identify_file), audio_files,
+            [top_k] * len(audio_files), [amp_thresh] * len(audio_files),
+            chunksize=max(1, len(audio_files) // (4 * workers)))
+
+        for result, stats in results:
+            # The statistics recorded in the worker
+            merge(stats)
+            if result['match'] is not None:
+                result['match']['title'] = titles.get(
+                    result['match']['track_id'])
+                n_matches += 1
+            output.write(json.dumps(result) + '\n')
+
+    return n_matches
+
+
+def identify_file(audio_file, top_k = TOP_K, amp_thresh = AMP_THRESH):
+
+    '''identify_file: fingerprints an audio file and matches it against the
+    index loaded in the worker.
+
+    Args:
+        audio_file: audio file in .wav
+        top_k: number of tracks in the ranking
+        amp_thresh: minimum amplitude value for a point to be considered
+            a candidate peak
+
+    Returns:
+        A dictionary with the file, the best match (None if its score is
+        lower than MINIMUM_SCORE), the ranking, the running times [s] of
+        each stage and the error message, if the file could not be
+        processed.
+    '''
+
+    result = {'file': audio_file, 'match': None, 'ranking': [],
+        'timings': dict(), 'error': None}
+
+    try:
+        if _index.meta['hash'] == 'packed':
+            hashes, offsets = make_packed_fingerprint(audio_file,
+                amp_thresh=amp_thresh, timings=result['timings'])
+        else:
+            hashes, offsets = legacy_fingerprints_to_arrays(
+                make_fingerprint(audio_file, amp_thresh=amp_thresh,
+                timings=result['timings']),
+                _index.meta.get('sample_rate', 22050),
+                _index.meta.get('hop_size', 512))
+
+        start = time.perf_counter()
+        ranking = score_tracks(_index, hashes, offsets, top_k)
+        result['timings']['search'] = time.perf_counter() - start
+    except Exception as error:
+        result['error'] = repr(error)
+        return result
+
+    result['ranking'] = ranking
+    if len(ranking) > 0 and ranking[0]['score'] >= MINIMUM_SCORE:
+        result['match'] = dict(ranking[0])
+
+    return result
+
+
+def list_audio_files(paths):
+
+    '''list_audio_files: expands the command line paths into a list of audio
+    files: directories are replaced by their sorted .wav files and paths
+    starting with @ by the lines of the file they name.
+    '''
+
+    audio_files = []
+
+    for path in paths:
+        if path.startswith('@'):
+            with open(path[1:]) as file:
+                audio_files.extend(line.strip() for line in file
+                    if line.strip())
+        elif os.path.isdir(path):
+            audio_files.extend(os.path.join(path, name) for name in
+                sorted(os.listdir(path)) if name.endswith('.wav'))
+        else:
+            audio_files.append(path)
+
+    return audio_files
+
+
+def _load_index(index_file):
+
+    global _index
+    _index = FingerprintIndex.load(index_file)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Identify many audio files '
+        'against the fingerprints index.')
+    parser.add_argument('paths', nargs='+', help='.wav files, folders of '
+        '.wav files or @file with one path per line')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default='results.jsonl',
+        help='JSON lines output file (- for the standard output)')
+    parser.add_argument('--index',
+        default='../resources/database/fingerprints_index.bin')
+    parser.add_argument('--metadata',
+        default='../resources/database/metadata_db.csv')
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    audio_files = list_audio_files(args.paths)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    start = time.time()
+    n_matches = identify_files(audio_files, args.index, args.metadata,
+        output, args.workers, args.top_k)
+    end = time.time()
+
+    if output is not sys.stdout:
+        output.close()
+    print(f'Identified {n_matches} of {len(audio_files)} files in '
+        f'{end - start:.1f} s ({len(audio_files) / (end - start):.2f} '
+        'files/s)', file=sys.stderr)
@@ -0,0 +1,631 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from fingerprints import AMP_THRESH, DELTA_FREQ, DELTA_TIME, FAN_OUT, \
+    OFFSET_FREQ, OFFSET_TIME, PAIRING, make_peaks_constellation, \
+    make_combinatorial_hashes, make_combinatorial_hashes_loop, \
+    make_packed_fingerprint, make_peaks_constellation_skimage, \
+    make_packed_hashes, add_fingerprints_to_postings
+from database import DATABASE_DIR
+from index import FingerprintIndex
+from preprocess import process_audio_file
+from search import MINIMUM_SCORE, searching_matching_track
+
+
+BENCHMARK_DIR = '../resources/benchmark'
+BENCHMARK_TOLERANCE = 0.1  # Relative change reported as a regression
+BENCHMARK_MIN_TIME = 0.01  # Smaller time changes are noise [s]
+STARTUP_BUDGET = 1.0  # Maximum time of shazir.py identifying a file [s]
+
+
+def benchmark_combinatorial_hashes(audio_file, amp_thresh = AMP_THRESH,
+    offset_time = OFFSET_TIME, offset_freq = OFFSET_FREQ,
+    delta_time = DELTA_TIME, delta_freq = DELTA_FREQ, fan_out = FAN_OUT,
+    repeat = 3):
+
+    '''benchmark_combinatorial_hashes: compares the running time of the
+    vectorized combinatorial hashing with the one of the nested loop, on the
+    peaks of the given audio file, and checks that the two produce the same
+    hashes.
+
+    Args:
+        audio_file: audio file in .wav
+        amp_thresh: minimum amplitude value for a point to be considered
+            a candidate peak
+        offset_time, offset_freq, delta_time, delta_freq, fan_out: parameters
+            of the combinatorial hashing (see make_fingerprint)
+        repeat: number of runs of each implementation; the best time is kept
+
+    Returns:
+        A dictionary with the number of peaks and hashes, the best running
+        times [s] of the two implementations and whether their results match.
+    '''
+
+    times, frequencies, amplitudes = process_audio_file(audio_file)
+    peaks_times, peaks_frequencies = make_peaks_constellation(times,
+        frequencies, amplitudes, amp_thresh)
+    args = (peaks_times, peaks_frequencies, offset_time, offset_freq,
+        delta_time, delta_freq, fan_out)
+
+    def _best_time(function):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function(*args)
+            best = min(best, time.perf_counter() - start)
+        return result, best
+
+    hashes_loop, time_loop = _best_time(make_combinatorial_hashes_loop)
+    hashes_vectorized, time_vectorized = _best_time(make_combinatorial_hashes)
+
+    return {'peaks': len(peaks_times), 'hashes': len(hashes_vectorized),
+        'loop_time': time_loop, 'vectorized_time': time_vectorized,
+        'match': hashes_loop == hashes_vectorized}
+
+
+def benchmark_peaks(audio_file, amp_thresh = 0.7, peaks_per_second = None,
+    repeat = 3):
+
+    '''benchmark_peaks: compares the running time of make_peaks_constellation
+    with the one of skimage peak_local_max, on the spectrogram of the given
+    audio file, and checks that the two find the same peaks.
+
+    Args:
+        audio_file: audio file in .wav
+        amp_thresh: minimum amplitude value for a point to be considered
+            a candidate peak
+        peaks_per_second: density cap of make_peaks_constellation
+        repeat: number of runs of each implementation; the best time is kept
+
+    Returns:
+        A dictionary with the number of peaks per second of the two
+        implementations, their best running times [s] and whether their
+        peaks match (only without density cap).
+    '''
+
+    times, frequencies, amplitudes = process_audio_file(audio_file)
+    duration = max(times[-1], times[1] - times[0])
+
+    def _best_time(function, **kwargs):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function(times, frequencies, amplitudes, amp_thresh,
+                **kwargs)
+            best = min(best, time.perf_counter() - start)
+        return result, best
+
+    peaks_skimage, time_skimage = _best_time(make_peaks_constellation_skimage)
+    peaks, time_separable = _best_time(make_peaks_constellation,
+        peaks_per_second=peaks_per_second)
+
+    return {'skimage_peaks_per_second': len(peaks_skimage[0]) / duration,
+        'peaks_per_second': len(peaks[0]) / duration,
+        'skimage_time': time_skimage, 'separable_time': time_separable,
+        'match': all(np.array_equal(a.ravel(), b.ravel())
+            for a, b in zip(peaks, peaks_skimage))}
+
+
+def benchmark_decoders(audio_file, decoders = ('librosa', 'soundfile'),
+    repeat = 3):
+
+    '''benchmark_decoders: compares the running time of the spectrogram
+    stage with each decoder and the fingerprints they produce, against the
+    ones of the first decoder.
+
+    Args:
+        audio_file: audio file in .wav
+        decoders: decoders to compare (see load_audio)
+        repeat: number of runs of each decoder; the best time is kept
+
+    Returns:
+        A dictionary with, for each decoder, the best running time [s] of the
+        spectrogram stage, the number of packed hashes and the fraction of the
+        (hash, offset) pairs of the first decoder it also produces.
+    '''
+
+    results = dict()
+
+    for decoder in decoders:
+        best = float('inf')
+        for _ in range(repeat):
+            timings = dict()
+            hashes, offsets = make_packed_fingerprint(audio_file,
+                decoder=decoder, timings=timings)
+            best = min(best, timings['spectrogram'])
+        pairs = (hashes.astype(np.uint64) << 32) + offsets.astype(np.uint64)
+        if len(results) == 0:
+            reference = pairs
+        results[decoder] = {'spectrogram_time': best, 'hashes': len(hashes),
+            'common': float(np.isin(reference, pairs).mean())
+            if len(reference) > 0 else 1.0}
+
+    return results
+
+
+def benchmark_startup(audio_file, database_dir = DATABASE_DIR, repeat = 3,
+    budget = STARTUP_BUDGET):
+
+    '''benchmark_startup: measures the time taken by a new shazir.py process
+    to identify an audio file, from the start of Python to the printed
+    match, and the time of its imports alone, i.e. what a user waits for at
+    the command line.
+
+    Args:
+        audio_file: audio file in .wav
+        database_dir: folder of the database searched by shazir.py
+        repeat: number of runs, the median one is kept
+        budget: maximum acceptable identification time [s]
+
+    Returns:
+        A dictionary with the median identification and import times [s],
+        the budget and whether the identification time is within it, or
+        None if there is no database in database_dir.
+    '''
+
+    if not (os.path.exists(os.path.join(database_dir, 'metadata_db.csv')) and
+        any(os.path.exists(os.path.join(database_dir, name)) for name in
+        ('fingerprints_index.bin', 'fingerprints_dict.json'))):
+        return None
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None,
+        (script_dir, os.environ.get('PYTHONPATH')))),
+        SHAZIR_DATABASE=database_dir)
+
+    def _median_time(command):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+    startup_time = _median_time([sys.executable,
+        os.path.join(script_dir, 'shazir.py'), audio_file])
+    import_time = _median_time([sys.executable, '-c', 'import shazir'])
+
+    return {'startup_time': startup_time, 'import_time': import_time,
+        'budget': budget, 'within_budget': startup_time <= budget}
+
+
+def make_synthetic_corpus(corpus_dir, n_tracks = 20, track_time = 30,
+    n_queries = 40, query_time = 10, snr = 10, n_unknown = 5,
+    sample_rate = 22050, seed = 0):
+
+    '''make_synthetic_corpus: generates offline a corpus of synthetic
+    tracks and of queries with a known answer. Each track is a sequence of
+    notes of random length, each a mix of one to three tones or a chirp,
+    over a quiet noise floor; each query is an excerpt of a random track at
+    a random offset with white noise added at the given signal to noise
+    ratio. The unknown queries are excerpts of tracks that are not in the
+    corpus, which should not be recognized.
+
+    Args:
+        corpus_dir: folder where the tracks are written in the wav subfolder,
+            the queries in the queries subfolder and their answers in
+            queries.json
+        n_tracks: number of tracks
+        track_time: duration of the tracks [s]
+        n_queries: number of queries excerpted from the tracks
+        query_time: duration of the queries [s]
+        snr: signal to noise ratio of the queries [dB]
+        n_unknown: number of queries excerpted from unknown tracks
+        sample_rate: sample rate of the tracks [Hz]
+        seed: seed of the random generator
+
+    Returns:
+        The list of the queries, as dictionaries with the file, the title of
+        the track (None if unknown) and the offset_time of the excerpt in the
+        track [s].
+    '''
+
+    rng = np.random.default_rng(seed)
+    wav_dir = os.path.join(corpus_dir, 'wav')
+    queries_dir = os.path.join(corpus_dir, 'queries')
+    os.makedirs(wav_dir, exist_ok=True)
+    os.makedirs(queries_dir, exist_ok=True)
+
+    tracks = [_synthetic_track(rng, track_time, sample_rate)
+        for _ in range(n_tracks + n_unknown)]
+    for track_id in range(n_tracks):
+        sf.write(os.path.join(wav_dir, f'track_{track_id:04d}.wav'),
+            tracks[track_id], sample_rate, subtype='PCM_16')
+
+    queries = []
+    n_samples = int(query_time * sample_rate)
+    for query_id in range(n_queries + n_unknown):
+        if query_id < n_queries:
+            track_id = int(rng.integers(n_tracks))
+            title = f'track_{track_id:04d}.wav'
+        else:
+            track_id = n_tracks + query_id - n_queries
+            title = None
+        start = int(rng.integers(len(tracks[track_id]) - n_samples + 1))
+        excerpt = tracks[track_id][start:start + n_samples]
+        noise = rng.standard_normal(len(excerpt))
+        noise *= np.sqrt(np.mean(excerpt ** 2) / 10 ** (snr / 10) /
+            np.mean(noise ** 2))
+        query = np.clip(excerpt + noise, -1, 1).astype(np.float32)
+        query_file = os.path.join(queries_dir, f'query_{query_id:04d}.wav')
+        sf.write(query_file, query, sample_rate, subtype='PCM_16')
+        queries.append({'file': query_file, 'title': title,
+            'offset_time': start / sample_rate})
+
+    with open(os.path.join(corpus_dir, 'queries.json'), 'w') as file:
+        json.dump(queries, file, indent=1)
+
+    return queries
+
+
+def _synthetic_track(rng, track_time, sample_rate):
+
+    '''_synthetic_track: generates a track of random notes (see
+    make_synthetic_corpus).'''
+
+    n_samples = int(track_time * sample_rate)
+    track = 0.01 * rng.standard_normal(n_samples)
+    start = 0
+    while start < n_samples:
+        length = min(int(rng.uniform(0.15, 0.8) * sample_rate),
+            n_samples - start)
+        t = np.arange(length) / sample_rate
+        note = np.zeros(length)
+        if rng.random() < 0.2:  # Chirp
+            f0, f1 = rng.uniform(200, 5000, size=2)
+            note += np.sin(2 * np.pi * (f0 * t + (f1 - f0) * t ** 2 /
+                (2 * t[-1] + 1e-9)))
+        else:
+            for _ in range(int(rng.integers(1, 4))):
+                note += rng.uniform(0.3, 1) * np.sin(2 * np.pi *
+                    rng.uniform(100, 5000) * t + rng.uniform(0, 2 * np.pi))
+        # Short fades, to avoid clicks between the notes
+        fade = min(length // 2, int(0.01 * sample_rate))
+        if fade > 0:
+            ramp = np.linspace(0, 1, fade)
+            note[:fade] *= ramp
+            note[length - fade:] *= ramp[::-1]
+        track[start:start + length] += 0.25 * note
+        start += length
+
+    return np.clip(track, -1, 1).astype(np.float32)
+
+
+def run_benchmark_suite(corpus_dir, amp_thresh = AMP_THRESH,
+    offset_tolerance = 0.5):
+
+    '''run_benchmark_suite: times every stage of the pipeline on a corpus
+    made by make_synthetic_corpus: process_audio_file,
+    make_peaks_constellation, make_combinatorial_hashes and
+    make_packed_hashes on each track, the build, save and load of the
+    index, and make_packed_fingerprint and searching_matching_track on each
+    query. The peak memory of each track stage is measured with tracemalloc
+    on the longest track, in a separate run so that tracing does not slow
+    down the timed one.
+
+    Args:
+        corpus_dir: folder of the corpus
+        amp_thresh: minimum amplitude value for a point to be considered
+            a candidate peak
+        offset_tolerance: maximum error on the offset of a query in its
+            track for it to be recognized correctly [s]
+
+    Returns:
+        A dictionary with, for each stage, the total time [s], the
+        throughput (seconds of audio or queries per second) and the peak
+        memory [bytes] when measured; the recognition accuracy on the known
+        queries, the false positive rate on the unknown ones, the size of
+        the index and the maximum resident memory of the process [bytes].
+    '''
+
+    wav_dir = os.path.join(corpus_dir, 'wav')
+    track_files = sorted(os.listdir(wav_dir))
+    with open(os.path.join(corpus_dir, 'queries.json')) as file:
+        queries = json.load(file)
+
+    stages = {name: {'time': 0.0} for name in ('process_audio_file',
+        'make_peaks_constellation', 'make_combinatorial_hashes',
+        'make_packed_hashes', 'index_build', 'index_save', 'index_load',
+        'query_fingerprint', 'searching_matching_track')}
+
+    def _timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        stages[stage]['time'] += time.perf_counter() - start
+        return result
+
+    metadata_db = pd.DataFrame(columns=['track_id', 'title'])
+    postings = []
+    audio_time = 0.0
+    longest = None
+
+    # The pipeline functions print their progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        for track_file in track_files:
+            path = os.path.join(wav_dir, track_file)
+            times, frequencies, amplitudes = _timed('process_audio_file',
+                process_audio_file, path)
+            peaks_times, peaks_frequencies = _timed(
+                'make_peaks_constellation', make_peaks_constellation, times,
+                frequencies, amplitudes, amp_thresh)
+            _timed('make_combinatorial_hashes', make_combinatorial_hashes,
+                peaks_times, peaks_frequencies, *PAIRING)
+            fingerprints = _timed('make_packed_hashes', make_packed_hashes,
+                peaks_times, peaks_frequencies, times, frequencies, *PAIRING)
+            add_fingerprints_to_postings(fingerprints, track_file, postings,
+                metadata_db)
+            duration = sf.info(path).duration
+            audio_time += duration
+            if longest is None or duration > longest[1]:
+                longest = (path, duration)
+
+        index_file = os.path.join(corpus_dir, 'fingerprints_index.bin')
+        metadata_file = os.path.join(corpus_dir, 'metadata_db.csv')
+        index = _timed('index_build', FingerprintIndex.from_postings,
+            postings)
+        _timed('index_save', index.save, index_file)
+        metadata_db.to_csv(metadata_file)
+        index = _timed('index_load', FingerprintIndex.load, index_file)
+        metadata_db = pd.read_csv(metadata_file, index_col=0)
+        titles = metadata_db['title'].to_dict()
+
+        correct = 0
+        false_positives = 0
+        query_time = 0.0
+        for query in queries:
+            fingerprints = _timed('query_fingerprint',
+                make_packed_fingerprint, query['file'],
+                amp_thresh=amp_thresh)
+            ranking = _timed('searching_matching_track',
+                searching_matching_track, index, metadata_db, fingerprints)
+            query_time += sf.info(query['file']).duration
+            recognized = len(ranking) > 0 and \
+                ranking[0]['score'] >= MINIMUM_SCORE
+            if query['title'] is None:
+                false_positives += recognized
+            elif (recognized and titles.get(ranking[0]['track_id']) ==
+                query['title'] and abs(ranking[0]['offset_time'] -
+                query['offset_time']) <= offset_tolerance):
+                correct += 1
+
+        memory = _peak_memory(longest[0], amp_thresh)
+
+    for stage in ('process_audio_file', 'make_peaks_constellation',
+        'make_combinatorial_hashes', 'make_packed_hashes'):
+        stages[stage]['throughput'] = audio_time / stages[stage]['time']
+        stages[stage]['peak_memory'] = memory[stage]
+    for stage in ('query_fingerprint', 'searching_matching_track'):
+        stages[stage]['throughput'] = len(queries) / stages[stage]['time']
+
+    n_unknown = sum(query['title'] is None for query in queries)
+    n_known = len(queries) - n_unknown
+
+    return {'stages': stages, 'tracks': len(track_files),
+        'audio_time': audio_time, 'queries': len(queries),
+        'query_audio_time': query_time,
+        'accuracy': correct / n_known if n_known else None,
+        'false_positive_rate': false_positives / n_unknown
+            if n_unknown else None,
+        'index_postings': index.n_postings,
+        'index_bytes': os.path.getsize(index_file),
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def _peak_memory(audio_file, amp_thresh):
+
+    '''_peak_memory: returns the peak memory [bytes] allocated by each track
+    stage of the pipeline on an audio file, traced with tracemalloc.'''
+
+    memory = dict()
+
+    def _traced(stage, function, *args):
+        tracemalloc.start()
+        result = function(*args)
+        memory[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result
+
+    times, frequencies, amplitudes = _traced('process_audio_file',
+        process_audio_file, audio_file)
+    peaks_times, peaks_frequencies = _traced('make_peaks_constellation',
+        make_peaks_constellation, times, frequencies, amplitudes, amp_thresh)
+    _traced('make_combinatorial_hashes', make_combinatorial_hashes,
+        peaks_times, peaks_frequencies, *PAIRING)
+    _traced('make_packed_hashes', make_packed_hashes, peaks_times,
+        peaks_frequencies, times, frequencies, *PAIRING)
+
+    return memory
+
+
+def save_benchmark_results(results, results_file, label = None):
+
+    '''save_benchmark_results: appends the results of a run, with the
+    date, the label and the git commit, as a line of a JSON lines file.'''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    run = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'label': label,
+        'commit': commit, 'results': results}
+    with open(results_file, 'a') as file:
+        file.write(json.dumps(run) + '\n')
+
+    return run
+
+
+def compare_benchmark_results(results_file, baseline = None,
+    tolerance = BENCHMARK_TOLERANCE):
+
+    '''compare_benchmark_results: compares the last run of a results file
+    with a previous one.
+
+    Args:
+        results_file: JSON lines file written by save_benchmark_results
+        baseline: label of the run to compare with; by default the run
+            before the last one
+        tolerance: relative change beyond which a slower stage, a larger
+            index or a lower accuracy is reported as a regression (a slower
+            stage only if it also takes BENCHMARK_MIN_TIME more)
+
+    Returns:
+        A list of dictionaries with the metric, its baseline and current
+        values, the relative change and whether it is a regression; empty if
+        there is no run to compare with.
+    '''
+
+    with open(results_file) as file:
+        runs = [json.loads(line) for line in file if line.strip()]
+    if baseline is None:
+        previous = runs[:-1]
+    else:
+        previous = [run for run in runs[:-1] if run['label'] == baseline]
+    if len(runs) == 0 or len(previous) == 0:
+        return []
+    old, new = previous[-1]['results'], runs[-1]['results']
+
+    # Metrics with the sign of a change that is a regression
+    metrics = [(f'{stage}.time', 1) for stage in new['stages']]
+    metrics += [(f'{stage}.peak_memory', 1) for stage in new['stages']
+        if 'peak_memory' in new['stages'][stage]]
+    metrics += [('index_bytes', 1), ('max_rss', 1), ('accuracy', -1),
+        ('false_positive_rate', 1)]
+
+    comparison = []
+    for metric, sign in metrics:
+        old_value, new_value = _metric(old, metric), _metric(new, metric)
+        if old_value is None or new_value is None:
+            continue
+        change = (new_value - old_value) / old_value if old_value else \
+            float(np.sign(new_value - old_value))
+        regression = sign * change > tolerance
+        if metric.endswith('.time'):
+            regression &= new_value - old_value > BENCHMARK_MIN_TIME
+        comparison.append({'metric': metric, 'baseline': old_value,
+            'current': new_value, 'change': change,
+            'regression': bool(regression)})
+
+    return comparison
+
+
+def _metric(results, metric):
+
+    stage, _, name = metric.rpartition('.')
+    if stage:
+        return results['stages'].get(stage, dict()).get(name)
+    return results.get(metric)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the stages of '
+        'the pipeline on one audio file, or on a synthetic corpus with '
+        '--suite.')
+    parser.add_argument('audio_file', nargs='?',
+        default='../resources/sample_trimmed.wav')
+    parser.add_argument('--suite', action='store_true',
+        help='run the benchmark suite on a synthetic corpus')
+    parser.add_argument('--corpus', default=os.path.join(BENCHMARK_DIR,
+        'corpus'), help='folder of the synthetic corpus (generated if '
+        'missing)')
+    parser.add_argument('--tracks', type=int, default=20)
+    parser.add_argument('--track-time', type=float, default=30)
+    parser.add_argument('--queries', type=int, default=40)
+    parser.add_argument('--snr', type=float, default=10)
+    parser.add_argument('--results', default=os.path.join(BENCHMARK_DIR,
+        'results.jsonl'), help='JSON lines file where the results are '
+        'appended')
+    parser.add_argument('--label', help='label of the run')
+    parser.add_argument('--baseline', help='label of the run to compare '
+        'with (by default the previous one)')
+    parser.add_argument('--database', default=DATABASE_DIR,
+        help='folder of the database searched by shazir.py in the startup '
+        'benchmark')
+    parser.add_argument('--startup-budget', type=float,
+        default=STARTUP_BUDGET, help='maximum median time of shazir.py '
+        'identifying the file [s]; the benchmark fails if it is exceeded')
+    args = parser.parse_args()
+
+    if args.suite:
+        if not os.path.exists(os.path.join(args.corpus, 'queries.json')):
+            make_synthetic_corpus(args.corpus, args.tracks, args.track_time,
+                args.queries, snr=args.snr)
+        results = run_benchmark_suite(args.corpus)
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)),
+            exist_ok=True)
+        save_benchmark_results(results, args.results, args.label)
+
+        for stage, result in results['stages'].items():
+            line = f"{stage}: {result['time']:.4f} s"
+            if 'throughput' in result:
+                line += f", {result['throughput']:.1f} /s"
+            if 'peak_memory' in result:
+                line += f", peak {result['peak_memory'] / 2**20:.1f} MiB"
+            print(line)
+        print(f"accuracy {results['accuracy']:.3f}, false positive rate "
+            f"{results['false_positive_rate']}, index "
+            f"{results['index_bytes'] / 2**20:.2f} MiB, max RSS "
+            f"{results['max_rss'] / 2**20:.0f} MiB")
+
+        for change in compare_benchmark_results(args.results, args.baseline):
+            if change['regression']:
+                print(f"REGRESSION {change['metric']}: "
+                    f"{change['baseline']:.4g} -> {change['current']:.4g} "
+                    f"({100 * change['change']:+.1f}%)")
+    else:
+        audio_file = args.audio_file
+
+        for amp_thresh in (0.7, 0.5):
+            result = benchmark_combinatorial_hashes(audio_file, amp_thresh)
+            print(f"amp_thresh = {amp_thresh}: {result['peaks']} peaks, "
+                f"{result['hashes']} hashes, loop "
+                f"{result['loop_time']:.4f} s, vectorized "
+                f"{result['vectorized_time']:.4f} s "
+                f"(x{result['loop_time'] / result['vectorized_time']:.1f}), "
+                f"same hashes: {result['match']}")
+
+        for peaks_per_second in (None, 30):
+            result = benchmark_peaks(audio_file, 0.5, peaks_per_second)
+            print(f"peaks_per_second = {peaks_per_second}: "
+                f"{result['peaks_per_second']:.1f} peaks/s "
+                f"(skimage {result['skimage_peaks_per_second']:.1f}), "
+                f"separable {result['separable_time']:.4f} s, skimage "
+                f"{result['skimage_time']:.4f} s "
+                f"(x{result['skimage_time'] / result['separable_time']:.1f}), "
+                f"same peaks: {result['match']}")
+
+        for decoder, result in benchmark_decoders(audio_file).items():
+            print(f"decoder = {decoder}: spectrogram "
+                f"{result['spectrogram_time']:.4f} s, "
+                f"{result['hashes']} hashes, {100 * result['common']:.1f}% "
+                "in common with librosa")
+
+        result = benchmark_startup(audio_file, args.database,
+            budget=args.startup_budget)
+        if result is None:
+            print(f'shazir.py {audio_file}: skipped, no database in '
+                f'{args.database} (build one with database.py or pass '
+                '--database)')
+        else:
+            print(f"shazir.py {audio_file}: {result['startup_time']:.3f} s "
+                f"(imports {result['import_time']:.3f} s), budget "
+                f"{result['budget']:.2f} s: "
+                f"{'OK' if result['within_budget'] else 'EXCEEDED'}")
+            if not result['within_budget']:
+                sys.exit(f"shazir.py took {result['startup_time']:.3f} s, "
+                    f"more than the budget of {result['budget']:.2f} s")
@@ -0,0 +1,128 @@
+import os
+import hashlib
+import json
+import zipfile
+
+import numpy as np
+
+from instrumentation import count
+
+
+CACHE_DIR = '../resources/cache'
+CACHE_MAX_BYTES = 1 << 30
+
+
+class PeaksCache():
+
+    '''PeaksCache: on-disk cache of the peak constellations (and optionally
+    of the spectrograms) of audio files, so that fingerprinting a file again
+    with different pairing parameters skips the decoding, the STFT and the
+    peak picking. The entries are uncompressed .npz files named after a key
+    made of the SHA-1 of the file content and of the parameters they depend
+    on, so a renamed file is still found and a modified one is not. When the
+    entries exceed max_bytes (None for no limit) the least recently used
+    ones are deleted.
+    Several processes can share a cache: the entries are written atomically
+    and an entry deleted while being read counts as a miss.
+    '''
+
+    def __init__(self, cache_dir = CACHE_DIR, max_bytes = CACHE_MAX_BYTES,
+        spectrogram = False):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.spectrogram = spectrogram
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, content_hash, params):
+
+        '''key: returns the key of the entry of a file content for the
+        given parameters (a dictionary of JSON values).'''
+
+        return hashlib.sha1((content_hash + json.dumps(params,
+            sort_keys=True)).encode()).hexdigest()
+
+    def load(self, key):
+
+        '''load: returns the arrays of an entry as a dictionary, or None if
+        there is no such entry, and marks it as recently used.'''
+
+        path = os.path.join(self.cache_dir, key + '.npz')
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            count('cache_misses')
+            return None
+
+        self.hits += 1
+        count('cache_hits')
+        return arrays
+
+    def save(self, key, **arrays):
+
+        '''save: stores the arrays as the entry of the key, then evicts the
+        least recently used entries if the cache is too large.'''
+
+        path = os.path.join(self.cache_dir, key + '.npz')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+
+        '''evict: deletes the least recently used entries until the cache
+        is not larger than max_bytes.'''
+
+        if self.max_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+def file_sha1(path):
+
+    '''file_sha1: returns the SHA-1 of the content of a file.'''
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def signal_sha1(samples, sample_rate):
+
+    '''signal_sha1: returns the SHA-1 of a signal in memory (see
+    load_audio), i.e. of its samples, with their format and shape, and of
+    its sample rate.'''
+
+    view = memoryview(np.ascontiguousarray(samples)
+        if isinstance(samples, np.ndarray) else samples)
+    sha1 = hashlib.sha1(f'{view.format} {view.shape} {sample_rate}'.encode())
+    sha1.update(view)
+
+    return sha1.hexdigest()
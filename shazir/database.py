@@ -1,12 +1,30 @@
 import os
+import inspect
 import pandas as pd
 import json
+import logging
+import sys
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from fingerprints import fingerprint_track_and_add_to_database
+from fingerprints import make_fingerprint, make_packed_fingerprint, \
+    add_fingerprints_to_database, add_fingerprints_to_postings, \
+    HASH_FREQ_BITS, HASH_DELTA_BITS
+from index import FingerprintIndex, IndexBuilder, convert_json_database
+from cache import PeaksCache, file_sha1
+from instrumentation import collect, count, merge, stage
 
 
-def create_new_database():
+DATABASE_DIR = '../resources/database'
+
+logger = logging.getLogger(__name__)
+
+
+def create_new_database(packed = False, workers = 1,
+    database_dir = DATABASE_DIR, cache = None, memory_limit = None,
+    block_frames = None):
 
     '''
     create_new_database: creates a database from scratch by looping
@@ -14,33 +32,361 @@ def create_new_database():
     the database is implemented by a dictionary of dictionaries; additionally
     it creates a database of metadata for the tracks, implemented by a pandas
     DataFrame.
+
+    The tracks can be fingerprinted in parallel by a pool of processes; the
+    results are merged in the order of the sorted file names, so the track
+    ids do not depend on which worker finishes first.
+
+    Args:
+        packed: if True, the tracks are fingerprinted into packed integer
+            hashes and the database is a FingerprintIndex, saved in the
+            binary file fingerprints_index.bin, instead of
+            fingerprints_dict.json
+        workers: number of processes fingerprinting the tracks
+        database_dir: folder of the database, with the tracks in its wav
+            subfolder
+        cache: optional PeaksCache of the peaks of the tracks (see
+            make_peaks)
+        memory_limit: optional bound of the memory used to build the
+            packed index [bytes]; the postings are then sorted out of core
+            in temporary files of database_dir (see IndexBuilder) rather
+            than gathered in memory
+        block_frames: optional number of frames of the blocks in which the
+            spectrograms of the tracks are computed and their peaks picked
+            (see make_fingerprint), to bound the memory of each worker on
+            long tracks
+
+    Returns:
+        A dictionary with the files that could not be fingerprinted as keys
+        and the raised exceptions as values.
     '''
 
     metadata_db = pd.DataFrame(columns=['track_id', 'title'])
     fingerprints_dict = dict()
+    postings = []
+    if packed and memory_limit is not None:
+        postings = IndexBuilder(memory_limit, temporary_dir=database_dir)
+    failures = dict()
 
-    cwd = os.getcwd()
-    os.chdir('../resources/database/wav')
+    wav_dir = os.path.join(database_dir, 'wav')
+    track_files = sorted(os.listdir(wav_dir))
+    make = make_packed_fingerprint if packed else make_fingerprint
+    if cache is not None:
+        make = partial(make, cache=cache)
+    if block_frames is not None:
+        make = partial(make, block_frames=block_frames)
 
-    for track_file in os.listdir():
+    for track_file, fingerprints_track in fingerprint_tracks(make, wav_dir,
+        track_files, workers):
 
-        try:
-            fingerprint_track_and_add_to_database(track_file, fingerprints_dict,
-                metadata_db)        
-        except:
-            print(f'Skipping track: {track_file}')
+        if isinstance(fingerprints_track, Exception):
+            logger.warning('Skipping track: %s (%r)', track_file,
+                fingerprints_track)
+            failures[track_file] = fingerprints_track
+            count('tracks_failed')
             continue
-    
-    os.chdir('..')
-    json.dump(fingerprints_dict, open( "fingerprints_dict.json", 'w' ) )
-    metadata_db.to_csv('metadata_db.csv')
-    os.chdir(cwd)
+        count('tracks_fingerprinted')
+        if packed:
+            add_fingerprints_to_postings(fingerprints_track, track_file,
+                postings, metadata_db)
+        else:
+            add_fingerprints_to_database(fingerprints_track, track_file,
+                fingerprints_dict, metadata_db)
+
+    if packed:
+        index_file = os.path.join(database_dir, 'fingerprints_index.bin')
+        if isinstance(postings, IndexBuilder):
+            postings.build(index_file)
+        else:
+            with stage('index_build'):
+                index = FingerprintIndex.from_postings(postings)
+            with stage('index_save'):
+                index.save(index_file)
+        tracks = {track_file: track_id for track_id, track_file in
+            zip(metadata_db['track_id'].astype(int), metadata_db['title'])}
+        manifest_tracks = {track_file: dict(_file_stat(os.path.join(wav_dir,
+            track_file)), track_id=int(track_id)) for track_file, track_id
+            in tracks.items()}
+        manifest_tracks.update({track_file: dict(_file_stat(os.path.join(
+            wav_dir, track_file)), error=repr(error)) for track_file, error
+            in failures.items()})
+        save_manifest(database_dir, {'params': fingerprint_params(),
+            'tracks': manifest_tracks})
+    else:
+        with open(os.path.join(database_dir, 'fingerprints_dict.json'),
+            'w') as file:
+            json.dump(fingerprints_dict, file)
+    metadata_db.to_csv(os.path.join(database_dir, 'metadata_db.csv'))
+
+    return failures
+
+
+def update_database(database_dir = DATABASE_DIR, workers = 1,
+    cache = None, block_frames = None):
+
+    '''update_database: brings a packed database up to date with the wav
+    folder, processing only what changed since the last build or update.
+    The manifest records, for each track, the SHA-1 of its content (the
+    file is hashed again only if its size or modification time changed) and
+    its track id, together with the fingerprinting parameters: new files are
+    added, files whose content changed are replaced and deleted files are
+    removed from the posting lists. If there is no manifest or the
+    parameters changed, the database is rebuilt from scratch.
+
+    The files that cannot be fingerprinted are recorded in the manifest
+    with their error, and are not tried again until their content changes;
+    the track of a changed file is replaced only once the new content is
+    fingerprinted, so it stays in the database if that fails. The index is
+    rewritten only if some postings are added or removed.
+
+    Args:
+        database_dir: folder of the database, with the tracks in its wav
+            subfolder
+        workers: number of processes fingerprinting the tracks
+        cache: optional PeaksCache of the peaks of the tracks (see
+            make_peaks)
+        block_frames: see create_new_database
+
+    Returns:
+        A dictionary with the lists of added, updated and removed tracks and
+        the failures (see create_new_database).
+    '''
+
+    index_file = os.path.join(database_dir, 'fingerprints_index.bin')
+    manifest = load_manifest(database_dir)
+
+    if (manifest is None or manifest['params'] != fingerprint_params() or
+        not os.path.exists(index_file)):
+        logger.info('Rebuilding the database from scratch')
+        failures = create_new_database(packed=True, workers=workers,
+            database_dir=database_dir, cache=cache,
+            block_frames=block_frames)
+        return {'added': sorted(track_file for track_file, entry in
+            load_manifest(database_dir)['tracks'].items()
+            if 'error' not in entry),
+            'updated': [], 'removed': [], 'failures': failures}
+
+    wav_dir = os.path.join(database_dir, 'wav')
+    tracks = manifest['tracks']
+    added = []
+    updated = []
+
+    for track_file in sorted(os.listdir(wav_dir)):
+        entry = tracks.get(track_file)
+        path = os.path.join(wav_dir, track_file)
+        stat = os.stat(path)
+        if (entry is not None and entry['size'] == stat.st_size and
+            entry['mtime'] == stat.st_mtime):
+            continue
+        file_stat = _file_stat(path)
+        if entry is not None and entry['sha1'] == file_stat['sha1']:
+            entry.update(file_stat)
+        elif entry is not None and 'track_id' in entry:
+            updated.append(track_file)
+        else:
+            added.append(track_file)  # New, or failed before and changed
+
+    current = set(os.listdir(wav_dir))
+    removed = []
+    removed_track_ids = []
+    for track_file in sorted(tracks):
+        if track_file not in current:
+            entry = tracks.pop(track_file)
+            if 'track_id' in entry:  # Not a failure
+                removed.append(track_file)
+                removed_track_ids.append(entry['track_id'])
+
+    if not (added or updated or removed):
+        save_manifest(database_dir, manifest)
+        return {'added': [], 'updated': [], 'removed': [], 'failures': {}}
+
+    metadata_db = pd.read_csv(os.path.join(database_dir, 'metadata_db.csv'),
+        index_col=0)
+    metadata_db.index = metadata_db.index.astype(str)
+
+    postings = []
+    failures = dict()
+    next_track_id = max((entry['track_id'] for entry in tracks.values()
+        if 'track_id' in entry), default=-1) + 1
+
+    make = make_packed_fingerprint
+    if cache is not None:
+        make = partial(make, cache=cache)
+    if block_frames is not None:
+        make = partial(make, block_frames=block_frames)
+
+    for track_file, fingerprints_track in fingerprint_tracks(make, wav_dir,
+        added + updated, workers):
+
+        file_stat = _file_stat(os.path.join(wav_dir, track_file))
+        if isinstance(fingerprints_track, Exception):
+            logger.warning('Skipping track: %s (%r)', track_file,
+                fingerprints_track)
+            failures[track_file] = fingerprints_track
+            count('tracks_failed')
+            # An updated track keeps its previous fingerprints
+            tracks[track_file] = dict(tracks.get(track_file, dict()),
+                **file_stat, error=repr(fingerprints_track))
+            continue
+        count('tracks_fingerprinted')
+        if 'track_id' in tracks.get(track_file, dict()):
+            removed_track_ids.append(tracks[track_file]['track_id'])
+        add_fingerprints_to_postings(fingerprints_track, track_file,
+            postings, metadata_db, track_id=next_track_id)
+        tracks[track_file] = dict(file_stat, track_id=next_track_id)
+        next_track_id += 1
+
+    if postings or removed_track_ids:
+        metadata_db = metadata_db.drop([str(track_id) for track_id in
+            removed_track_ids])
+        index = FingerprintIndex.load(index_file, mmap=False)
+        with stage('index_build'):
+            index = index.update(removed_track_ids, postings)
+        with stage('index_save'):
+            index.save(index_file + '.tmp')
+            os.replace(index_file + '.tmp', index_file)
+        metadata_db.to_csv(os.path.join(database_dir, 'metadata_db.csv'))
+    save_manifest(database_dir, manifest)
+
+    return {'added': [f for f in added if f not in failures],
+        'updated': [f for f in updated if f not in failures],
+        'removed': removed, 'failures': failures}
+
+
+def fingerprint_params():
+
+    '''fingerprint_params: returns the parameters of the packed
+    fingerprints (defaults of make_packed_fingerprint, except the cache and
+    the blocks, which do not change them, and hash layout), which must not
+    change for an index to be updated incrementally.
+    '''
+
+    params = {name: parameter.default for name, parameter in
+        inspect.signature(make_packed_fingerprint).parameters.items()
+        if parameter.default is not inspect.Parameter.empty and
+        name not in ('cache', 'block_frames')}
+    params['hash_freq_bits'] = HASH_FREQ_BITS
+    params['hash_delta_bits'] = HASH_DELTA_BITS
+
+    return params
+
+
+def load_manifest(database_dir = DATABASE_DIR):
+
+    '''load_manifest: loads the manifest of the database, or returns None
+    if there is none.
+    '''
+
+    manifest_file = os.path.join(database_dir, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as file:
+        return json.load(file)
+
+
+def save_manifest(database_dir, manifest):
+
+    '''save_manifest: saves the manifest of the database.'''
+
+    manifest_file = os.path.join(database_dir, 'manifest.json')
+    with open(manifest_file + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def _file_stat(path):
+
+    '''_file_stat: returns the SHA-1 of the content of a file, its size
+    and its modification time.
+    '''
+
+    stat = os.stat(path)
+
+    return {'sha1': file_sha1(path), 'size': stat.st_size,
+        'mtime': stat.st_mtime}
+
+
+def fingerprint_tracks(make, wav_dir, track_files, workers = 1):
+
+    '''fingerprint_tracks: fingerprints the tracks, in a pool of processes
+    if workers is greater than one. At most twice as many tracks as workers
+    are submitted ahead of the one being yielded, so that only their
+    fingerprints are held at a time, however many tracks there are.
+
+    Args:
+        make: function taking the path of a track and returning its
+            fingerprints (make_fingerprint or make_packed_fingerprint)
+        wav_dir: folder of the tracks
+        track_files: names of the track files
+        workers: number of processes
+
+    Yields:
+        Tuples of the track file name and its fingerprints, or the exception
+        raised while fingerprinting it, in the order of track_files.
+    '''
+
+    paths = [os.path.join(wav_dir, track_file) for track_file in track_files]
+
+    if workers <= 1:
+        for track_file, path in zip(track_files, paths):
+            try:
+                yield track_file, make(path)
+            except Exception as error:
+                yield track_file, error
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        submitted = 0
+        for track_file in track_files:
+            while submitted < len(paths) and len(pending) < 2 * workers:
+                pending.append(executor.submit(collect, make,
+                    paths[submitted]))
+                submitted += 1
+            future = pending.popleft()
+            try:
+                result, stats = future.result()
+                # The statistics recorded in the worker
+                merge(stats)
+            except Exception as error:
+                result = error
+            del future
+            yield track_file, result
 
 
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     start = time.time()
-    create_new_database()
+    workers = 1
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    cache = PeaksCache() if '--cache' in sys.argv else None
+    block_frames = None
+    if '--block-frames' in sys.argv:
+        block_frames = int(sys.argv[sys.argv.index('--block-frames') + 1])
+    memory_limit = None
+    if '--memory-limit' in sys.argv:
+        # In MiB
+        memory_limit = int(float(sys.argv[sys.argv.index('--memory-limit')
+            + 1]) * 2**20)
+
+    if '--convert' in sys.argv:
+        convert_json_database('../resources/database/fingerprints_dict.json',
+            '../resources/database/fingerprints_index.bin')
+    elif '--update' in sys.argv:
+        changes = update_database(workers=workers, cache=cache,
+            block_frames=block_frames)
+        print(f"Added {len(changes['added'])}, updated "
+            f"{len(changes['updated'])}, removed {len(changes['removed'])} "
+            f"tracks, {len(changes['failures'])} failures")
+    else:
+        failures = create_new_database(packed='--packed' in sys.argv,
+            workers=workers, cache=cache, memory_limit=memory_limit,
+            block_frames=block_frames)
+        if failures:
+            print(f'{len(failures)} tracks could not be fingerprinted: '
+                f'{", ".join(failures)}')
     end = time.time()
     print(f'Running time: {end - start}')
\ No newline at end of file
@@ -1,11 +1,34 @@
-# import time
+import time
 import numpy as np
-from skimage.feature import peak_local_max
-from preprocess import process_audio_file
+from cache import file_sha1, signal_sha1
+from instrumentation import count, stage, timed
+from preprocess import DECODER, process_audio_blocks, process_audio_file
 
 
 AMP_THRESH = 0.7
 
+# Density caps of the peaks (None: no cap) and edges [Hz] of the frequency
+# bands of max_peaks_per_band
+PEAKS_PER_SECOND = None
+MAX_PEAKS_PER_FRAME = None
+MAX_PEAKS_PER_BAND = None
+PEAKS_BANDS = (250, 500, 1000, 2000, 4000)
+
+# Target zone of the anchors and number of pairs of each anchor (see
+# make_combinatorial_hashes); PAIRING lists them in the order of the
+# arguments of make_combinatorial_hashes and make_packed_hashes
+OFFSET_TIME = 1  # [s]
+OFFSET_FREQ = 500  # [Hz]
+DELTA_TIME = 10  # [s]
+DELTA_FREQ = 1000  # [Hz]
+FAN_OUT = 15
+PAIRING = (OFFSET_TIME, OFFSET_FREQ, DELTA_TIME, DELTA_FREQ, FAN_OUT)
+
+# Layout of the packed hashes: anchor frequency bin | target frequency bin |
+# delta frames, from the most to the least significant bits of a uint32
+HASH_FREQ_BITS = 11
+HASH_DELTA_BITS = 10
+
 
 def fingerprint_track_and_add_to_database(track_file, fingerprints_dict,
     metadata_db):
@@ -23,6 +46,25 @@ def fingerprint_track_and_add_to_database(track_file, fingerprints_dict,
     '''
 
     fingerprints_track = make_fingerprint(track_file)
+    add_fingerprints_to_database(fingerprints_track, track_file,
+        fingerprints_dict, metadata_db)
+
+
+def add_fingerprints_to_database(fingerprints_track, track_file,
+    fingerprints_dict, metadata_db):
+
+    '''add_fingerprints_to_database: adds the fingerprints of a track, as
+    returned by make_fingerprint, to the database, with the next track id.
+
+    Args:
+        fingerprints_track: dictionary of the track fingerprints
+        track_file: name of the track audio file
+        fingerprints_dict: dictionary where hashes are the keys and the value
+            is another dictionary where the track_id is the key and the time
+            offset is the value
+        metadata_db: pandas DataFrame that contains metadata information about
+            the tracks (track id and file name)
+    '''
 
     track_id = str(len(metadata_db.index))
     metadata_db.loc[track_id] = [track_id, track_file]
@@ -34,35 +76,98 @@ def fingerprint_track_and_add_to_database(track_file, fingerprints_dict,
             fingerprints_dict[h] = {track_id: fingerprints_track[h]}
 
 
-def fingerprint_recording(recording_file, amp_thresh = AMP_THRESH):
+def fingerprint_recording(recording_file, amp_thresh = AMP_THRESH,
+    packed = False):
 
-    '''fingerprint_recording: takes a recording file and processes it into
-    its fingerprints.
+    '''fingerprint_recording: takes a recording file, or a recording
+    still in memory, and processes it into its fingerprints.
 
     Args:
-        recording_file: .wav file to be processed
+        recording_file: .wav file to be processed, or tuple of the recorded
+            samples and their sample rate (see load_audio), which are
+            fingerprinted without being written to a file
         amp_thresh: minimum amplitude value for a point to be considered
             a candidate peak
+        packed: if True, the fingerprints are packed integer hashes, to be
+            searched in a FingerprintIndex
 
     Returns:
-        A dictionary containing the recording fingerprints.
+        A dictionary containing the recording fingerprints, or a tuple of
+        hashes and offsets arrays if packed.
     '''
 
+    if packed:
+        return make_packed_fingerprint(recording_file, amp_thresh=amp_thresh)
+
     fingerprints_recording = make_fingerprint(recording_file,
         amp_thresh=amp_thresh)
 
     return fingerprints_recording
 
 
+def fingerprint_track_and_add_to_postings(track_file, postings,
+    metadata_db):
+
+    '''fingerprint_track_and_add_to_postings: takes a track, processes
+    it into its packed fingerprints and appends them to the postings.
+
+    Args:
+        track_file: audio file in .wav
+        postings: list of (hashes, track_ids, offsets) arrays, one entry for
+            each track, from which a FingerprintIndex is built
+        metadata_db: pandas DataFrame that contains metadata information about
+            the tracks (track id and file name)
+    '''
+
+    fingerprints_track = make_packed_fingerprint(track_file)
+    add_fingerprints_to_postings(fingerprints_track, track_file, postings,
+        metadata_db)
+
+
+def add_fingerprints_to_postings(fingerprints_track, track_file, postings,
+    metadata_db, track_id = None):
+
+    '''add_fingerprints_to_postings: appends the packed fingerprints of a
+    track, as returned by make_packed_fingerprint, to the postings, with the
+    next track id.
+
+    Args:
+        fingerprints_track: tuple of the track hashes and offsets arrays
+        track_file: name of the track audio file
+        postings: list of (hashes, track_ids, offsets) arrays, one entry for
+            each track, from which a FingerprintIndex is built
+        metadata_db: pandas DataFrame that contains metadata information about
+            the tracks (track id and file name)
+        track_id: id of the track; by default, the number of tracks in
+            metadata_db
+    '''
+
+    hashes, offsets = fingerprints_track
+
+    if track_id is None:
+        track_id = len(metadata_db.index)
+    metadata_db.loc[str(track_id)] = [str(track_id), track_file]
+
+    postings.append((hashes, np.full(len(hashes), track_id, dtype=np.int32),
+        offsets))
+
+
 def make_fingerprint(audio_file, frame_size = 2048, hop_size = 512,
-    amp_thresh = AMP_THRESH, offset_time = 1, offset_freq = 500, delta_time = 10,
-    delta_freq = 1000, fan_out = 15):
+    amp_thresh = AMP_THRESH, offset_time = OFFSET_TIME,
+    offset_freq = OFFSET_FREQ, delta_time = DELTA_TIME,
+    delta_freq = DELTA_FREQ, fan_out = FAN_OUT,
+    peaks_per_second = PEAKS_PER_SECOND,
+    max_peaks_per_frame = MAX_PEAKS_PER_FRAME,
+    max_peaks_per_band = MAX_PEAKS_PER_BAND, decoder = DECODER,
+    cache = None, timings = None, block_frames = None):
 
     '''make_fingerprint: takes in imput an audio file in .wav and performs
     the fingerprinting of it.
 
     Args:
-        audio_file: audio file in .wav
+        audio_file: audio file in .wav (path or file object), or tuple of
+            an array of samples, or any object exposing the buffer
+            protocol, and of their sample rate (see load_audio)
         frame_size: number of samples in the time frame - should be a
             power of two
         hop_size: number of time samples in between successive frames - should
@@ -79,33 +184,212 @@ def make_fingerprint(audio_file, frame_size = 2048, hop_size = 512,
             a possible pair
         fan_out: maximum number of pairs for each peak in the combinatorial
             hashing
+        peaks_per_second, max_peaks_per_frame, max_peaks_per_band: density
+            caps of the peaks (see make_peaks_constellation)
+        decoder: how the audio file is decoded (see load_audio)
+        cache: optional PeaksCache, where the peaks are looked up before
+            computing them
+        timings: optional dictionary, where the running times [s] of the
+            spectrogram, peaks and hashes stages are stored
+        block_frames: if given, the spectrogram is computed and its peaks
+            are picked in blocks of this many frames, with the same result,
+            so that the whole spectrogram is never in memory (see
+            process_audio_blocks); useful for long tracks
 
     Returns:
         A dictionary representing the fingerprints of the input audio.
     '''
     
-    times, frequencies, amplitudes = process_audio_file(audio_file,
-        frame_size, hop_size)
-
-    peaks_times, peaks_frequencies = make_peaks_constellation(times,
-        frequencies, amplitudes, amp_thresh)
+    times, frequencies, peaks_times, peaks_frequencies = make_peaks(
+        audio_file, frame_size, hop_size, amp_thresh, peaks_per_second,
+        max_peaks_per_frame, max_peaks_per_band, decoder, cache, timings,
+        block_frames)
+    peaks_end = time.perf_counter()
     
     fingerprints_dict = make_combinatorial_hashes(peaks_times,
         peaks_frequencies, offset_time, offset_freq, delta_time, delta_freq,
         fan_out)
+
+    if timings is not None:
+        timings['hashes'] = time.perf_counter() - peaks_end
     
     return fingerprints_dict
     
 
+def make_packed_fingerprint(audio_file, frame_size = 2048, hop_size = 512,
+    amp_thresh = AMP_THRESH, offset_time = OFFSET_TIME,
+    offset_freq = OFFSET_FREQ, delta_time = DELTA_TIME,
+    delta_freq = DELTA_FREQ, fan_out = FAN_OUT,
+    peaks_per_second = PEAKS_PER_SECOND,
+    max_peaks_per_frame = MAX_PEAKS_PER_FRAME,
+    max_peaks_per_band = MAX_PEAKS_PER_BAND, decoder = DECODER,
+    cache = None, timings = None, block_frames = None):
+
+    '''make_packed_fingerprint: same as make_fingerprint, but the
+    fingerprints are returned as packed integer hashes, keeping every
+    occurrence of a hash.
+
+    Args:
+        audio_file: audio file in .wav, or tuple of samples and sample
+            rate (see make_fingerprint)
+        frame_size, hop_size, amp_thresh, offset_time, offset_freq,
+            delta_time, delta_freq, fan_out, peaks_per_second,
+            max_peaks_per_frame, max_peaks_per_band, decoder, cache,
+            timings, block_frames: see make_fingerprint
+
+    Returns:
+        A tuple consisting of an array of uint32 hashes and an array of the
+        corresponding anchor time offsets, in frames.
+    '''
+
+    times, frequencies, peaks_times, peaks_frequencies = make_peaks(
+        audio_file, frame_size, hop_size, amp_thresh, peaks_per_second,
+        max_peaks_per_frame, max_peaks_per_band, decoder, cache, timings,
+        block_frames)
+    peaks_end = time.perf_counter()
+
+    fingerprints = make_packed_hashes(peaks_times, peaks_frequencies, times,
+        frequencies, offset_time, offset_freq, delta_time, delta_freq, fan_out)
+
+    if timings is not None:
+        timings['hashes'] = time.perf_counter() - peaks_end
+
+    return fingerprints
+
+
+def make_peaks(audio_file, frame_size = 2048, hop_size = 512,
+    amp_thresh = AMP_THRESH, peaks_per_second = PEAKS_PER_SECOND,
+    max_peaks_per_frame = MAX_PEAKS_PER_FRAME,
+    max_peaks_per_band = MAX_PEAKS_PER_BAND, decoder = DECODER, cache = None,
+    timings = None, block_frames = None):
+
+    '''make_peaks: computes the spectrogram of an audio file and its peak
+    constellation, or loads them from the cache. The peaks are cached by
+    file content and by all the parameters they depend on; if the cache
+    also keeps the spectrograms, a change of amp_thresh or of the density
+    caps only repeats the peak picking. With block_frames the spectrogram
+    is not kept in the cache, since it is never whole in memory, and the
+    peaks time includes the second pass over the spectrogram.
+
+    Args:
+        audio_file: audio file in .wav, or tuple of samples and sample
+            rate (see make_fingerprint)
+        frame_size, hop_size, amp_thresh, peaks_per_second,
+            max_peaks_per_frame, max_peaks_per_band, decoder, cache,
+            timings, block_frames: see make_fingerprint
+
+    Returns:
+        A tuple consisting of the arrays of the time [s] and frequency [Hz]
+        samples of the spectrogram and of the time and frequency coordinates
+        of the peaks (see make_peaks_constellation).
+    '''
+
+    start = time.perf_counter()
+    content_hash = None
+    if cache is not None:
+        content_hash = _content_hash(audio_file)
+        peaks_key = cache.key(content_hash, {'frame_size': frame_size,
+            'hop_size': hop_size, 'decoder': decoder,
+            'amp_thresh': amp_thresh, 'peaks_per_second': peaks_per_second,
+            'max_peaks_per_frame': max_peaks_per_frame,
+            'max_peaks_per_band': max_peaks_per_band})
+        entry = cache.load(peaks_key)
+        if entry is not None:
+            times = entry['times']
+            frequencies = entry['frequencies']
+            if timings is not None:
+                timings['spectrogram'] = time.perf_counter() - start
+                timings['peaks'] = 0.0
+            return times, frequencies, \
+                times[entry['peaks_frames'].astype(np.intp)[:, np.newaxis]], \
+                frequencies[entry['peaks_bins'].astype(np.intp)[:, np.newaxis]]
+
+    if block_frames is not None:
+        times, frequencies, blocks = process_audio_blocks(audio_file,
+            frame_size, hop_size, decoder, block_frames)
+        spectrogram_end = time.perf_counter()
+        peaks_times, peaks_frequencies = make_peaks_constellation_blocks(
+            times, frequencies, blocks, amp_thresh, peaks_per_second,
+            max_peaks_per_frame, max_peaks_per_band)
+    else:
+        times, frequencies, amplitudes = make_spectrogram(audio_file,
+            frame_size, hop_size, decoder, cache, content_hash)
+        spectrogram_end = time.perf_counter()
+        peaks_times, peaks_frequencies = make_peaks_constellation(times,
+            frequencies, amplitudes, amp_thresh, peaks_per_second,
+            max_peaks_per_frame, max_peaks_per_band)
+    if cache is not None:
+        # Peaks are stored compactly as indices into the time and frequency
+        # samples
+        cache.save(peaks_key, times=times, frequencies=frequencies,
+            peaks_frames=np.searchsorted(times,
+            peaks_times.ravel()).astype(np.int32),
+            peaks_bins=np.searchsorted(frequencies,
+            peaks_frequencies.ravel()).astype(np.uint16))
+
+    if timings is not None:
+        timings['spectrogram'] = spectrogram_end - start
+        timings['peaks'] = time.perf_counter() - spectrogram_end
+
+    return times, frequencies, peaks_times, peaks_frequencies
+
+
+def make_spectrogram(audio_file, frame_size = 2048, hop_size = 512,
+    decoder = DECODER, cache = None, content_hash = None):
+
+    '''make_spectrogram: computes the spectrogram of an audio file (see
+    process_audio_file), or loads it from the cache if the cache keeps the
+    spectrograms.
+
+    Args:
+        audio_file: audio file in .wav, or tuple of samples and sample
+            rate (see make_fingerprint)
+        frame_size, hop_size, decoder, cache: see make_fingerprint
+        content_hash: SHA-1 of the file content, if already known
+
+    Returns:
+        A tuple consisting of the arrays of the time [s] and frequency [Hz]
+        samples and of the normalized amplitudes.
+    '''
+
+    if cache is None or not cache.spectrogram:
+        return process_audio_file(audio_file, frame_size, hop_size, decoder)
+
+    if content_hash is None:
+        content_hash = _content_hash(audio_file)
+    key = cache.key(content_hash, {'frame_size': frame_size,
+        'hop_size': hop_size, 'decoder': decoder})
+    entry = cache.load(key)
+    if entry is not None:
+        return entry['times'], entry['frequencies'], entry['amplitudes']
+
+    times, frequencies, amplitudes = process_audio_file(audio_file,
+        frame_size, hop_size, decoder)
+    cache.save(key, times=times, frequencies=frequencies,
+        amplitudes=amplitudes)
+
+    return times, frequencies, amplitudes
+
+
 ### Helper functions in the following
 
 
-def make_peaks_constellation(times, frequencies, amplitudes, amp_thresh=AMP_THRESH):
+@timed('peaks')
+def make_peaks_constellation(times, frequencies, amplitudes, amp_thresh=AMP_THRESH,
+    peaks_per_second=PEAKS_PER_SECOND, max_peaks_per_frame=MAX_PEAKS_PER_FRAME,
+    max_peaks_per_band=MAX_PEAKS_PER_BAND, bands=PEAKS_BANDS):
 
     '''make_peaks_constellation: identifies peaks in the spectrogram. Peaks are
     time-frequency points that have higher energy content then all
     their neighbours. A minimum amplitude threshold is also considered.
 
+    The neighbourhood maxima are computed with a separable maximum filter
+    (one pass along frequency, one along time), only at the points above
+    the threshold, giving the same peaks, in the same order, as skimage
+    peak_local_max (see make_peaks_constellation_skimage). Optionally the density of the peaks
+    is capped, keeping the strongest ones, so that the number of hashes does
+    not depend on the loudness and genre of the track.
+
     Args:
         times: array containing the time samples
         frequencies: array containing the frequency samples
@@ -113,30 +397,361 @@ def make_peaks_constellation(times, frequencies, amplitudes, amp_thresh=AMP_THRE
             amplitudes.shape = (frequencies.shape, times.shape)    
         amp_thresh: minimum amplitude value for a point to be considered
             a candidate peak
+        peaks_per_second: if given, maximum number of peaks in each second
+        max_peaks_per_frame: if given, maximum number of peaks in each time
+            frame
+        max_peaks_per_band: if given, maximum number of peaks in each
+            frequency band of each time frame
+        bands: edges [Hz] of the frequency bands
 
     Returns:
         A tuple consisting of two arrays, respectively of the time and
-        frequency coordinates of the spectogram peaks.
+        frequency coordinates of the spectogram peaks, sorted by decreasing
+        amplitude.
+    '''
+
+    i, j = _local_maxima(amplitudes, amp_thresh)
+    if amplitudes.min() == amplitudes.max():  # No peak in a constant one
+        i = i[:0]
+        j = j[:0]
+
+    return _select_peaks(times, frequencies, i, j, amplitudes[i, j],
+        peaks_per_second, max_peaks_per_frame, max_peaks_per_band, bands)
+
+
+def make_peaks_constellation_blocks(times, frequencies, blocks,
+    amp_thresh = AMP_THRESH, peaks_per_second = PEAKS_PER_SECOND,
+    max_peaks_per_frame = MAX_PEAKS_PER_FRAME,
+    max_peaks_per_band = MAX_PEAKS_PER_BAND, bands = PEAKS_BANDS):
+
+    '''make_peaks_constellation_blocks: same as make_peaks_constellation,
+    on a spectrogram given block by block, as by process_audio_blocks. The
+    peaks of the frames inside each block are picked as soon as it comes,
+    so only one block of the spectrogram is in memory at a time; they are
+    ordered and capped at the end, all together, so the result is the same
+    as on the whole spectrogram.
+
+    Args:
+        times: array containing the time samples
+        frequencies: array containing the frequency samples
+        blocks: iterable of tuples of the index of the first frame of a
+            block and of its amplitudes, consecutive blocks overlapping by
+            two frames
+        amp_thresh, peaks_per_second, max_peaks_per_frame,
+            max_peaks_per_band, bands: see make_peaks_constellation
+
+    Returns:
+        See make_peaks_constellation.
+    '''
+
+    i = []
+    j = []
+    amplitudes = []
+    lowest = np.inf
+    highest = -np.inf
+
+    for first, block in blocks:
+        with stage('peaks'):
+            block_i, block_j = _local_maxima(block, amp_thresh)
+            i.append(block_i)
+            j.append(block_j + first)
+            amplitudes.append(block[block_i, block_j])
+            lowest = min(lowest, block.min())
+            highest = max(highest, block.max())
+
+    with stage('peaks'):
+        i = np.concatenate(i) if i else np.empty(0, dtype=np.intp)
+        j = np.concatenate(j) if j else np.empty(0, dtype=np.intp)
+        amplitudes = np.concatenate(amplitudes) if amplitudes else \
+            np.empty(0, dtype=np.float32)
+        if lowest == highest:  # No peak in a constant one
+            i = i[:0]
+            j = j[:0]
+            amplitudes = amplitudes[:0]
+        # Same order as the points of the whole spectrogram
+        order = np.lexsort((j, i))
+
+        return _select_peaks(times, frequencies, i[order], j[order],
+            amplitudes[order], peaks_per_second, max_peaks_per_frame,
+            max_peaks_per_band, bands)
+
+
+def make_peaks_constellation_skimage(times, frequencies, amplitudes,
+    amp_thresh=AMP_THRESH):
+
+    '''make_peaks_constellation_skimage: reference implementation of
+    make_peaks_constellation, without density caps, using skimage
+    peak_local_max.
     '''
 
-    # start = time.time()
+    from skimage.feature import peak_local_max  # Slow to import
+
     peaks = peak_local_max(amplitudes, threshold_abs=amp_thresh)
     peaks_splitted = np.hsplit(peaks, 2)
     i = peaks_splitted[0]
     j = peaks_splitted[1]
     peaks_frequencies = frequencies[i]
     peaks_times = times[j]
-    # end = time.time()
-    # print(f'make_peaks_constellation took {end - start} s')
 
     return peaks_times, peaks_frequencies
 
 
+def _select_peaks(times, frequencies, i, j, amplitudes, peaks_per_second,
+    max_peaks_per_frame, max_peaks_per_band, bands):
+
+    # Orders the peaks, given in the order of the points of the
+    # spectrogram, by decreasing amplitude and applies the density caps
+    order = np.argsort(-amplitudes, kind='stable')  # Highest first
+    i = i[order]
+    j = j[order]
+
+    keep = np.ones(len(i), dtype=bool)
+    if max_peaks_per_band is not None:
+        band = np.searchsorted(bands, frequencies[i], side='right')
+        keep &= _rank_in_groups(j * (len(bands) + 1) + band) < \
+            max_peaks_per_band
+    if max_peaks_per_frame is not None:
+        keep &= _rank_in_groups(np.where(keep, j, -1)) < max_peaks_per_frame
+    if peaks_per_second is not None and len(times) > 1:
+        # Seconds are counted in whole frames, from the first one
+        second_frames = max(1, int(round(1 / (times[1] - times[0]))))
+        keep &= _rank_in_groups(np.where(keep, j // second_frames, -1)) < \
+            peaks_per_second
+    # Column vectors, as returned by peak_local_max and np.hsplit
+    i = i[keep, np.newaxis]
+    j = j[keep, np.newaxis]
+
+    peaks_frequencies = frequencies[i]
+    peaks_times = times[j]
+    count('peaks_found', len(i))
+
+    return peaks_times, peaks_frequencies
+
+
+def _local_maxima(amplitudes, amp_thresh):
+
+    # Only the few points above the threshold, out of the border, can be
+    # peaks: the maximum of their 3x3 neighbourhood is computed for them
+    # alone, first along frequency for the three frames, then along time
+    i, j = np.nonzero(amplitudes[1:-1, 1:-1] > amp_thresh)
+    i += 1
+    j += 1
+    maxima = amplitudes[i, j]
+    for frame in (j - 1, j, j + 1):
+        maxima = np.maximum(maxima, np.maximum(np.maximum(
+            amplitudes[i - 1, frame], amplitudes[i, frame]),
+            amplitudes[i + 1, frame]))
+    is_peak = amplitudes[i, j] == maxima
+
+    return i[is_peak], j[is_peak]
+
+
+def _content_hash(audio_file):
+
+    # Key of the audio in the cache: the SHA-1 of the file content, or of
+    # the samples of a signal in memory
+    if isinstance(audio_file, tuple):
+        return signal_sha1(*audio_file)
+    return file_sha1(audio_file)
+
+
+def _rank_in_groups(groups):
+
+    # Rank of each element among the ones of its group, in the input order;
+    # the group -1 collects the elements already discarded, and is not
+    # ranked
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] !=
+        sorted_groups[:-1]])
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.repeat(starts,
+        np.diff(np.r_[starts, len(groups)]))
+    ranks[groups == -1] = np.iinfo(np.int64).max
+
+    return ranks
+
+
+@timed('hashes')
 def make_combinatorial_hashes(peaks_times, peaks_frequencies,
     offset_time, offset_freq, delta_time, delta_freq, fan_out):
 
     '''make_combinatorial_hashes: processes the spectogram peaks of a
-    single track into its combinatorial hashes.
+    single track into its combinatorial hashes. The anchor/target pairs are
+    found by make_combinatorial_pairs, so the result is the same as the one
+    of make_combinatorial_hashes_loop.
+
+    Args:
+        peaks_times: time values for the peaks
+        peaks_frequencies: frequency values for the peaks
+        offset_time: minimum time distance from the anchor point time value
+            for a peak to be a possible pair 
+        offset_frequency: minimum frequency distance from the anchor point
+            frequency value for a peak to be a possible pair 
+        delta_time: determines the maximum time value for a peak to be a
+            possible pair
+        delta_freq: determines the maximum frequency value for a peak to be
+            a possible pair
+        fan_out: maximum number of pairs for each peak in the combinatorial
+            hashing
+    
+    Returns:
+        Returns a dictionary where hashes are the keys and the value is
+        another dictionary where the track_id is the key and the time offset
+        is the value.
+    '''
+
+    peaks_times = np.ravel(peaks_times)
+    peaks_frequencies = np.ravel(peaks_frequencies)
+
+    anchors, targets = make_combinatorial_pairs(peaks_times,
+        peaks_frequencies, offset_time, offset_freq, delta_time, delta_freq,
+        fan_out)
+    count('hashes_emitted', len(anchors))
+
+    anchor_times = peaks_times[anchors]
+    delta_times = peaks_times[targets] - anchor_times
+
+    fingerprints_dict = dict()
+    for anchor_freq, f, dt, anchor_time in zip(
+        peaks_frequencies[anchors].tolist(), peaks_frequencies[targets].tolist(),
+        delta_times.tolist(), anchor_times.tolist()):
+        fingerprints_dict[str(hash((anchor_freq, f, dt)))] = anchor_time
+
+    return fingerprints_dict
+
+
+def make_combinatorial_pairs(peaks_times, peaks_frequencies, offset_time,
+    offset_freq, delta_time, delta_freq, fan_out, max_candidates=2**22):
+
+    '''make_combinatorial_pairs: finds the anchor/target pairs of the
+    combinatorial hashing with NumPy. Peaks are sorted by frequency band and
+    time once and the target zone of each anchor is located with a binary
+    search in the (at most two) bands it overlaps; anchors are
+    processed in blocks so that at most max_candidates candidate pairs are
+    held in memory at the same time.
+
+    For each anchor the targets are the first fan_out peaks, in input order,
+    that fall in the target zone, and pairs are returned sorted by anchor and
+    then by target, i.e. in the same order in which the nested loop of
+    make_combinatorial_hashes_loop emits them.
+
+    Args:
+        peaks_times: time values for the peaks
+        peaks_frequencies: frequency values for the peaks
+        offset_time: minimum time distance from the anchor point time value
+            for a peak to be a possible pair 
+        offset_frequency: minimum frequency distance from the anchor point
+            frequency value for a peak to be a possible pair 
+        delta_time: determines the maximum time value for a peak to be a
+            possible pair
+        delta_freq: determines the maximum frequency value for a peak to be
+            a possible pair
+        fan_out: maximum number of pairs for each peak in the combinatorial
+            hashing
+        max_candidates: maximum number of candidate pairs checked at once
+
+    Returns:
+        A tuple consisting of two integer arrays, respectively of the indices
+        of the anchor peaks and of the target peaks.
+    '''
+
+    peaks_times = np.ravel(peaks_times)
+    peaks_frequencies = np.ravel(peaks_frequencies)
+    n_peaks = len(peaks_times)
+
+    if n_peaks == 0 or delta_freq <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Peaks are sorted by frequency band of width delta_freq and then by
+    # time, on a single key: the target zone of an anchor spans at most two
+    # bands, in each of which the zone is a contiguous range of keys
+    bands = np.floor(peaks_frequencies / delta_freq)
+    span = (peaks_times.max() - peaks_times.min() + abs(offset_time) +
+        abs(delta_time) + 1)
+    order = np.lexsort((peaks_times, bands))
+    sorted_keys = bands[order] * span + peaks_times[order]
+    # Ranges are widened by a few ulps of the keys and the zone is checked
+    # exactly afterwards, so rounding in the keys cannot lose a target
+    eps = 4 * np.spacing(np.abs(sorted_keys).max())
+
+    # Target zone in time: start_time < t < start_time + delta_time
+    start_times = peaks_times + offset_time
+    first_bands = np.floor((peaks_frequencies - offset_freq) / delta_freq)
+    lower = np.empty((n_peaks, 2), dtype=np.int64)
+    upper = np.empty((n_peaks, 2), dtype=np.int64)
+    for j in range(2):
+        band_keys = (first_bands + j) * span + start_times
+        lower[:, j] = np.searchsorted(sorted_keys, band_keys - eps,
+            side='right')
+        upper[:, j] = np.searchsorted(sorted_keys, band_keys + delta_time +
+            eps, side='left')
+    segment_counts = np.maximum(upper - lower, 0)
+    counts = segment_counts.sum(axis=1)
+    ends = np.cumsum(counts)
+
+    anchors_blocks = []
+    targets_blocks = []
+    first = 0
+
+    while first < n_peaks:
+        # Largest block of anchors whose candidates fit in max_candidates
+        done = ends[first - 1] if first > 0 else 0
+        last = max(int(np.searchsorted(ends, done + max_candidates,
+            side='right')), first + 1)
+        block_counts = counts[first:last]
+        n_candidates = int(block_counts.sum())
+
+        if n_candidates > 0:
+            # One segment of candidates for each anchor and band
+            block_segments = segment_counts[first:last].ravel()
+            anchors = np.repeat(np.repeat(np.arange(first, last), 2),
+                block_segments)
+            segment_starts = np.cumsum(block_segments) - block_segments
+            positions = (np.arange(n_candidates) -
+                np.repeat(segment_starts - lower[first:last].ravel(),
+                block_segments))
+            targets = order[positions]
+
+            # Target zone: start_time < t < start_time + delta_time and
+            # start_freq < f < start_freq + delta_freq
+            start_freqs = peaks_frequencies[anchors] - offset_freq
+            target_freqs = peaks_frequencies[targets]
+            target_times = peaks_times[targets]
+            in_zone = ((target_times > start_times[anchors]) &
+                (target_times < start_times[anchors] + delta_time) &
+                (target_freqs > start_freqs) &
+                (target_freqs < start_freqs + delta_freq))
+            anchors = anchors[in_zone]
+            targets = targets[in_zone]
+
+            # Keep the first fan_out targets of each anchor, in input order
+            sorting = np.argsort(anchors.astype(np.int64) * n_peaks + targets)
+            anchors = anchors[sorting]
+            targets = targets[sorting]
+            new_anchor = np.ones(len(anchors), dtype=bool)
+            new_anchor[1:] = anchors[1:] != anchors[:-1]
+            group_starts = np.flatnonzero(new_anchor)
+            group_sizes = np.diff(np.append(group_starts, len(anchors)))
+            ranks = np.arange(len(anchors)) - np.repeat(group_starts,
+                group_sizes)
+            anchors_blocks.append(anchors[ranks < fan_out])
+            targets_blocks.append(targets[ranks < fan_out])
+
+        first = last
+
+    if not anchors_blocks:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    return np.concatenate(anchors_blocks), np.concatenate(targets_blocks)
+
+
+def make_combinatorial_hashes_loop(peaks_times, peaks_frequencies,
+    offset_time, offset_freq, delta_time, delta_freq, fan_out):
+
+    '''make_combinatorial_hashes_loop: reference implementation of
+    make_combinatorial_hashes, pairing peaks with a nested Python loop; it is
+    kept to check and benchmark the vectorized engine against.
 
     Args:
         peaks_times: time values for the peaks
@@ -149,6 +764,8 @@ def make_combinatorial_hashes(peaks_times, peaks_frequencies,
             possible pair
         delta_freq: determines the maximum frequency value for a peak to be
             a possible pair
+        fan_out: maximum number of pairs for each peak in the combinatorial
+            hashing
     
     Returns:
         Returns a dictionary where hashes are the keys and the value is
@@ -177,10 +794,88 @@ def make_combinatorial_hashes(peaks_times, peaks_frequencies,
 
     fingerprints_dict = dict()
 
-    # start = time.time()
     for anchor_time, anchor_freq in zip(peaks_times, peaks_frequencies):
         _pairs_from_anchor_point(anchor_time, anchor_freq)
-    # end = time.time()
-    # print(f'make_combinatorial_hashes took {end - start} s') 
 
-    return fingerprints_dict       
+    return fingerprints_dict
+
+
+@timed('hashes')
+def make_packed_hashes(peaks_times, peaks_frequencies, times, frequencies,
+    offset_time, offset_freq, delta_time, delta_freq, fan_out):
+
+    '''make_packed_hashes: processes the spectogram peaks of a single
+    track into its combinatorial hashes, packed into unsigned integers. The
+    pairs are the same as in make_combinatorial_hashes, but frequencies and
+    times are quantized to the spectrogram bins and frames, so that hashing
+    does not depend on floating point values. Repeated hashes are all kept.
+
+    Args:
+        peaks_times: time values for the peaks
+        peaks_frequencies: frequency values for the peaks
+        times: array containing the time samples of the spectrogram
+        frequencies: array containing the frequency samples of the spectrogram
+        offset_time, offset_freq, delta_time, delta_freq, fan_out: see
+            make_combinatorial_hashes
+
+    Returns:
+        A tuple consisting of an array of uint32 hashes and an array of the
+        corresponding anchor time offsets, in frames.
+    '''
+
+    anchors, targets = make_combinatorial_pairs(peaks_times,
+        peaks_frequencies, offset_time, offset_freq, delta_time, delta_freq,
+        fan_out)
+
+    # Peaks lie on the spectrogram grid, so their indices are found exactly
+    peaks_frames = np.searchsorted(times, np.ravel(peaks_times))
+    peaks_bins = np.searchsorted(frequencies, np.ravel(peaks_frequencies))
+
+    hashes = pack_hashes(peaks_bins[anchors], peaks_bins[targets],
+        peaks_frames[targets] - peaks_frames[anchors])
+    count('hashes_emitted', len(hashes))
+
+    return hashes, peaks_frames[anchors].astype(np.int32)
+
+
+def pack_hashes(anchor_bins, target_bins, delta_frames):
+
+    '''pack_hashes: packs the frequency bins of anchor and target peaks
+    and their distance in frames into uint32 hashes, with HASH_FREQ_BITS
+    bits for each bin and HASH_DELTA_BITS bits for the distance.
+
+    Args:
+        anchor_bins: frequency bins of the anchor peaks
+        target_bins: frequency bins of the target peaks
+        delta_frames: time distances between anchor and target peaks, in
+            frames
+
+    Returns:
+        An array of uint32 hashes.
+
+    Raises:
+        ValueError: if a bin or a distance does not fit in its bits, since
+            it would collide with the hashes of other values.
+    '''
+
+    anchor_bins = _check_bits(anchor_bins, HASH_FREQ_BITS, 'frequency bins')
+    target_bins = _check_bits(target_bins, HASH_FREQ_BITS, 'frequency bins')
+    delta_frames = _check_bits(delta_frames, HASH_DELTA_BITS,
+        'time distances')
+
+    hashes = anchor_bins << (HASH_FREQ_BITS + HASH_DELTA_BITS)
+    hashes |= target_bins << HASH_DELTA_BITS
+    hashes |= delta_frames
+
+    return hashes
+
+
+def _check_bits(values, bits, name):
+
+    # Returns the values as uint32, if they are all in [0, 2**bits)
+    values = np.asarray(values)
+    if len(values) > 0 and (values.min() < 0 or values.max() >= 1 << bits):
+        raise ValueError(f'The {name} must be in [0, {1 << bits}) to be '
+            f'packed in {bits} bits, got [{values.min()}, {values.max()}]')
+
+    return values.astype(np.uint32)
@@ -0,0 +1,585 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from instrumentation import count, stage, timed
+
+
+INDEX_MAGIC = b'SHAZIDX1'
+INDEX_ALIGN = 64
+INDEX_ARRAYS = ('keys', 'starts', 'track_ids', 'offsets')
+
+
+class FingerprintIndex():
+
+    '''FingerprintIndex: inverted index of packed fingerprints. Keys are the
+    sorted unique hashes and, CSR-style, the postings of the i-th key are
+    track_ids[starts[i]:starts[i + 1]] and offsets[starts[i]:starts[i + 1]],
+    i.e. every (track_id, frame offset) occurrence of the hash. The meta
+    dictionary records how the hashes were made ('hash' is 'packed' for
+    make_packed_hashes and 'legacy' for an index converted from
+    fingerprints_dict.json).
+    '''
+
+    def __init__(self, keys, starts, track_ids, offsets, meta = None):
+        self.keys = keys
+        self.starts = starts
+        self.track_ids = track_ids
+        self.offsets = offsets
+        self.meta = {'hash': 'packed'} if meta is None else meta
+
+    @classmethod
+    def from_postings(cls, postings, meta = None):
+
+        '''from_postings: builds the index from the postings of the tracks.
+
+        Args:
+            postings: list of (hashes, track_ids, offsets) arrays, as filled
+                by fingerprint_track_and_add_to_postings
+            meta: dictionary describing the hashes (see FingerprintIndex)
+
+        Returns:
+            A FingerprintIndex.
+        '''
+
+        if len(postings) == 0:
+            return cls.from_sorted(np.empty(0, dtype=np.uint32),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                meta)
+
+        hashes, track_ids, offsets = (np.concatenate(p) for p in
+            zip(*postings))
+        order = np.lexsort((offsets, track_ids, hashes))
+
+        return cls.from_sorted(hashes[order], track_ids[order],
+            offsets[order], meta)
+
+    @classmethod
+    def from_sorted(cls, hashes, track_ids, offsets, meta = None):
+
+        '''from_sorted: builds the index from flat postings already sorted
+        by hash, track id and offset.
+
+        Args:
+            hashes: sorted array with the hash of each posting
+            track_ids: array with the track id of each posting
+            offsets: array with the frame offset of each posting
+            meta: dictionary describing the hashes (see FingerprintIndex)
+
+        Returns:
+            A FingerprintIndex.
+        '''
+
+        if len(hashes) == 0:
+            starts = np.zeros(1, dtype=np.int64)
+        else:
+            boundaries = np.flatnonzero(hashes[1:] != hashes[:-1]) + 1
+            starts = np.concatenate(([0], boundaries,
+                [len(hashes)])).astype(np.int64)
+
+        return cls(hashes[starts[:-1]], starts, track_ids.astype(np.int32),
+            offsets.astype(np.int32), meta)
+
+    def update(self, removed_track_ids = (), postings = ()):
+
+        '''update: returns a new index without the postings of the removed
+        tracks and with the new postings merged in. The new postings are
+        sorted on their own and inserted with a binary search, so the cost
+        is a linear copy of the index plus the sort of the new postings.
+
+        Args:
+            removed_track_ids: ids of the tracks to remove
+            postings: list of (hashes, track_ids, offsets) arrays of the new
+                tracks, whose ids must be greater than the ones left in the
+                index
+
+        Returns:
+            The updated FingerprintIndex.
+        '''
+
+        hashes = np.repeat(self.keys, np.diff(self.starts))
+        track_ids = self.track_ids
+        offsets = self.offsets
+
+        if len(removed_track_ids) > 0:
+            keep = ~np.isin(track_ids, np.asarray(removed_track_ids))
+            hashes, track_ids, offsets = (hashes[keep], track_ids[keep],
+                offsets[keep])
+
+        new = FingerprintIndex.from_postings(list(postings))
+        if new.n_postings > 0:
+            if len(track_ids) > 0 and new.track_ids.min() <= track_ids.max():
+                raise ValueError('New track ids must be greater than the '
+                    'ones in the index')
+            new_hashes = np.repeat(new.keys, np.diff(new.starts)).astype(
+                hashes.dtype)
+            # Existing postings of a hash come before the new ones, whose
+            # track ids are greater
+            positions = np.searchsorted(hashes, new_hashes, side='right')
+            hashes = np.insert(hashes, positions, new_hashes)
+            track_ids = np.insert(track_ids, positions, new.track_ids)
+            offsets = np.insert(offsets, positions, new.offsets)
+
+        return FingerprintIndex.from_sorted(hashes, track_ids, offsets,
+            self.meta)
+
+    def postings(self, h):
+
+        '''postings: returns the posting list of a hash.
+
+        Args:
+            h: hash to look up
+
+        Returns:
+            A tuple consisting of the arrays of track ids and frame offsets
+            of every occurrence of the hash (empty if the hash is missing).
+        '''
+
+        i = np.searchsorted(self.keys, h)
+        if i == len(self.keys) or self.keys[i] != h:
+            start = end = 0
+        else:
+            start, end = self.starts[i], self.starts[i + 1]
+
+        return self.track_ids[start:end], self.offsets[start:end]
+
+    @timed('lookup')
+    def lookup(self, hashes, max_postings = None):
+
+        '''lookup: gathers the postings of many hashes at once.
+
+        Args:
+            hashes: array of hashes to look up
+            max_postings: if given, the hashes with more postings are
+                skipped, as stop words: they are too common (silence, steady
+                tones) to tell the tracks apart and would dominate the cost
+
+        Returns:
+            A tuple of three arrays with one element for each posting of the
+            hashes that are found: the position of the hash in the input
+            array, the track id and the frame offset.
+        '''
+
+        hashes = np.asarray(hashes, dtype=self.keys.dtype)
+        if len(self.keys) == 0 or len(hashes) == 0:
+            return (np.empty(0, dtype=np.intp), self.track_ids[:0],
+                self.offsets[:0])
+
+        positions = np.minimum(np.searchsorted(self.keys, hashes),
+            len(self.keys) - 1)
+        found = np.flatnonzero(self.keys[positions] == hashes)
+        starts = self.starts[positions[found]]
+        counts = self.starts[positions[found] + 1] - starts
+        if max_postings is not None:
+            common = counts > max_postings
+            if common.any():
+                count('hashes_pruned', common.sum())
+                found, starts, counts = (found[~common], starts[~common],
+                    counts[~common])
+
+        query_positions = np.repeat(found, counts)
+        gather = (np.arange(counts.sum()) +
+            np.repeat(starts - (np.cumsum(counts) - counts), counts))
+        count('hashes_hit', len(found))
+        count('postings_scanned', len(gather))
+
+        return query_positions, self.track_ids[gather], self.offsets[gather]
+
+    def save(self, index_file):
+
+        '''save: saves the index to a binary file, made of a magic string,
+        the length of a JSON header, the header itself (meta, dtype, shape
+        and position of each array) and the arrays, aligned to INDEX_ALIGN
+        bytes, so that they can be memory-mapped by load.
+
+        Args:
+            index_file: path of the index file
+        '''
+
+        arrays = [np.ascontiguousarray(getattr(self, name))
+            for name in INDEX_ARRAYS]
+
+        with open(index_file, 'wb') as file:
+            _write_header(file, self.meta, [(array.dtype, len(array))
+                for array in arrays])
+            for array in arrays:
+                file.write(b'\0' * (-file.tell() % INDEX_ALIGN))
+                array.tofile(file)
+
+    @classmethod
+    @timed('index_load')
+    def load(cls, index_file, mmap = True):
+
+        '''load: opens an index saved by save. With mmap the arrays are
+        memory-mapped, so only the header is read here and a query only
+        touches the pages of the postings it needs.
+
+        Args:
+            index_file: path of the index file
+            mmap: if False, the arrays are read in memory
+
+        Returns:
+            A FingerprintIndex.
+        '''
+
+        with open(index_file, 'rb') as file:
+            if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f'{index_file} is not a fingerprint index')
+            header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+            header = json.loads(file.read(header_size))
+
+        arrays = []
+        for name in INDEX_ARRAYS:
+            layout = header['arrays'][name]
+            if layout['shape'] == 0:
+                arrays.append(np.empty(0, dtype=layout['dtype']))
+            elif mmap:
+                arrays.append(np.memmap(index_file, dtype=layout['dtype'],
+                    mode='r', offset=layout['offset'],
+                    shape=(layout['shape'],)))
+            else:
+                arrays.append(np.fromfile(index_file, dtype=layout['dtype'],
+                    count=layout['shape'], offset=layout['offset']))
+
+        return cls(*arrays, meta=header['meta'])
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def n_postings(self):
+        return len(self.track_ids)
+
+    @property
+    def nbytes(self):
+        return (self.keys.nbytes + self.starts.nbytes + self.track_ids.nbytes
+            + self.offsets.nbytes)
+
+
+class IndexBuilder():
+
+    '''IndexBuilder: builds an index file from more postings than fit in
+    memory (external sort). The postings appended are buffered until they
+    reach a run of run_postings, which is sorted and written to a temporary
+    file; build then merges the sorted runs block by block, k-way, and
+    streams the result into the index file, so the memory used never
+    exceeds memory_limit bytes, whatever the number of postings. When there
+    are so many runs that their blocks would be tiny, groups of runs are
+    first merged into longer ones. It can be used in place of the list of
+    postings of FingerprintIndex.from_postings.
+    '''
+
+    # Bytes of memory per buffered posting while sorting a run (the
+    # buffered arrays, their concatenation, the sort order and the sorted
+    # records) and while merging the runs (the blocks, their concatenation,
+    # the sort keys and order and the merged records)
+    _RUN_BYTES = 48
+    _MERGE_BYTES = 64
+    _MIN_BLOCK = 4096  # Records read at once from a run, if possible
+
+    def __init__(self, memory_limit, hash_dtype = np.uint32,
+        temporary_dir = None):
+
+        self.memory_limit = memory_limit
+        self.run_postings = max(1, memory_limit // self._RUN_BYTES)
+        self._dtype = np.dtype([('hash', hash_dtype), ('track_id', np.int32),
+            ('offset', np.int32)])
+        self._temporary_dir = tempfile.mkdtemp(prefix='shazir_runs_',
+            dir=temporary_dir)
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+        self._n_run_files = 0
+
+    def append(self, postings):
+
+        '''append: adds the postings of a track.
+
+        Args:
+            postings: tuple of the hashes, track_ids and offsets arrays
+        '''
+
+        hashes, track_ids, offsets = postings
+        self._buffer.append((np.asarray(hashes, dtype=self._dtype['hash']),
+            np.asarray(track_ids, dtype=np.int32),
+            np.asarray(offsets, dtype=np.int32)))
+        self._buffered += len(hashes)
+        if self._buffered >= self.run_postings:
+            self._write_run()
+
+    def build(self, index_file, meta = None):
+
+        '''build: merges the runs into the index file (see
+        FingerprintIndex.save) and deletes the temporary files.
+
+        Args:
+            index_file: path of the index file
+            meta: dictionary describing the hashes (see FingerprintIndex)
+
+        Returns:
+            The number of postings of the index.
+        '''
+
+        meta = {'hash': 'packed'} if meta is None else meta
+        try:
+            self._write_run()
+            with stage('index_merge'):
+                # Merge passes on groups of runs, until they are few enough
+                # to be merged with blocks of _MIN_BLOCK records
+                runs = self._runs
+                fan_in = max(2, self.memory_limit // (self._MERGE_BYTES *
+                    self._MIN_BLOCK))
+                while len(runs) > fan_in:
+                    runs = [self._merge_to_run(runs[i:i + fan_in])
+                        for i in range(0, len(runs), fan_in)]
+                n_postings, n_keys = self._merge_to_index(runs)
+            with stage('index_save'):
+                self._assemble(index_file, meta, n_postings, n_keys)
+        finally:
+            shutil.rmtree(self._temporary_dir, ignore_errors=True)
+
+        return n_postings
+
+    def _write_run(self):
+
+        if self._buffered == 0:
+            return
+        hashes, track_ids, offsets = (np.concatenate(arrays)
+            for arrays in zip(*self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+        order = np.lexsort((offsets, track_ids, hashes))
+        run = np.empty(len(order), dtype=self._dtype)
+        run['hash'] = hashes[order]
+        run['track_id'] = track_ids[order]
+        run['offset'] = offsets[order]
+        del hashes, track_ids, offsets, order
+
+        run_file = self._run_file()
+        run.tofile(run_file)
+        self._runs.append((run_file, len(run)))
+        count('index_runs')
+
+    def _run_file(self):
+
+        self._n_run_files += 1
+        return os.path.join(self._temporary_dir,
+            f'run_{self._n_run_files}.bin')
+
+    def _merge_to_run(self, runs):
+
+        run_file = self._run_file()
+        n_postings = 0
+        with open(run_file, 'wb') as file:
+            for merged in self._merge_blocks(runs):
+                merged.tofile(file)
+                n_postings += len(merged)
+
+        return run_file, n_postings
+
+    def _merge_to_index(self, runs):
+
+        # Writes the keys, starts, track ids and offsets of the index, each
+        # in a temporary file
+        outputs = {name: open(os.path.join(self._temporary_dir,
+            f'{name}.bin'), 'wb') for name in INDEX_ARRAYS}
+        n_postings = 0
+        n_keys = 0
+        last_hash = None
+
+        try:
+            for merged in self._merge_blocks(runs):
+                hashes = merged['hash']
+                new_key = np.ones(len(hashes), dtype=bool)
+                new_key[1:] = hashes[1:] != hashes[:-1]
+                if last_hash is not None:
+                    new_key[0] = hashes[0] != last_hash
+                hashes[new_key].tofile(outputs['keys'])
+                (np.flatnonzero(new_key) + n_postings).astype(
+                    np.int64).tofile(outputs['starts'])
+                merged['track_id'].tofile(outputs['track_ids'])
+                merged['offset'].tofile(outputs['offsets'])
+                n_keys += int(new_key.sum())
+                n_postings += len(merged)
+                last_hash = hashes[-1]
+            np.array([n_postings], dtype=np.int64).tofile(outputs['starts'])
+        finally:
+            for output in outputs.values():
+                output.close()
+
+        return n_postings, n_keys
+
+    def _merge_blocks(self, runs):
+
+        # Yields the records of the runs in order, in chunks, and deletes the
+        # runs. Every run has a block in memory; the records up to the
+        # smallest last record of the blocks are all in memory, so they are
+        # sorted and yielded, and the blocks that are used up are refilled
+        block_postings = max(1, self.memory_limit // (self._MERGE_BYTES *
+            max(1, len(runs))))
+        files = [open(run_file, 'rb') for run_file, _ in runs]
+        remaining = [n for _, n in runs]
+        blocks = [np.empty(0, dtype=self._dtype) for _ in runs]
+
+        try:
+            while True:
+                for i, file in enumerate(files):
+                    if len(blocks[i]) == 0 and remaining[i] > 0:
+                        blocks[i] = np.fromfile(file, dtype=self._dtype,
+                            count=min(block_postings, remaining[i]))
+                        remaining[i] -= len(blocks[i])
+                if all(len(block) == 0 for block in blocks):
+                    return
+
+                # Bound: the smallest last record among the blocks of the
+                # runs that are not exhausted (none if all are)
+                pending = [tuple(block[-1]) for block, n in zip(blocks,
+                    remaining) if len(block) > 0 and n > 0]
+                bound = min(pending) if pending else None
+
+                merged = []
+                for i, block in enumerate(blocks):
+                    n = len(block) if bound is None else _count_up_to(block,
+                        bound)
+                    merged.append(block[:n])
+                    blocks[i] = block[n:]
+                merged = np.concatenate(merged)
+
+                yield merged[np.lexsort((merged['offset'],
+                    merged['track_id'], merged['hash']))]
+        finally:
+            for file in files:
+                file.close()
+            for run_file, _ in runs:
+                os.remove(run_file)
+
+    def _assemble(self, index_file, meta, n_postings, n_keys):
+
+        # Writes the header and copies the temporary arrays after it
+        arrays = {'keys': (self._dtype['hash'], n_keys),
+            'starts': (np.dtype(np.int64), n_keys + 1),
+            'track_ids': (np.dtype(np.int32), n_postings),
+            'offsets': (np.dtype(np.int32), n_postings)}
+        block_bytes = max(1 << 16, self.memory_limit // 2)
+
+        with open(index_file, 'wb') as file:
+            _write_header(file, meta, [arrays[name]
+                for name in INDEX_ARRAYS])
+            for name in INDEX_ARRAYS:
+                file.write(b'\0' * (-file.tell() % INDEX_ALIGN))
+                with open(os.path.join(self._temporary_dir, f'{name}.bin'),
+                    'rb') as array_file:
+                    shutil.copyfileobj(array_file, file, block_bytes)
+
+
+def _count_up_to(block, bound):
+
+    # Number of records of a sorted block up to the bound record, included
+    hash_bound, track_bound, offset_bound = bound
+    lower = np.searchsorted(block['hash'], hash_bound, side='left')
+    upper = np.searchsorted(block['hash'], hash_bound, side='right')
+    same = block[lower:upper]
+    below = np.searchsorted(same['track_id'], track_bound, side='left')
+    equal = np.searchsorted(same['track_id'], track_bound, side='right')
+    n = below + int(np.searchsorted(same['offset'][below:equal],
+        offset_bound, side='right'))
+
+    return lower + n
+
+
+def _write_header(file, meta, arrays):
+
+    # Writes the magic string, the length of the JSON header and the header
+    # (meta, dtype, shape and position of each array), given the dtype and
+    # length of each array in the order of INDEX_ARRAYS
+    def _header(data_start):
+        position = data_start
+        layout = dict()
+        for name, (dtype, length) in zip(INDEX_ARRAYS, arrays):
+            layout[name] = {'dtype': np.dtype(dtype).str, 'shape': length,
+                'offset': position}
+            position += -(-np.dtype(dtype).itemsize * length //
+                INDEX_ALIGN) * INDEX_ALIGN
+        return json.dumps({'meta': meta, 'arrays': layout}).encode()
+
+    # The header size depends on the offsets it contains: grow the data
+    # start until the header fits before it
+    data_start = INDEX_ALIGN
+    header = _header(data_start)
+    while len(INDEX_MAGIC) + 8 + len(header) > data_start:
+        data_start += INDEX_ALIGN
+        header = _header(data_start)
+
+    file.write(INDEX_MAGIC)
+    file.write(np.uint64(len(header)).tobytes())
+    file.write(header)
+
+
+def legacy_fingerprints_to_arrays(fingerprints, sample_rate = 22050,
+    hop_size = 512):
+
+    '''legacy_fingerprints_to_arrays: converts the fingerprints of a track, as
+    returned by make_fingerprint, into the arrays used by FingerprintIndex:
+    the string hashes become uint64 and the time offsets become frames.
+
+    Args:
+        fingerprints: dictionary where hashes are the keys and the time
+            offsets [s] are the values
+        sample_rate: sample rate used to compute the fingerprints
+        hop_size: hop size used to compute the fingerprints
+
+    Returns:
+        A tuple consisting of an array of uint64 hashes and an array of the
+        corresponding time offsets, in frames.
+    '''
+
+    hashes = np.fromiter((int(h) for h in fingerprints.keys()),
+        dtype=np.int64, count=len(fingerprints)).view(np.uint64)
+    times = np.fromiter(fingerprints.values(), dtype=np.float64,
+        count=len(fingerprints))
+
+    return hashes, np.rint(times * sample_rate / hop_size).astype(np.int32)
+
+
+def convert_json_database(json_file, index_file, sample_rate = 22050,
+    hop_size = 512):
+
+    '''convert_json_database: one-off conversion of a fingerprints_dict.json
+    database into a binary index file; the hashes are kept as they are, so
+    the index has to be queried with fingerprints made by make_fingerprint.
+
+    Args:
+        json_file: path of the .json database
+        index_file: path of the index file to write
+        sample_rate: sample rate used to compute the fingerprints
+        hop_size: hop size used to compute the fingerprints
+
+    Returns:
+        The converted FingerprintIndex.
+    '''
+
+    with open(json_file) as file:
+        fingerprints_dict = json.load(file)
+
+    hashes = []
+    track_ids = []
+    times = []
+    for h, postings in fingerprints_dict.items():
+        for track_id, time in postings.items():
+            hashes.append(int(h))
+            track_ids.append(int(track_id))
+            times.append(time)
+
+    offsets = np.rint(np.array(times, dtype=np.float64) * sample_rate
+        / hop_size).astype(np.int32)
+    index = FingerprintIndex.from_postings([(
+        np.array(hashes, dtype=np.int64).view(np.uint64),
+        np.array(track_ids, dtype=np.int32), offsets)],
+        meta={'hash': 'legacy', 'sample_rate': sample_rate,
+        'hop_size': hop_size})
+    index.save(index_file)
+
+    return index
@@ -0,0 +1,220 @@
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+
+
+# If this environment variable is set, the instrumentation is enabled at
+# import and the statistics are written at exit to the file it names
+STATS_ENV = 'SHAZIR_STATS'
+
+_enabled = False
+_times = defaultdict(float)
+_calls = defaultdict(int)
+_counters = defaultdict(int)
+_hooks = []
+
+
+class _Stage():
+
+    '''_Stage: context manager adding its running time to a stage.'''
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+
+        self.name = name
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        elapsed = time.perf_counter() - self.start
+        _times[self.name] += elapsed
+        _calls[self.name] += 1
+        for hook in _hooks:
+            hook('time', self.name, elapsed)
+        return False
+
+
+class _NullStage():
+
+    '''_NullStage: context manager doing nothing, used when the
+    instrumentation is disabled.'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+
+    '''stage: returns a context manager timing the code it wraps as the
+    given stage (e.g. decode, stft, peaks, hashes, lookup, count, rank). When
+    the instrumentation is disabled it is a shared object doing nothing.
+
+        with stage('peaks'):
+            ...
+    '''
+
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def timed(name):
+
+    '''timed: decorator timing every call of a function as the given stage
+    (see stage).'''
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value = 1):
+
+    '''count: adds value to a counter (e.g. samples_decoded, peaks_found,
+    hashes_emitted, hashes_hit, postings_scanned, candidate_tracks), if the
+    instrumentation is enabled.'''
+
+    if _enabled:
+        value = int(value)
+        _counters[name] += value
+        for hook in _hooks:
+            hook('count', name, value)
+
+
+def enable(hook = None):
+
+    '''enable: enables the instrumentation.
+
+    Args:
+        hook: optional callback, called as hook(kind, name, value) at the end
+            of every stage (kind 'time', value in seconds) and at every
+            counter increment (kind 'count')
+    '''
+
+    global _enabled
+    _enabled = True
+    if hook is not None:
+        _hooks.append(hook)
+
+
+def disable():
+
+    '''disable: disables the instrumentation and removes the hooks; the
+    statistics are kept until reset.'''
+
+    global _enabled
+    _enabled = False
+    _hooks.clear()
+
+
+def is_enabled():
+
+    return _enabled
+
+
+def reset():
+
+    '''reset: clears the timers and the counters.'''
+
+    _times.clear()
+    _calls.clear()
+    _counters.clear()
+
+
+def snapshot():
+
+    '''snapshot: returns the statistics collected so far.
+
+    Returns:
+        A dictionary with the stages, each with its total running time [s]
+        and number of calls, and the counters.
+    '''
+
+    return {'stages': {name: {'time': _times[name], 'calls': _calls[name]}
+        for name in _times}, 'counters': dict(_counters)}
+
+
+def merge(stats):
+
+    '''merge: adds statistics (see snapshot) to the ones collected so far,
+    e.g. those of a worker process returned by collect. The hooks are not
+    called.'''
+
+    if stats is None:
+        return
+    for name, values in stats['stages'].items():
+        _times[name] += values['time']
+        _calls[name] += values['calls']
+    for name, value in stats['counters'].items():
+        _counters[name] += value
+
+
+def collect(function, *args, **kwargs):
+
+    '''collect: calls function in a worker process, and returns its result
+    with the statistics recorded during the call (None if the
+    instrumentation is disabled), to be merged in the parent process:
+
+        result, stats = executor.submit(collect, function, *args).result()
+        merge(stats)
+
+    The statistics of the worker are reset at every call, so it must not be
+    called in the parent process.'''
+
+    if not _enabled:
+        return function(*args, **kwargs), None
+    reset()
+    result = function(*args, **kwargs)
+    return result, snapshot()
+
+
+def export_json(stats_file = None):
+
+    '''export_json: returns the statistics (see snapshot) as JSON, and writes
+    them to stats_file if given.'''
+
+    stats = json.dumps(snapshot(), indent=1, sort_keys=True)
+    if stats_file is not None:
+        with open(stats_file, 'w') as file:
+            file.write(stats)
+
+    return stats
+
+
+def _export_at_exit(stats_file):
+
+    # Worker processes import this module too: only the main process, with
+    # the statistics merged from the workers, writes the file
+    if multiprocessing.parent_process() is None:
+        export_json(stats_file)
+
+
+if os.environ.get(STATS_ENV):
+    enable()
+    atexit.register(_export_at_exit, os.environ[STATS_ENV])
@@ -0,0 +1,273 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from fingerprints import AMP_THRESH
+from index import FingerprintIndex
+from preprocess import stream_audio_file
+from search import MINIMUM_SCORE, DELTA_BIN, MAX_POSTINGS, joint_counts, \
+    load_titles, merge_joint_counts, rank_joint_counts
+from streaming import StreamingFingerprinter
+
+
+MONITOR_SEGMENT_TIME = 5  # [s]
+MONITOR_WINDOW_SEGMENTS = 4
+MONITOR_MAX_GAP = 4  # [segments]
+MONITOR_TOP_K = 10
+MONITOR_MAX_TIME = 30  # [s]
+MONITOR_RELATIVE_SCORE = 0.1
+
+
+class BroadcastMonitor():
+
+    '''BroadcastMonitor: finds every occurrence of the tracks of the index
+    in a long audio stream, such as an hour of radio. The stream is
+    fingerprinted incrementally and the joint counts (see joint_counts) of
+    its hashes are kept per segment of segment_time seconds; the windows of
+    window_segments consecutive segments, sliding by one segment, are ranked
+    by adding up the counts of their segments, so the hashes are looked up
+    only once however much the windows overlap. Every track scoring at least
+    minimum_score in a window, and at least relative_score times the best
+    track of the window, is a detection (the second condition discards the
+    tracks sharing some hashes with the one playing); the detections of the
+    same track with the same time offset are merged into one occurrence, which
+    is returned when the track has not been detected for max_gap segments.
+    The segments that no window needs any more are forgotten, so the memory
+    does not grow with the length of the stream, and the peaks threshold
+    follows the loudness of the last max_time seconds. The hashes with more
+    than max_postings postings are skipped, as in score_tracks; the tracks
+    are not pruned to the candidates, since the counts of the segments are
+    added up.
+    '''
+
+    def __init__(self, index, sample_rate = 22050, frame_size = 2048,
+        hop_size = 512, amp_thresh = AMP_THRESH,
+        segment_time = MONITOR_SEGMENT_TIME,
+        window_segments = MONITOR_WINDOW_SEGMENTS,
+        max_gap = MONITOR_MAX_GAP, minimum_score = MINIMUM_SCORE,
+        delta_bin = DELTA_BIN, top_k = MONITOR_TOP_K,
+        max_time = MONITOR_MAX_TIME,
+        relative_score = MONITOR_RELATIVE_SCORE,
+        max_postings = MAX_POSTINGS):
+
+        self.index = index
+        self._fingerprinter = StreamingFingerprinter(sample_rate, frame_size,
+            hop_size, amp_thresh, max_time=max_time)
+        self._frame_time = hop_size / sample_rate
+        self._segment_frames = max(1, int(round(segment_time /
+            self._frame_time)))
+        self._window_segments = window_segments
+        self._max_gap = max_gap
+        self._minimum_score = minimum_score
+        self._relative_score = relative_score
+        self._delta_bin = delta_bin
+        self._max_postings = max_postings
+        self._top_k = top_k
+        # Detections whose offsets differ by at most this many bins are the
+        # same occurrence, since the offset may straddle two bins
+        self._tolerance = 1
+
+        self._sample_rate = sample_rate
+        self._hop_size = hop_size
+        self.n_samples = 0
+        self._segments = dict()
+        self._next_segment = 0
+        self._open = []
+
+    def feed(self, samples):
+
+        '''feed: processes a new block of mono samples.
+
+        Args:
+            samples: array of float samples at the monitor sample rate
+
+        Returns:
+            The list of the occurrences that ended (see finish).
+        '''
+
+        self.n_samples += len(samples)
+        self._fingerprinter.feed(samples)
+        self._add_hashes(*self._fingerprinter.take())
+
+        return self._scan(self._fingerprinter.committed_frame //
+            self._segment_frames)
+
+    def finish(self):
+
+        '''finish: processes the end of the stream.
+
+        Returns:
+            The list of the occurrences still open, each a dictionary with
+            the track_id, the start_time and end_time in the stream [s], the
+            score (number of matching hashes) and the offset_time of the
+            track with respect to the stream [s], i.e. the track time minus
+            the stream time.
+        '''
+
+        self._add_hashes(*self._fingerprinter.take(final=True))
+        n_segments = -(-self.n_samples // (self._segment_frames *
+            self._hop_size))
+        occurrences = self._scan(n_segments)
+        occurrences.extend(self._close(occurrence)
+            for occurrence in self._open)
+        self._open = []
+
+        return sorted(occurrences, key=lambda occurrence:
+            occurrence['start_time'])
+
+    def _add_hashes(self, hashes, offsets):
+
+        segments = offsets // self._segment_frames
+        for segment in np.unique(segments):
+            keys, counts = joint_counts(self.index,
+                hashes[segments == segment], offsets[segments == segment],
+                self._delta_bin, self._max_postings)
+            # Late anchors of a segment already scanned go to the next one
+            segment = max(int(segment), self._next_segment)
+            if segment in self._segments:
+                keys, counts = merge_joint_counts(*self._segments[segment],
+                    keys, counts)
+            self._segments[segment] = (keys, counts)
+
+    def _scan(self, n_complete):
+
+        # Ranks the windows ending at the segments completed since the last
+        # call and returns the occurrences that ended
+        occurrences = []
+
+        for segment in range(self._next_segment, n_complete):
+            first = max(0, segment - self._window_segments + 1)
+            keys = np.empty(0, dtype=np.int64)
+            counts = np.empty(0, dtype=np.int64)
+            for s in range(first, segment + 1):
+                if s in self._segments:
+                    keys, counts = merge_joint_counts(keys, counts,
+                        *self._segments[s])
+
+            ranking = rank_joint_counts(keys, counts, self._top_k,
+                self._delta_bin, self._frame_time)
+            for detection in ranking:
+                if (detection['score'] >= self._minimum_score and
+                    detection['score'] >= self._relative_score *
+                    ranking[0]['score']):
+                    self._detect(detection, first, segment)
+
+            still_open = []
+            for occurrence in self._open:
+                if segment - occurrence['last_window'] >= self._max_gap:
+                    occurrences.append(self._close(occurrence))
+                else:
+                    still_open.append(occurrence)
+            self._open = still_open
+
+            self._segments.pop(segment - self._window_segments + 1, None)
+            self._next_segment = segment + 1
+
+        return occurrences
+
+    def _detect(self, detection, first, last):
+
+        offset_bin = detection['offset'] // self._delta_bin
+        for occurrence in self._open:
+            if (occurrence['track_id'] == detection['track_id'] and
+                abs(occurrence['bin'] - offset_bin) <= self._tolerance):
+                break
+        else:
+            occurrence = {'track_id': detection['track_id'],
+                'bin': offset_bin, 'matches': dict()}
+            self._open.append(occurrence)
+        occurrence['last_window'] = last
+
+        # Matches of each segment of the window around the occurrence offset
+        key = (detection['track_id'] << 32) + occurrence['bin'] + 2**31
+        for segment in range(first, last + 1):
+            if segment in self._segments:
+                keys, counts = self._segments[segment]
+                lower, upper = np.searchsorted(keys, [key - self._tolerance,
+                    key + self._tolerance + 1])
+                if upper > lower:
+                    occurrence['matches'][segment] = int(
+                        counts[lower:upper].sum())
+
+    def _close(self, occurrence):
+
+        segments = sorted(occurrence['matches'])
+        offset_time = occurrence['bin'] * self._delta_bin * self._frame_time
+        segment_time = self._segment_frames * self._frame_time
+
+        # The track cannot start before its own time 0
+        return {'track_id': occurrence['track_id'],
+            'start_time': max(segments[0] * segment_time, -offset_time, 0.0),
+            'end_time': min((segments[-1] + 1) * segment_time,
+                self.n_samples / self._sample_rate),
+            'score': sum(occurrence['matches'].values()),
+            'offset_time': offset_time}
+
+
+def monitor_file(index, audio_file, block_time = 10, **kwargs):
+
+    '''monitor_file: finds every occurrence of the tracks of the index in a
+    long audio file, which is read block by block.
+
+    Args:
+        index: FingerprintIndex of the tracks
+        audio_file: audio file in any format supported by soundfile
+        block_time: duration of the blocks read from the file [s]
+        kwargs: parameters of BroadcastMonitor
+
+    Returns:
+        A generator of the occurrences (see BroadcastMonitor.finish), in the
+        order in which they end.
+    '''
+
+    monitor = BroadcastMonitor(index, **kwargs)
+
+    for block in stream_audio_file(audio_file,
+        kwargs.get('sample_rate', 22050), block_time):
+        yield from monitor.feed(block)
+
+    yield from monitor.finish()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Find every occurrence of '
+        'the tracks of the database in a long recording.')
+    parser.add_argument('audio_file')
+    parser.add_argument('--output', default='-',
+        help='JSON lines output file (- for the standard output)')
+    parser.add_argument('--index',
+        default='../resources/database/fingerprints_index.bin')
+    parser.add_argument('--metadata',
+        default='../resources/database/metadata_db.csv')
+    parser.add_argument('--segment-time', type=float,
+        default=MONITOR_SEGMENT_TIME)
+    parser.add_argument('--window-segments', type=int,
+        default=MONITOR_WINDOW_SEGMENTS)
+    args = parser.parse_args()
+
+    index = FingerprintIndex.load(args.index)
+    if index.meta['hash'] != 'packed':
+        sys.exit('Monitoring needs a packed index: build it with '
+            'database.py --packed')
+    titles = load_titles(args.metadata)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    start = time.time()
+    n_occurrences = 0
+    for occurrence in monitor_file(index, args.audio_file,
+        segment_time=args.segment_time,
+        window_segments=args.window_segments):
+        occurrence['title'] = titles.get(occurrence['track_id'])
+        output.write(json.dumps(occurrence) + '\n')
+        output.flush()
+        n_occurrences += 1
+    end = time.time()
+
+    if output is not sys.stdout:
+        output.close()
+    print(f'Found {n_occurrences} occurrences in {end - start:.1f} s',
+        file=sys.stderr)
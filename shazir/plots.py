@@ -1,6 +1,14 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import librosa
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.scale import SymmetricalLogTransform
 from matplotlib.ticker import ScalarFormatter
 from matplotlib.ticker import MaxNLocator
 import matplotlib.pylab as pylab
@@ -13,8 +21,21 @@ params = {'legend.fontsize': 'x-large',
          'ytick.labelsize':'x-large'}
 pylab.rcParams.update(params)
 
+# Frequency of the note C2 (librosa.note_to_hz('C2')) [Hz]: defines the
+# range (-x, x) within which the frequency axis is linear
+LINEAR_THRESH = 65.40639132514966
+
+# Fast mode: maximum width of the figures [pixels], resolution and rows of
+# the spectrogram image
+MAX_WIDTH = 2000
+DPI = 100
+IMAGE_ROWS = 600
+
+DIAGNOSTICS_DIR = '../resources/diagnostics/'
 
-def plot_spectrogram(times, frequencies, amplitudes, dir_output, track_name = None):
+
+def plot_spectrogram(times, frequencies, amplitudes, dir_output,
+    track_name = None, fast = False, max_width = MAX_WIDTH):
 
     '''plot_spectrogram: plots the spectrogram.
 
@@ -23,16 +44,27 @@ def plot_spectrogram(times, frequencies, amplitudes, dir_output, track_name = No
         frequencies: array containing the frequency samples
         amplitudes: array containing the spectrogram amplitudes
             amplitudes.shape = (frequencies.shape, times.shape)
+        fast: if True, the figure is rendered headless with Agg, at most
+            max_width pixels wide, and the spectrogram is drawn as an image
+            of at most max_width columns (see _spectrogram_image) instead of
+            a mesh of all its points
+        max_width: maximum width of the figure in fast mode [pixels]
+
+    Returns:
+        The path of the exported figure.
     '''
-    width = int(0.1 * times[-1])
-    fig, ax = plt.subplots(figsize=(width,10))
-    out = ax.pcolormesh(times, frequencies, amplitudes, cmap='bone_r')
-    _ = ax.set_xlim(times.min(), times.max())
-    _ = ax.set_ylim(frequencies.min(), frequencies.max())
-    thresh = librosa.note_to_hz("C2")  # Defines the range (-x, x), 
-                                       # within which the plot is linear
-    ax.set_yscale('symlog', base=2, linthresh=thresh)
-    ax.yaxis.set_major_formatter(ScalarFormatter())
+
+    width = _figure_width(times, fast, max_width)
+    fig, ax = _subplots((width, 10), fast)
+    if fast:
+        out = _plot_spectrogram_image(ax, times, frequencies, amplitudes,
+            max_width)
+    else:
+        out = ax.pcolormesh(times, frequencies, amplitudes, cmap='bone_r')
+        _ = ax.set_xlim(times.min(), times.max())
+        _ = ax.set_ylim(frequencies.min(), frequencies.max())
+        ax.set_yscale('symlog', base=2, linthresh=LINEAR_THRESH)
+        ax.yaxis.set_major_formatter(ScalarFormatter())
     ax.yaxis.set_label_text("Frequency [Hz]")
     ax.xaxis.set_label_text("Time [s]")
 
@@ -43,17 +75,19 @@ def plot_spectrogram(times, frequencies, amplitudes, dir_output, track_name = No
         title = f'Spectrogram of {track_name}'
         export_name = dir_output + f'Spectrogram_{track_name}.jpg'
 
-    plt.title(title)  
+    ax.set_title(title)
 
     # fig.colorbar(out)
     cax = fig.add_axes([ax.get_position().x1 + 0.25 / width, ax.get_position().y0, 0.3 / width ,ax.get_position().height])
     fig.colorbar(out, cax=cax)
 
-    plt.savefig(export_name, bbox_inches='tight')
+    _save(fig, export_name, fast, bbox_inches='tight')
+
+    return export_name
+
 
-    
 def plot_peaks_constellation(frequencies, times, peaks_times, peaks_frequencies,
-    dir_output, track_name = None):
+    dir_output, track_name = None, fast = False, max_width = MAX_WIDTH):
 
     '''plot_peaks_constellation: plots the constallation map for the
     spectrogram peaks.
@@ -63,15 +97,17 @@ def plot_peaks_constellation(frequencies, times, peaks_times, peaks_frequencies,
         peaks_times: time values for the peaks
         peaks_frequencies: frequency values for the peaks
         track_name: name of the track (optional)
+        fast, max_width: see plot_spectrogram
+
+    Returns:
+        The path of the exported figure.
     '''
 
-    width = int(0.1 * times[-1])
-    fig, ax = plt.subplots(figsize=(width,10))
+    width = _figure_width(times, fast, max_width)
+    fig, ax = _subplots((width, 10), fast)
     out = ax.scatter(peaks_times, peaks_frequencies, marker='x', c='teal' ,s=20)
     ax.set_ylim(frequencies.min(), frequencies.max())
-    thresh = librosa.note_to_hz("C2")  # Defines the range (-x, x)
-                                       # within which the plot is linear
-    ax.set_yscale('symlog', base=2, linthresh=thresh)
+    ax.set_yscale('symlog', base=2, linthresh=LINEAR_THRESH)
     ax.yaxis.set_major_formatter(ScalarFormatter())
     ax.yaxis.set_label_text("Frequency [Hz]")
     ax.xaxis.set_label_text("Time [s]")
@@ -83,52 +119,65 @@ def plot_peaks_constellation(frequencies, times, peaks_times, peaks_frequencies,
         title = f'Constellation Map of {track_name}'
         export_name = dir_output + f'Constellation_{track_name}.jpg'
 
-    plt.title(title)
-    plt.savefig(export_name, bbox_inches='tight')
+    ax.set_title(title)
+    _save(fig, export_name, fast, bbox_inches='tight')
+
+    return export_name
 
 
 def plot_matching_hash_locations(fingerprints_track, fingerprints_recording,
-    dir_output, track_name = None):
+    dir_output, track_name = None, fast = False, frame_time = 512 / 22050):
 
     '''plot_matching_hash_locations: creates a scatterplot of the peaks
     time offsets with respect to the beginning of the audio, considering
     the track and the recording; additionally it creates a histogram with
     the differences of time offsets between the track and the recording.
+    The score is the highest bar of the histogram, computed once.
 
     Args:
-        fingerprints_track: dictionary containing the track fingerprints
+        fingerprints_track: dictionary containing the track fingerprints,
+            or tuple of packed hashes and offsets (see
+            make_packed_fingerprint)
         fingerprints_recording: dictionary containing the recording
-            fingerprints
+            fingerprints, or tuple of packed hashes and offsets
+        fast: see plot_spectrogram
+        frame_time: duration of a frame [s], to convert the offsets of
+            packed fingerprints
+
+    Returns:
+        The paths of the exported figures.
     '''
 
     def _plot_hash_locations(matching_times_track, matching_times_recording, score):
-    
-        fig, ax = plt.subplots(figsize=(20,10))
 
-        ax.scatter(matching_times_track, matching_times_recording, s=100, 
-            facecolors="None", edgecolor='teal')  
+        fig, ax = _subplots((20, 10), fast)
+
+        ax.scatter(matching_times_track, matching_times_recording, s=100,
+            facecolors="None", edgecolor='teal')
 
-        plt.xlabel('Track time [s]')
-        plt.ylabel('Sample time [s]')
-        plt.grid()
+        ax.set_xlabel('Track time [s]')
+        ax.set_ylabel('Sample time [s]')
+        ax.grid()
 
         if track_name is None:
             title = f'Scatterplot of matching hash locations (score: {score})'
             export_name = dir_output + 'Matching_hash_locations.jpg'
         else:
-            title = f'Scatterplot of matching hash locations of {track_name} (score: {score})' 
+            title = f'Scatterplot of matching hash locations of {track_name} (score: {score})'
             export_name = dir_output + f'Matching_hash_locations_{track_name}.jpg'
 
-        plt.title(title)
-        plt.savefig(export_name)
-    
-    def _plot_histogram_time_offsets_differences(time_offset_differences, score):
+        ax.set_title(title)
+        _save(fig, export_name, fast)
 
-        fig, ax = plt.subplots(figsize=(20,10))
+        return export_name
 
-        plt.hist(time_offset_differences, facecolor='teal', edgecolor='#e0e0e0', linewidth=0.5, alpha=0.7)
+    def _plot_histogram_time_offsets_differences(counts, edges, score):
+
+        fig, ax = _subplots((20, 10), fast)
+
+        # The histogram of the score, drawn from its counts
+        ax.hist(edges[:-1], edges, weights=counts, facecolor='teal', edgecolor='#e0e0e0', linewidth=0.5, alpha=0.7)
 
-        # plt.hist(time_offset_differences)
         ax.yaxis.set_major_locator(MaxNLocator(integer=True))
 
         if track_name is None:
@@ -137,18 +186,199 @@ def plot_matching_hash_locations(fingerprints_track, fingerprints_recording,
         else:
             title = f'Histogram of differences of time offsets of {track_name} (score = {score})'
             export_name = dir_output + f'Histogram_time_offsets_differences_{track_name}.jpg'
-        
-        plt.xlabel('(Track time - Sample time) [s]')
-        plt.title(title)
-        plt.savefig(export_name)
 
-    matches = []
+        ax.set_xlabel('(Track time - Sample time) [s]')
+        ax.set_title(title)
+        _save(fig, export_name, fast)
+
+        return export_name
+
+    matching_times_track, matching_times_recording = _matching_hash_times(
+        fingerprints_track, fingerprints_recording, frame_time)
+
+    counts, edges = np.histogram(matching_times_track -
+        matching_times_recording, bins='auto')
+    score = int(counts.max())
+
+    return [_plot_hash_locations(matching_times_track,
+        matching_times_recording, score),
+        _plot_histogram_time_offsets_differences(counts, edges, score)]
+
+
+def plot_report(audio_file, dir_output = DIAGNOSTICS_DIR, track_file = None,
+    max_width = MAX_WIDTH):
+
+    '''plot_report: renders the diagnostics of an audio file in fast mode:
+    its spectrogram and peaks constellation and, if track_file is given,
+    the matching hash locations and the histogram of the differences of time
+    offsets with the track (packed fingerprints). The file is decoded once
+    and its hashes are made from the peaks of the constellation.
 
-    [matches.append([fingerprints_track[k], fingerprints_recording[k],fingerprints_track[k] -
-        fingerprints_recording[k]]) if k in fingerprints_track else None
-        for k in fingerprints_recording.keys()]   
+    Args:
+        audio_file: audio file in .wav, e.g. a query
+        dir_output: folder of the figures, ending with a separator
+        track_file: optional audio file of the track to match the audio with
+        max_width: see plot_spectrogram
+
+    Returns:
+        The paths of the exported figures.
+    '''
+
+    from fingerprints import PAIRING, make_packed_fingerprint, \
+        make_packed_hashes, make_peaks_constellation
+    from preprocess import load_audio, process_audio_file
+
+    audio = load_audio(audio_file)
+    track_name = os.path.basename(audio_file)
+    times, frequencies, amplitudes = process_audio_file(audio)
+    peaks_times, peaks_frequencies = make_peaks_constellation(times,
+        frequencies, amplitudes)
+
+    export_names = [plot_spectrogram(times, frequencies, amplitudes,
+        dir_output, track_name, fast=True, max_width=max_width),
+        plot_peaks_constellation(frequencies, times, peaks_times,
+        peaks_frequencies, dir_output, track_name, fast=True,
+        max_width=max_width)]
+    del amplitudes
+
+    if track_file is not None:
+        # Same pairing as make_packed_fingerprint, used for the track
+        fingerprints = make_packed_hashes(peaks_times, peaks_frequencies,
+            times, frequencies, *PAIRING)
+        export_names += plot_matching_hash_locations(
+            make_packed_fingerprint(track_file), fingerprints, dir_output,
+            f'{os.path.basename(track_file)}_{track_name}', fast=True,
+            frame_time=times[1] - times[0])
+
+    return export_names
+
+
+def plot_reports(audio_files, dir_output = DIAGNOSTICS_DIR, track_file = None,
+    workers = 1, max_width = MAX_WIDTH):
+
+    '''plot_reports: renders the diagnostics of many audio files (see
+    plot_report), in a pool of processes if workers is greater than one.
+
+    Returns:
+        A list with the paths of the exported figures of each file.
+    '''
+
+    os.makedirs(dir_output, exist_ok=True)
+    report = partial(plot_report, dir_output=dir_output,
+        track_file=track_file, max_width=max_width)
+
+    if workers <= 1:
+        return [report(audio_file) for audio_file in audio_files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(report, audio_files))
+
+
+def _subplots(figsize, fast):
+
+    # In fast mode the figure is not registered with pyplot: it is drawn by
+    # an Agg canvas, needs no display and is freed once saved
+    if not fast:
+        return plt.subplots(figsize=figsize)
+    fig = Figure(figsize=figsize, dpi=DPI)
+    FigureCanvasAgg(fig)
 
-    score = max(np.histogram([m[2] for m in matches], bins='auto')[0])
+    return fig, fig.add_subplot()
 
-    _plot_hash_locations([m[0] for m in matches],[m[1] for m in matches], score)
-    _plot_histogram_time_offsets_differences([m[2] for m in matches], score)
+
+def _save(fig, export_name, fast, **kwargs):
+
+    fig.savefig(export_name, **kwargs)
+    if not fast:
+        plt.close(fig)
+
+
+def _figure_width(times, fast, max_width):
+
+    # Width of the figures of a track [in]: 0.1 per second, at least 8 in
+    # fast mode and at most max_width pixels
+    width = int(0.1 * times[-1])
+    if fast:
+        width = min(max(width, 8), max_width / DPI)
+
+    return width
+
+
+def _plot_spectrogram_image(ax, times, frequencies, amplitudes, max_width):
+
+    # The spectrogram is reduced to at most max_width columns and to
+    # IMAGE_ROWS rows evenly spaced on the symlog frequency axis, each pixel
+    # keeping the maximum of the points it covers, so that the peaks stay
+    # visible; the image is drawn on a linear axis in symlog units, with the
+    # ticks of the powers of two labelled in Hz
+    amplitudes = np.asarray(amplitudes, dtype=np.float32)
+    columns = np.linspace(0, amplitudes.shape[1], min(max_width,
+        amplitudes.shape[1]) + 1).astype(np.intp)[:-1]
+    image = np.maximum.reduceat(amplitudes, columns, axis=1)
+
+    transform = SymmetricalLogTransform(2, LINEAR_THRESH, 1)
+    low, high = transform.transform(np.array([frequencies[0],
+        frequencies[-1]]))
+    edges = transform.inverted().transform(np.linspace(low, high,
+        IMAGE_ROWS + 1))
+    rows = np.clip(np.searchsorted(frequencies, edges[:-1], side='right') -
+        1, 0, len(frequencies) - 1)
+    image = np.maximum.reduceat(image, rows, axis=0)
+
+    out = ax.imshow(image, cmap='bone_r', aspect='auto', origin='lower',
+        interpolation='nearest', extent=(times[0], times[-1], low, high))
+    ticks = np.r_[0, 2.0 ** np.arange(np.ceil(np.log2(LINEAR_THRESH)),
+        np.floor(np.log2(frequencies[-1])) + 1)]
+    ax.set_yticks(transform.transform(ticks), [f'{tick:g}' for tick in ticks])
+
+    return out
+
+
+def _matching_hash_times(fingerprints_track, fingerprints_recording,
+    frame_time):
+
+    # Times [s] in the track and in the recording of the hashes they share.
+    # The dictionaries of make_fingerprint are intersected as sets of keys;
+    # in the packed fingerprints a hash can occur several times, and every
+    # pair of occurrences is a match: the recording hashes are looked up in
+    # the sorted track hashes
+    if isinstance(fingerprints_track, dict):
+        common = list(fingerprints_recording.keys() &
+            fingerprints_track.keys())
+        return np.array(list(map(fingerprints_track.__getitem__, common)),
+            dtype=float), np.array(list(map(
+            fingerprints_recording.__getitem__, common)), dtype=float)
+
+    hashes_track, offsets_track = fingerprints_track
+    hashes_recording, offsets_recording = fingerprints_recording
+    order = np.argsort(hashes_track, kind='stable')
+    sorted_hashes = np.asarray(hashes_track)[order]
+    first = np.searchsorted(sorted_hashes, hashes_recording, side='left')
+    n_matches = np.searchsorted(sorted_hashes, hashes_recording,
+        side='right') - first
+    starts = np.cumsum(n_matches) - n_matches
+    matches = order[np.repeat(first - starts, n_matches) +
+        np.arange(n_matches.sum())]
+
+    return np.asarray(offsets_track)[matches] * frame_time, np.repeat(
+        np.asarray(offsets_recording), n_matches) * frame_time
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render the diagnostics '
+        'figures of audio files headless: spectrogram, peaks constellation '
+        'and matching hashes with a track.')
+    parser.add_argument('audio_files', nargs='+')
+    parser.add_argument('--track', help='track to match the files with')
+    parser.add_argument('--output', default=DIAGNOSTICS_DIR,
+        help='folder of the figures')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-width', type=int, default=MAX_WIDTH,
+        help='maximum width of the figures [pixels]')
+    args = parser.parse_args()
+
+    matplotlib.use('Agg')
+    reports = plot_reports(args.audio_files, os.path.join(args.output, ''),
+        args.track, args.workers, args.max_width)
+    for audio_file, export_names in zip(args.audio_files, reports):
+        print(f'{audio_file}: {", ".join(export_names)}')
@@ -1,8 +1,20 @@
-# import time
+import logging
 import os
-import librosa
+from math import gcd
 import numpy as np
-import librosa.display
+import soundfile as sf
+
+from instrumentation import count, stage, timed
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+
+DECODER = 'soundfile'
+BLOCK_FRAMES = 1024
+
+logger = logging.getLogger(__name__)
 
 
 def convert_mp3_to_wav():
@@ -17,17 +29,22 @@ def convert_mp3_to_wav():
     os.chdir('../../../shazir')
     
 
-def process_audio_file(audio_file, frame_size=2048, hop_size=512):
+def process_audio_file(audio_file, frame_size=2048, hop_size=512,
+    decoder=DECODER):
 
-    '''process_audio_file: takes a .wav audio file and returns the
-    values defining its spectrogram, calculated using the librosa library.
+    '''process_audio_file: takes a .wav audio file, or a signal already in
+    memory, and returns the values defining its spectrogram, the same as
+    calculated using the librosa library (see _stft).
 
     Args:
-        audio_file: audio track in .wav format
+        audio_file: audio track in .wav format (path or file object), or a
+            tuple of its samples and sample rate (see load_audio)
         frame_size: number of samples in the time frame - should be a
             power of two
         hop_size: number of time samples in between successive frames - should
             be a power of two
+        decoder: how the audio file is decoded and resampled (see
+            load_audio)
     
     Returns:
         A tuple consisting of an array of time samples [s], an array of the
@@ -35,18 +52,290 @@ def process_audio_file(audio_file, frame_size=2048, hop_size=512):
         normalized in [0,1].
     '''
 
-    print(f'Processing track: {audio_file}')
-    # start = time.time()
-    audio_signal, sample_rate = librosa.load(audio_file)
-    audio_stft = librosa.stft(audio_signal, n_fft=frame_size,
-        hop_length=hop_size)  # Short-Time Fourier-Transform
-    amp = np.abs(audio_stft)**2
-    amp_log = librosa.power_to_db(amp)  # Decibel
-    amp_log_norm = amp_log / amp_log.max()
-    times = librosa.frames_to_time(np.arange(amp_log.shape[1]),
-        sr=sample_rate, hop_length=hop_size)
-    frequencies = librosa.fft_frequencies(sr=sample_rate, n_fft=frame_size)
-    # end = time.time()
-    # print(f'process_audio_file took {end - start} s')
-
-    return times, frequencies, amp_log_norm
+    logger.info('Processing track: %s', _audio_name(audio_file))
+    audio_signal, sample_rate = load_audio(audio_file, decoder=decoder)
+    with stage('stft'):
+        audio_stft = _stft(audio_signal, frame_size,
+            hop_size)  # Short-Time Fourier-Transform
+        # The signal is float32, so is the whole chain: the power, the
+        # decibels and the normalization are computed in place
+        amp_log = np.abs(audio_stft)
+        del audio_stft
+        _power_to_db(amp_log)
+        np.maximum(amp_log, amp_log.max() - 80, out=amp_log)
+        amp_log /= amp_log.max()
+    times = np.arange(amp_log.shape[1]) * hop_size / float(sample_rate)
+    frequencies = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+
+    return times, frequencies, amp_log
+
+
+def process_audio_blocks(audio_file, frame_size = 2048, hop_size = 512,
+    decoder = DECODER, block_frames = BLOCK_FRAMES):
+
+    '''process_audio_blocks: same as process_audio_file, but the spectrogram
+    is computed block by block, so that only a block of frames is in memory
+    at a time, besides the signal. The normalization needs the maximum of
+    the whole spectrogram: a first pass computes it and a second pass
+    computes the blocks again and normalizes them, giving the same values
+    as process_audio_file. Consecutive blocks overlap by two frames, so that
+    every frame but the first and the last one is inside a block together
+    with its two neighbours.
+
+    Args:
+        audio_file, frame_size, hop_size, decoder: see process_audio_file
+        block_frames: number of new frames in each block
+
+    Returns:
+        A tuple consisting of an array of time samples [s], an array of the
+        frequency samples [Hz] and a generator of the blocks, as tuples of
+        the index of their first frame and of a 2D array of the amplitudes
+        of their frames, normalized as in process_audio_file.
+    '''
+
+    logger.info('Processing track: %s', _audio_name(audio_file))
+    audio_signal, sample_rate = load_audio(audio_file, decoder=decoder)
+    frames, window = _frames(audio_signal, frame_size, hop_size)
+
+    max_db = None
+    for start in range(0, len(frames), block_frames):
+        with stage('stft'):
+            block_max = _power_to_db(np.abs(_stft_block(frames[start:start +
+                block_frames], window))).max()
+        max_db = block_max if max_db is None else max(max_db, block_max)
+
+    def blocks():
+        for start in range(0, len(frames), block_frames):
+            first = max(0, start - 1)
+            with stage('stft'):
+                amp_log = np.abs(_stft_block(frames[first:start +
+                    block_frames + 1], window))
+                _power_to_db(amp_log)
+                np.maximum(amp_log, max_db - 80, out=amp_log)
+                amp_log /= max_db
+            yield first, amp_log
+
+    times = np.arange(len(frames)) * hop_size / float(sample_rate)
+    frequencies = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+
+    return times, frequencies, blocks()
+
+
+@timed('decode')
+def load_audio(audio_file, sample_rate = 22050, decoder = DECODER):
+
+    '''load_audio: decodes an audio file into a mono float32 signal at
+    sample_rate. The audio can also be a signal already in memory, given as
+    a tuple of its samples and its sample rate [Hz]: the samples are a NumPy
+    array, mono or with the channels as columns, or any object exposing the
+    buffer protocol (bytes, memoryview, array.array, ...), whose raw bytes
+    are read as float32 samples; integer samples are PCM, scaled to [-1, 1)
+    as when reading a file. A mono float32 signal at sample_rate is
+    returned as it is, without copies; otherwise it is converted, mixed down
+    and resampled as a decoded file.
+
+    Args:
+        audio_file: audio file (path or file object), or tuple of samples
+            and sample rate
+        sample_rate: sample rate of the returned signal [Hz]
+        decoder: 'soundfile' reads the file directly as float32, mixing it
+            down block by block by adding up the channels, and resamples it,
+            only if its rate differs from sample_rate, with soxr (or a
+            polyphase filter if soxr is not installed); 'librosa' uses
+            librosa.load, which is also used for the formats that soundfile
+            cannot read; for a signal in memory, only the resampling
+            applies
+
+    Returns:
+        A tuple consisting of the array of samples and the sample rate [Hz].
+    '''
+
+    if isinstance(audio_file, tuple):
+        samples, file_rate = audio_file
+        audio_signal = _as_signal(samples)
+        decoder = 'soundfile'
+    elif decoder == 'soundfile':
+        try:
+            audio_signal, file_rate = _read_mono(audio_file)
+        except RuntimeError:  # Format not supported by libsndfile
+            decoder = 'librosa'
+    if decoder == 'librosa':
+        import librosa  # Slow to import
+        audio_signal, sample_rate = librosa.load(audio_file, sr=sample_rate)
+        count('samples_decoded', len(audio_signal))
+        return audio_signal, sample_rate
+    elif decoder != 'soundfile':
+        raise ValueError(f'Unknown decoder: {decoder}')
+
+    if file_rate != sample_rate:
+        if soxr is not None:
+            audio_signal = soxr.resample(audio_signal, file_rate, sample_rate,
+                quality='HQ')
+        else:
+            from scipy.signal import resample_poly  # Slow to import
+            common = gcd(sample_rate, file_rate)
+            audio_signal = resample_poly(audio_signal, sample_rate // common,
+                file_rate // common).astype(np.float32, copy=False)
+    count('samples_decoded', len(audio_signal))
+
+    return audio_signal, sample_rate
+
+
+def _stft(audio_signal, frame_size, hop_size, block_frames = 256):
+
+    # Same as librosa.stft with its defaults, bit for bit (centred frames
+    # padded with zeros, periodic Hann window computed as scipy does, float64
+    # products and FFT, complex64 result), without the import of librosa,
+    # scipy and numba; the frames are windowed in blocks, so that only the
+    # result is allocated in full
+    frames, window = _frames(audio_signal, frame_size, hop_size)
+
+    audio_stft = np.empty((frame_size // 2 + 1, len(frames)),
+        dtype=np.complex64)
+    for start in range(0, len(frames), block_frames):
+        audio_stft[:, start:start + block_frames] = _stft_block(
+            frames[start:start + block_frames], window)
+
+    return audio_stft
+
+
+def _frames(audio_signal, frame_size, hop_size):
+
+    # Centred frames, as a view of the signal padded with zeros, and the
+    # periodic Hann window; librosa pads with zeros by default since 0.10
+    # (pad_mode='constant'), 0.8 reflected the signal instead
+    window = (0.5 + 0.5 * np.cos(np.linspace(-np.pi, np.pi,
+        frame_size + 1)))[:-1]
+    padded = np.pad(audio_signal, frame_size // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded,
+        frame_size)[::hop_size]
+
+    return frames, window
+
+
+def _stft_block(frames, window):
+
+    # Frequency bins by frames, complex64 as librosa.stft
+    return np.ascontiguousarray(np.fft.rfft(window * frames, axis=1).T,
+        dtype=np.complex64)
+
+
+def _power_to_db(amplitudes):
+
+    # Decibels of the magnitudes, in place, as librosa.power_to_db
+    np.square(amplitudes, out=amplitudes)
+    np.maximum(amplitudes, 1e-10, out=amplitudes)
+    np.log10(amplitudes, out=amplitudes)
+    amplitudes *= 10
+
+    return amplitudes
+
+
+def _as_signal(samples):
+
+    # Bytes-like buffers hold raw float32 samples, the other ones (and the
+    # arrays) have their own format; only a conversion or a mix down copies
+    if not isinstance(samples, np.ndarray):
+        view = memoryview(samples)
+        if view.format in ('B', 'b', 'c'):
+            samples = np.frombuffer(view, dtype=np.float32)
+        else:
+            samples = np.asarray(view)
+    if np.issubdtype(samples.dtype, np.integer):
+        # Integer PCM is scaled to [-1, 1) as soundfile reads it, i.e. by
+        # half the range of the type (unsigned samples are centred first)
+        info = np.iinfo(samples.dtype)
+        half = (int(info.max) - int(info.min) + 1) // 2
+        samples = samples.astype(np.float32)
+        if info.min == 0:
+            samples -= half
+        samples *= np.float32(1 / half)
+    samples = samples.astype(np.float32, copy=False)
+    if samples.ndim == 2:
+        samples = _mix_down(samples)
+
+    return samples
+
+
+def _audio_name(audio_file):
+
+    if isinstance(audio_file, tuple):
+        return f'signal in memory at {audio_file[1]} Hz'
+    return audio_file
+
+
+def _read_mono(audio_file, block_size = 1 << 18):
+
+    # The file is read and mixed down block by block into the mono signal,
+    # so that all its channels are never in memory at once
+    with sf.SoundFile(audio_file) as file:
+        audio_signal = np.empty(file.frames, dtype=np.float32)
+        position = 0
+        for block in file.blocks(block_size, dtype='float32',
+            always_2d=True):
+            audio_signal[position:position + len(block)] = _mix_down(block)
+            position += len(block)
+
+        return audio_signal[:position], file.samplerate
+
+
+def _mix_down(audio_signal):
+
+    # Adding up the channel columns is much faster than mean(axis=1) on the
+    # interleaved samples
+    if audio_signal.shape[1] == 1:
+        return audio_signal[:, 0]
+    mono = audio_signal[:, 0].copy()
+    for channel in range(1, audio_signal.shape[1]):
+        mono += audio_signal[:, channel]
+    mono *= 1 / audio_signal.shape[1]
+
+    return mono
+
+
+def stream_audio_file(audio_file, sample_rate = 22050, block_time = 10):
+
+    '''stream_audio_file: reads a long audio file block by block, so that it
+    never has to fit in memory. The blocks are mixed down to mono and
+    resampled to sample_rate with a polyphase filter; each block is filtered
+    together with some samples of its neighbours, so the result is the same
+    as resampling the whole signal at once.
+
+    Args:
+        audio_file: audio file in any format supported by soundfile
+        sample_rate: sample rate of the returned blocks [Hz]
+        block_time: duration of the blocks [s]
+
+    Returns:
+        A generator of float32 arrays of mono samples.
+    '''
+
+    from scipy.signal import resample_poly  # Slow to import
+
+    with sf.SoundFile(audio_file) as file:
+        common = gcd(sample_rate, file.samplerate)
+        up, down = sample_rate // common, file.samplerate // common
+        # Blocks and context are multiples of down, so that every block
+        # starts on an output sample; the context covers the half length of
+        # the resample_poly filter, 10 * max(up, down) upsampled samples
+        block_size = max(1, int(block_time * file.samplerate) // down) * down
+        context = down * -(-(10 * max(up, down) // up + 1) // down)
+
+        def read():
+            return _mix_down(file.read(block_size, dtype='float32',
+                always_2d=True))
+
+        previous = np.empty(0, dtype=np.float32)
+        current = read()
+        while len(current) > 0:
+            following = read()
+            if up == down:
+                yield current
+            else:
+                left = previous[len(previous) - context:]
+                resampled = resample_poly(np.concatenate((left, current,
+                    following[:context])), up, down)
+                start = len(left) * up // down
+                yield resampled[start:start - (-len(current) * up //
+                    down)].astype(np.float32)
+            previous, current = current, following
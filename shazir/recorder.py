@@ -1,25 +1,70 @@
 import numpy as np
-import librosa
 import soundfile as sf
-import pyaudio
-import tkinter
-import tkinter as tk
-import tkinter.messagebox
 import time
-from tkinter import messagebox
+
+# pyaudio and tkinter are imported when recording, so that the buffer and
+# the callback can be used without them
+PA_FLOAT32 = 1  # pyaudio.paFloat32
+PA_CONTINUE = 0  # pyaudio.paContinue
+
+
+class SampleBuffer():
+
+    '''SampleBuffer: preallocated buffer of audio samples with amortized O(1)
+    append. When the capacity is exceeded it is doubled, so a recording of n
+    samples is copied O(log n) times instead of at every append; view returns
+    the samples captured so far without copying them.
+    '''
+
+    def __init__(self, capacity = 22050 * 60, dtype = np.float32):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def append(self, samples):
+        end = self._size + len(samples)
+        if end > len(self._data):
+            grown = np.empty(max(end, 2 * len(self._data)),
+                dtype=self._data.dtype)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size:end] = samples
+        # The size is updated after the samples are written, so a view taken
+        # by another thread only contains complete samples
+        self._size = end
+
+    def view(self):
+        size = self._size
+        return self._data[:size]
+
+    def __len__(self):
+        return self._size
+
 
 class Recorder():
     
-    def __init__(self, format_audio = pyaudio.paFloat32, channels = 1,
-                 rate = 22050, frames = 2048):
+    def __init__(self, format_audio = PA_FLOAT32, channels = 1,
+                 rate = 22050, frames = 2048, recognizer = None,
+                 poll_interval = 200, capacity_seconds = 60):
         self._format = format_audio
         self._channels = channels
         self._rate = rate
         self._frames = frames
         self._audio = None
         self._stream = None
+        self._buffer = SampleBuffer(capacity_seconds * rate * channels)
+        # Optional StreamingRecognizer, fed every poll_interval ms from the
+        # Tkinter loop: the recording stops as soon as it finds a match
+        self._recognizer = recognizer
+        self._poll_interval = poll_interval
+        self._fed = 0
         
-    def record(self, name = 'recording.wav'):
+    def record(self, name = None):
+        # The recording is kept in memory as (samples, rate), to be
+        # fingerprinted directly; it is also written to the file name, if
+        # given
+        import tkinter
+        import tkinter as tk
+        from tkinter import messagebox
         # Start Tkinter and set Title
         self.main = tkinter.Tk()
         self.collections = []
@@ -48,14 +93,17 @@ class Recorder():
 
         tkinter.mainloop()
         
-        try:
-            sf.write(name, self._full_data, self._rate)
-            self.recording = 'recording.wav'
-        except:
+        if len(self._buffer) > 0:
+            self.recording = (self.get_recording().reshape(-1,
+                self._channels), self._rate)
+            if name is not None:
+                sf.write(name, self.recording[0], self._rate)
+        else:
             print("Quitting shazir...")
         
         
     def start(self):
+        import pyaudio
         self.start_rec.configure(bg='red', text='Recording...',
             state='disabled')
         self._audio = pyaudio.PyAudio()
@@ -66,24 +114,30 @@ class Recorder():
                                       output=False,
                                       stream_callback=self.callback,
                                       frames_per_buffer=self._frames)
+        self.stop_rec.configure(state='active')
+        if self._recognizer is not None:
+            self.main.after(self._poll_interval, self.feed_recognizer)
     
+    def feed_recognizer(self):
+        new_data = self._buffer.view()[self._fed:]
+        self._fed += len(new_data)
+        if self._recognizer.feed(new_data):
+            self.stop()
+        else:
+            self.main.after(self._poll_interval, self.feed_recognizer)
+
     def stop(self):
         self._stream.close()
         self._audio.terminate()
         self.main.destroy()
     
     def callback(self, in_data, frame_count, time_info, flag):
-        self.stop_rec.configure(state='active')
-        numpy_array = np.frombuffer(in_data, dtype=np.float32)
-        librosa.feature.mfcc(numpy_array)
-        try:
-            self._full_data = np.append(self._full_data, numpy_array)
-        except:
-            self._full_data = numpy_array
-        return None, pyaudio.paContinue        
+        # Runs in the audio thread: only copy the samples in the buffer
+        self._buffer.append(np.frombuffer(in_data, dtype=np.float32))
+        return None, PA_CONTINUE
 
     def get_rate(self):
         return self._rate
     
     def get_recording(self):
-        return self._full_data
+        return self._buffer.view()
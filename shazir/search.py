@@ -1,41 +1,303 @@
+import csv
+
 import numpy as np
 
+from index import FingerprintIndex, legacy_fingerprints_to_arrays
+from instrumentation import count, stage, timed
+
 MINIMUM_SCORE = 20
+TOP_K = 5
+DELTA_BIN = 2  # Width of the bins of the time offsets differences [frames]
+LEGACY_DELTA_BIN = 8  # Same, for the indexes converted from .json
+MAX_POSTINGS = 1000  # Hashes with more postings are skipped
+CANDIDATES = 50  # Tracks with the most hits scored by time offsets
 
-def searching_matching_track(fingerprints_dict, metadata_db, fingerprints_recording):
+def searching_matching_track(fingerprints_dict, metadata_db,
+    fingerprints_recording, top_k = TOP_K, max_postings = MAX_POSTINGS,
+    candidates = CANDIDATES):
 
     '''searching_matching_track: finds all matching hashes between the 
     recording and the tracks in the database and computes the score for
     each track, thus identifying if there is a match.
     
     Args:
-        hash_database: 
-        metadata_db: 
-        fingerprints_recording:
+        fingerprints_dict: dictionary of dictionaries of the tracks
+            fingerprints, or a FingerprintIndex
+        metadata_db: pandas DataFrame with the tracks metadata, or dictionary
+            of the titles by track id (see load_titles)
+        fingerprints_recording: dictionary of the recording fingerprints, as
+            returned by make_fingerprint, or tuple of hashes and offsets, as
+            returned by make_packed_fingerprint
+        top_k: number of tracks in the ranking
+        max_postings, candidates: see score_tracks
+
+    Returns:
+        The ranking of the top_k tracks by score (see score_tracks).
     '''
-    
+
+    if isinstance(fingerprints_dict, FingerprintIndex):
+        hashes, offsets = _recording_arrays(fingerprints_dict,
+            fingerprints_recording)
+        ranking = score_tracks(fingerprints_dict, hashes, offsets, top_k,
+            max_postings=max_postings, candidates=candidates)
+    else:
+        ranking = _score_tracks_dict(fingerprints_dict,
+            fingerprints_recording, top_k, max_postings, candidates)
+
+    print_best_match(ranking, metadata_db)
+
+    return ranking
+
+
+def print_best_match(ranking, metadata_db):
+
+    '''print_best_match: prints the title of the best track of the ranking,
+    if its score is high enough.
+
+    Args:
+        ranking: ranking of the tracks (see score_tracks)
+        metadata_db: pandas DataFrame with the tracks metadata, or dictionary
+            of the titles by track id (see load_titles)
+    '''
+
+    if len(ranking) == 0 or ranking[0]['score'] < MINIMUM_SCORE:
+        print('Scores are too low :( Try again, perhaps with a longer recording!')
+    elif isinstance(metadata_db, dict):
+        title = metadata_db.get(int(ranking[0]['track_id']))
+        print(f'The best match is {title} (score = {ranking[0]["score"]})')
+    else:
+        title = metadata_db.loc[int(ranking[0]['track_id'])]['title']
+        print(f'The best match is {title} (score = {ranking[0]["score"]})')
+
+
+def load_titles(metadata_file):
+
+    '''load_titles: reads the titles of the tracks from the metadata .csv
+    file, without pandas, which is slow to import.
+
+    Args:
+        metadata_file: path of the metadata .csv file
+
+    Returns:
+        A dictionary with the track ids as keys and the titles as values.
+    '''
+
+    with open(metadata_file, newline='') as file:
+        return {int(row['track_id']): row['title']
+            for row in csv.DictReader(file)}
+
+
+def score_tracks(index, hashes, offsets, top_k = TOP_K, delta_bin = None,
+    max_postings = MAX_POSTINGS, candidates = CANDIDATES):
+
+    '''score_tracks: scores all the tracks of the index at once. The
+    postings of all the recording hashes are gathered as arrays and the
+    differences of time offsets between track and recording are quantized
+    in bins of delta_bin frames; the score of a track is the highest number
+    of matches falling in the same bin, found by counting the unique joint
+    (track_id, bin) keys. The hashes with more than max_postings postings
+    are skipped and only the tracks with the most matching hashes, as many
+    as candidates, are scored, which bounds the cost of a query whatever its
+    hashes.
+
+    The score counts the matches of a single bin, so it grows with the
+    width of the bins. The offsets of a legacy index are converted from
+    seconds and spread over more frames than those of a packed one: they
+    are binned with LEGACY_DELTA_BIN, so that the matching tracks score
+    above MINIMUM_SCORE as with a packed index (with DELTA_BIN many fell
+    below it). The scores differ from those of the histogram of each track
+    computed for a .json database.
+
+    Args:
+        index: FingerprintIndex of the tracks
+        hashes: array of the recording hashes
+        offsets: array of the recording time offsets [frames]
+        top_k: number of tracks in the ranking
+        delta_bin: width of the bins of the time offsets differences
+            [frames] (None for DELTA_BIN, or LEGACY_DELTA_BIN for a legacy
+            index)
+        max_postings: maximum number of postings of a hash (None for no
+            limit)
+        candidates: number of tracks scored (None for all)
+
+    Returns:
+        A list of at most top_k dictionaries, sorted by decreasing score,
+        with the track_id, the score, and the estimated offset of the
+        recording in the track, in frames (offset) and seconds (offset_time).
+    '''
+
+    if delta_bin is None:
+        delta_bin = (LEGACY_DELTA_BIN if index.meta['hash'] == 'legacy'
+            else DELTA_BIN)
+
+    keys, counts = joint_counts(index, hashes, offsets, delta_bin,
+        max_postings, candidates)
+
+    return rank_joint_counts(keys, counts, top_k, delta_bin,
+        index.meta.get('hop_size', 512) / index.meta.get('sample_rate', 22050))
+
+
+def joint_counts(index, hashes, offsets, delta_bin = DELTA_BIN,
+    max_postings = None, candidates = None):
+
+    '''joint_counts: counts the matches between the recording and the
+    tracks of the index for each (track_id, bin of the time offsets
+    differences) pair.
+
+    Args:
+        index: FingerprintIndex of the tracks
+        hashes: array of the recording hashes
+        offsets: array of the recording time offsets [frames]
+        delta_bin: width of the bins of the time offsets differences [frames]
+        max_postings: maximum number of postings of a hash (None for no
+            limit)
+        candidates: if given, only the pairs of the tracks with the most
+            matching hashes, exactly as many as candidates (the ties at the
+            last place are broken arbitrarily), are counted; since the
+            matching hashes are an upper bound of the score, the other
+            tracks would rarely rank first. The counts of several recordings
+            are then no longer additive
+
+    Returns:
+        A tuple consisting of the sorted array of the unique joint keys, with
+        the track id in the high 32 bits and the bin (shifted by 2**31) in
+        the low 32 bits, and the array of their counts.
+    '''
+
+    count('hashes_looked_up', len(hashes))
+    query_positions, track_ids, track_offsets = index.lookup(hashes,
+        max_postings)
+
+    with stage('count'):
+        if candidates is not None and len(track_ids) > 0:
+            # First pass: the number of matching hashes of each track
+            hits = np.bincount(track_ids)
+            if np.count_nonzero(hits) > candidates:
+                # Exactly candidates tracks, even if many have as many hits
+                # as the last one, so that the cost stays bounded
+                selected = np.zeros(len(hits), dtype=bool)
+                selected[np.argpartition(-hits, candidates)[:candidates]] = \
+                    True
+                keep = selected[track_ids]
+                query_positions, track_ids, track_offsets = (
+                    query_positions[keep], track_ids[keep],
+                    track_offsets[keep])
+
+        deltas = (track_offsets.astype(np.int64) -
+            np.asarray(offsets, dtype=np.int64)[query_positions])
+        bins = np.floor_divide(deltas, delta_bin)
+
+        return np.unique((track_ids.astype(np.int64) << 32) + (bins + 2**31),
+            return_counts=True)
+
+
+def merge_joint_counts(keys, counts, new_keys, new_counts):
+
+    '''merge_joint_counts: adds up two sets of joint counts, as returned
+    by joint_counts.
+    '''
+
+    keys, inverse = np.unique(np.concatenate((keys, new_keys)),
+        return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate((counts,
+        new_counts)), minlength=len(keys)).astype(np.int64)
+
+    return keys, counts
+
+
+@timed('rank')
+def rank_joint_counts(keys, counts, top_k = TOP_K, delta_bin = DELTA_BIN,
+    frame_time = 512 / 22050):
+
+    '''rank_joint_counts: ranks the tracks by score, i.e. by the highest
+    count among their bins of the time offsets differences.
+
+    Args:
+        keys: sorted array of unique joint keys, as returned by joint_counts
+        counts: array of the counts of the keys
+        top_k: number of tracks in the ranking
+        delta_bin: width of the bins of the time offsets differences [frames]
+        frame_time: duration of a frame [s]
+
+    Returns:
+        The ranking, see score_tracks.
+    '''
+
+    if len(keys) == 0:
+        return []
+
+    tracks = keys >> 32
+    bins = (keys & 0xFFFFFFFF) - 2**31
+
+    # Best bin of each track: the first one after sorting by decreasing count
+    order = np.lexsort((-counts, tracks))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = tracks[order[1:]] != tracks[order[:-1]]
+    best = order[first]
+    count('candidate_tracks', len(best))
+
+    ranking = best[np.argsort(-counts[best], kind='stable')[:top_k]]
+
+    return [{'track_id': int(tracks[i]), 'score': int(counts[i]),
+        'offset': int(bins[i] * delta_bin),
+        'offset_time': float(bins[i] * delta_bin * frame_time)}
+        for i in ranking]
+
+
+def _score_tracks_dict(fingerprints_dict, fingerprints_recording, top_k,
+    max_postings = None, candidates = None):
+
+    '''_score_tracks_dict: scores the tracks of a dictionary of
+    dictionaries database, with one histogram of the time offsets
+    differences for each track (see score_tracks for max_postings and
+    candidates).
+    '''
+
     time_offset_dict = dict()
-    match = None
-    max_score = 0
 
     for k in fingerprints_recording.keys():
         if k in fingerprints_dict.keys():
+            if (max_postings is not None and
+                len(fingerprints_dict[k]) > max_postings):
+                count('hashes_pruned')
+                continue
             for track_id in fingerprints_dict[k].keys():
                 try:
                     time_offset_dict[track_id].append(fingerprints_dict[k][track_id] - fingerprints_recording[k])
                 except:
                     time_offset_dict[track_id] = [fingerprints_dict[k][track_id] - fingerprints_recording[k]]
-                    
-    for track_id in time_offset_dict.keys():         
-        track_score = max(np.histogram(time_offset_dict[track_id], bins='sqrt')[0])
-        if track_score > max_score:
-            match = track_id
-            max_score = track_score
-    
-    if max_score < MINIMUM_SCORE:
-        print('Scores are too low :( Try again, perhaps with a longer recording!')
-    else:
-        title = metadata_db.loc[int(match)]['title']
-        print(f'The best match is {title} (score = {max_score})')
-    
-    
\ No newline at end of file
+
+    track_ids = list(time_offset_dict.keys())
+    if candidates is not None and len(track_ids) > candidates:
+        # Only the tracks with the most matching hashes are scored
+        track_ids.sort(key=lambda track_id: -len(time_offset_dict[track_id]))
+        track_ids = track_ids[:candidates]
+    count('candidate_tracks', len(track_ids))
+    ranking = []
+    for track_id in track_ids:
+        histogram, edges = np.histogram(time_offset_dict[track_id], bins='sqrt')
+        best = np.argmax(histogram)
+        ranking.append({'track_id': int(track_id),
+            'score': int(histogram[best]), 'offset_time': float(edges[best])})
+
+    ranking.sort(key=lambda match: -match['score'])
+
+    return ranking[:top_k]
+
+
+def _recording_arrays(index, fingerprints_recording):
+
+    '''_recording_arrays: returns the recording fingerprints as arrays of
+    hashes and offsets, converting them if they were made by
+    make_fingerprint and the index was converted from a .json database.
+    '''
+
+    if isinstance(fingerprints_recording, dict):
+        if index.meta['hash'] != 'legacy':
+            raise ValueError('The index contains packed hashes: fingerprint '
+                'the recording with make_packed_fingerprint')
+        return legacy_fingerprints_to_arrays(fingerprints_recording,
+            index.meta.get('sample_rate', 22050),
+            index.meta.get('hop_size', 512))
+
+    return fingerprints_recording
@@ -0,0 +1,338 @@
+import argparse
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from fingerprints import AMP_THRESH, make_packed_fingerprint
+from index import FingerprintIndex
+from search import MINIMUM_SCORE, TOP_K, load_titles, score_tracks
+
+
+SERVER_PORT = 8750
+SERVER_TIMEOUT = 30  # [s]
+SERVER_MAX_BYTES = 64 << 20
+
+logger = logging.getLogger(__name__)
+
+_index = None
+
+
+class ServerBusy(Exception):
+
+    '''ServerBusy: raised when a query arrives while max_pending queries are
+    already waiting for a worker.'''
+
+
+class QueryServer():
+
+    '''QueryServer: identifies audio clips against an index kept in memory,
+    so that a query only costs its fingerprinting and search. The index is
+    memory-mapped once in each process of a pool of workers (the pages are
+    shared through the operating system cache) and each worker fingerprints
+    a short noise clip at start, so that the first query does not pay for
+    the lazy initializations of the libraries. At most max_pending queries
+    can be waiting for or running in a worker: the following ones are
+    refused at once with ServerBusy rather than queued without bound, so the
+    clients can retry later or go to another server.
+    '''
+
+    def __init__(self, index_file, metadata_file, workers = 1,
+        max_pending = None, top_k = TOP_K, amp_thresh = AMP_THRESH,
+        timeout = SERVER_TIMEOUT):
+
+        index = FingerprintIndex.load(index_file)
+        if index.meta['hash'] != 'packed':
+            raise ValueError('The server needs a packed index: build it with '
+                'database.py --packed')
+        self.n_keys = len(index.keys)
+        self.titles = load_titles(metadata_file)
+        self.top_k = top_k
+        self.amp_thresh = amp_thresh
+        self.timeout = timeout
+
+        self.max_pending = 2 * workers if max_pending is None else max_pending
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+            initializer=_start_worker, initargs=(index_file, amp_thresh))
+        # Start all the workers now rather than at the first queries
+        for future in [self._executor.submit(time.sleep, 0.1)
+            for _ in range(workers)]:
+            future.result()
+
+    def identify_audio(self, data, sample_rate = None):
+
+        '''identify_audio: identifies an audio clip.
+
+        Args:
+            data: bytes of an audio file in any format supported by
+                soundfile (e.g. .wav) or, if sample_rate is given, raw mono
+                float32 samples, which are fingerprinted without decoding
+            sample_rate: sample rate of the raw samples [Hz]
+
+        Returns:
+            See identify_hashes.
+        '''
+
+        if sample_rate is not None and (sample_rate <= 0 or
+            len(data) % 4 != 0):
+            raise ValueError('Raw samples must be float32, at a positive '
+                'sample rate')
+
+        return self._run(_identify_audio, bytes(data), self.top_k,
+            self.amp_thresh, sample_rate)
+
+    def identify_hashes(self, hashes, offsets):
+
+        '''identify_hashes: identifies a clip from its packed fingerprints,
+        computed by the client with make_packed_fingerprint.
+
+        Args:
+            hashes: sequence of the clip hashes
+            offsets: sequence of the clip time offsets [frames]
+
+        Returns:
+            A dictionary with the best match (None if its score is lower than
+            MINIMUM_SCORE), the ranking of the tracks (see score_tracks) with
+            their titles and the running times [s] of each stage in the
+            worker.
+        '''
+
+        hashes = np.asarray(hashes, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if hashes.ndim != 1 or hashes.shape != offsets.shape:
+            raise ValueError('hashes and offsets must be lists of the same '
+                'length')
+        if len(hashes) > 0 and (hashes.min() < 0 or hashes.max() >= 2**32):
+            raise ValueError('hashes must be unsigned 32 bits integers')
+
+        return self._run(_identify_hashes, hashes.astype(np.uint32),
+            offsets.astype(np.int32), self.top_k)
+
+    def close(self):
+
+        self._executor.shutdown(cancel_futures=True)
+
+    def _run(self, function, *args):
+
+        # The slot is released when the worker is done, not when the caller
+        # stops waiting, so that timed out queries still count as pending
+        if not self._slots.acquire(blocking=False):
+            raise ServerBusy(f'{self.max_pending} queries already pending')
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+
+        result = future.result(timeout=self.timeout)
+        for match in result['ranking']:
+            match['title'] = self.titles.get(match['track_id'])
+        if result['match'] is not None:
+            result['match'] = dict(result['ranking'][0])
+
+        return result
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+
+    '''QueryRequestHandler: HTTP interface of a QueryServer.
+
+        GET /health        status of the server
+        POST /identify     identifies the clip in the body: an audio file,
+                           raw mono float32 samples if the X-Sample-Rate
+                           header gives their rate, or with Content-Type
+                           application/json an object
+                           {"hashes": [...], "offsets": [...]}
+
+    The answer of /identify is the JSON result of QueryServer.identify_hashes
+    (400 if the query is not valid, 503 if the server is busy, 504 if the
+    query takes longer than the server timeout).
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        if self.path != '/health':
+            self._reply(404, {'error': f'Unknown path: {self.path}'})
+            return
+
+        query_server = self.server.query_server
+        self._reply(200, {'status': 'ok', 'keys': query_server.n_keys,
+            'tracks': len(query_server.titles),
+            'max_pending': query_server.max_pending})
+
+    def do_POST(self):
+
+        if self.path != '/identify':
+            self._reply(404, {'error': f'Unknown path: {self.path}'})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0 or length > SERVER_MAX_BYTES:
+            self.close_connection = True
+            self._reply(413 if length > 0 else 411, {'error': 'The body must '
+                f'have a Content-Length of at most {SERVER_MAX_BYTES} bytes'})
+            return
+        body = self.rfile.read(length)
+
+        query_server = self.server.query_server
+        try:
+            if self.headers.get_content_type() == 'application/json':
+                query = json.loads(body)
+                result = query_server.identify_hashes(query['hashes'],
+                    query['offsets'])
+            elif 'X-Sample-Rate' in self.headers:
+                result = query_server.identify_audio(body,
+                    int(self.headers['X-Sample-Rate']))
+            else:
+                result = query_server.identify_audio(body)
+        except ServerBusy as error:
+            self._reply(503, {'error': str(error)}, {'Retry-After': '1'})
+        except FutureTimeoutError:
+            self._reply(504, {'error': 'The query timed out'})
+        except (ValueError, KeyError, TypeError, RuntimeError) as error:
+            self._reply(400, {'error': repr(error)})
+        else:
+            self._reply(200, result)
+
+    def _reply(self, status, content, headers = None):
+
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+
+        # The clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+
+        logger.info('%s %s', self.address_string(), format % args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+
+    '''UnixHTTPServer: ThreadingHTTPServer listening on a Unix socket.'''
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # Left by a previous server
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_http_server(query_server, host = 'localhost', port = SERVER_PORT,
+    unix_socket = None):
+
+    '''make_http_server: returns an HTTP server answering the queries with
+    query_server (see QueryRequestHandler), one thread per connection,
+    listening on host and port or, if given, on the Unix socket path.
+    '''
+
+    if unix_socket is not None:
+        http_server = UnixHTTPServer(unix_socket, QueryRequestHandler)
+    else:
+        http_server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+    http_server.daemon_threads = True
+    http_server.query_server = query_server
+
+    return http_server
+
+
+def _start_worker(index_file, amp_thresh):
+
+    global _index
+    _index = FingerprintIndex.load(index_file)
+
+    noise = np.random.default_rng(0).standard_normal(22050) * 0.1
+    make_packed_fingerprint((noise.astype(np.float32), 22050),
+        amp_thresh=amp_thresh)
+
+
+def _identify_audio(data, top_k, amp_thresh, sample_rate = None):
+
+    # Raw samples are read in place from the bytes, files are decoded from
+    # memory
+    audio = io.BytesIO(data) if sample_rate is None else (data, sample_rate)
+    timings = dict()
+    hashes, offsets = make_packed_fingerprint(audio, amp_thresh=amp_thresh,
+        timings=timings)
+
+    return _identify_hashes(hashes, offsets, top_k, timings)
+
+
+def _identify_hashes(hashes, offsets, top_k, timings = None):
+
+    timings = dict() if timings is None else timings
+    start = time.perf_counter()
+    ranking = score_tracks(_index, hashes, offsets, top_k)
+    timings['search'] = time.perf_counter() - start
+
+    match = None
+    if len(ranking) > 0 and ranking[0]['score'] >= MINIMUM_SCORE:
+        match = ranking[0]
+
+    return {'match': match, 'ranking': ranking, 'timings': timings}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve identification '
+        'queries against the fingerprints index kept in memory.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--unix-socket',
+        help='listen on this Unix socket path instead of host and port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-pending', type=int,
+        help='queries pending before refusing new ones (default: twice the '
+        'workers)')
+    parser.add_argument('--timeout', type=float, default=SERVER_TIMEOUT)
+    parser.add_argument('--index',
+        default='../resources/database/fingerprints_index.bin')
+    parser.add_argument('--metadata',
+        default='../resources/database/metadata_db.csv')
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        query_server = QueryServer(args.index, args.metadata, args.workers,
+            args.max_pending, args.top_k, timeout=args.timeout)
+    except ValueError as error:
+        sys.exit(str(error))
+    http_server = make_http_server(query_server, args.host, args.port,
+        args.unix_socket)
+
+    logger.info('Serving on %s', args.unix_socket or
+        f'http://{args.host}:{args.port}')
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        query_server.close()
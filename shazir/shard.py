@@ -0,0 +1,363 @@
+import argparse
+import ipaddress
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError, Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from fingerprints import make_packed_fingerprint
+from index import FingerprintIndex
+from search import DELTA_BIN, MAX_POSTINGS, TOP_K, joint_counts, \
+    load_titles, merge_joint_counts, rank_joint_counts
+
+
+SHARD_DIR = '../resources/database/shards'
+SHARD_PORT = 8760
+# Environment variable holding the key shared by the nodes and the
+# coordinators; there is no default key, since the nodes run the queries of
+# whoever knows it
+SHARD_KEY_ENV = 'SHAZIR_SHARD_KEY'
+
+
+def shard_of(hashes, n_shards):
+
+    '''shard_of: returns the shard owning each hash. The hashes are mixed by
+    a multiplicative (Fibonacci) hash before being mapped to the shards, since
+    their bits are frequency bins and time distances, which are far from
+    uniform.
+
+    Args:
+        hashes: array of packed hashes
+        n_shards: number of shards
+
+    Returns:
+        An array of shard numbers in [0, n_shards).
+    '''
+
+    mixed = (np.asarray(hashes, dtype=np.uint64) * np.uint64(2654435761)) \
+        & np.uint64(0xFFFFFFFF)
+
+    return ((mixed * np.uint64(n_shards)) >> np.uint64(32)).astype(np.intp)
+
+
+def split_index(index, n_shards, shard_dir = SHARD_DIR):
+
+    '''split_index: partitions a packed index by hash into n_shards indexes,
+    saved as shard_<i>.bin in shard_dir. Each shard holds all the postings of
+    the hashes it owns (see shard_of), and its meta records its number and
+    the number of shards.
+
+    Args:
+        index: FingerprintIndex to split
+        n_shards: number of shards
+        shard_dir: folder of the shard files
+
+    Returns:
+        The list of the shard files.
+    '''
+
+    if index.meta['hash'] != 'packed':
+        raise ValueError('Only a packed index can be sharded')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    posting_shards = np.repeat(shard_of(index.keys, n_shards),
+        np.diff(index.starts))
+    hashes = np.repeat(index.keys, np.diff(index.starts))
+    shard_files = []
+
+    for shard in range(n_shards):
+        keep = posting_shards == shard
+        shard_file = os.path.join(shard_dir, f'shard_{shard}.bin')
+        FingerprintIndex.from_sorted(hashes[keep], index.track_ids[keep],
+            index.offsets[keep], dict(index.meta, shard=shard,
+            n_shards=n_shards)).save(shard_file)
+        shard_files.append(shard_file)
+
+    return shard_files
+
+
+def serve_shard(index_file, address = ('localhost', SHARD_PORT),
+    authkey = None, ready = None):
+
+    '''serve_shard: runs a shard node, answering the queries of the
+    coordinators until the process is stopped. Each connection is served by
+    a thread: the node first sends the meta of its shard, then answers every
+    (hashes, offsets, delta_bin, max_postings) query with the joint counts of
+    the hashes (see joint_counts), until the coordinator closes the
+    connection. Only JSON headers and raw arrays are exchanged (see
+    _send_arrays), never pickled objects.
+
+    Args:
+        index_file: path of the shard file, written by split_index
+        address: (host, port) where the node listens
+        authkey: key shared with the coordinators (bytes, required)
+        ready: optional connection, where the address of the node is sent
+            once it listens (useful with port 0)
+    '''
+
+    if not authkey:
+        raise ValueError('A shard node needs an authkey')
+    index = FingerprintIndex.load(index_file)
+
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                continue  # Client with a wrong key or gone
+            threading.Thread(target=_serve_connection,
+                args=(index, connection), daemon=True).start()
+
+
+class ShardCoordinator():
+
+    '''ShardCoordinator: searches an index partitioned among shard nodes
+    (see serve_shard). The hashes of a query are split by shard and sent
+    only to the nodes owning them, in parallel; the joint counts of the
+    (track_id, bin of the time offsets differences) pairs returned by the
+    nodes are added up and ranked as with a single index, so the ranking is
+    the one score_tracks would return on the whole index without candidates
+    (each hash lives in one shard, so the stop hashes longer than
+    max_postings are skipped by their node as they would be by the index).
+    authkey is the key of the nodes (see serve_shard).
+    '''
+
+    def __init__(self, addresses, authkey, delta_bin = DELTA_BIN,
+        max_postings = MAX_POSTINGS):
+
+        self.delta_bin = delta_bin
+        self.max_postings = max_postings
+        self._connections = dict()
+        self._locks = dict()
+
+        for address in addresses:
+            connection = Client(address, authkey=authkey)
+            meta = json.loads(connection.recv_bytes())
+            self.n_shards = meta['n_shards']
+            self._connections[meta['shard']] = connection
+            self._locks[meta['shard']] = threading.Lock()
+        self.meta = meta
+
+        missing = set(range(self.n_shards)) - set(self._connections)
+        if missing:
+            self.close()
+            raise ValueError(f'No node for the shards {sorted(missing)}')
+        self._executor = ThreadPoolExecutor(max_workers=self.n_shards)
+
+    def joint_counts(self, hashes, offsets):
+
+        '''joint_counts: same as joint_counts on the whole index, with
+        max_postings.'''
+
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        offsets = np.asarray(offsets, dtype=np.int32)
+        shards = shard_of(hashes, self.n_shards)
+
+        futures = [self._executor.submit(self._query, shard,
+            hashes[shards == shard], offsets[shards == shard])
+            for shard in np.unique(shards)]
+
+        keys = np.empty(0, dtype=np.int64)
+        counts = np.empty(0, dtype=np.int64)
+        for future in futures:
+            keys, counts = merge_joint_counts(keys, counts, *future.result())
+
+        return keys, counts
+
+    def score_tracks(self, hashes, offsets, top_k = TOP_K):
+
+        '''score_tracks: same as score_tracks on the whole index, without
+        candidates.'''
+
+        keys, counts = self.joint_counts(hashes, offsets)
+
+        return rank_joint_counts(keys, counts, top_k, self.delta_bin,
+            self.meta.get('hop_size', 512) /
+            self.meta.get('sample_rate', 22050))
+
+    def close(self):
+
+        for connection in self._connections.values():
+            connection.close()
+        if hasattr(self, '_executor'):
+            self._executor.shutdown()
+
+    def _query(self, shard, hashes, offsets):
+
+        with self._locks[shard]:
+            connection = self._connections[shard]
+            _send_arrays(connection, {'delta_bin': self.delta_bin,
+                'max_postings': self.max_postings}, hashes, offsets)
+            header, keys, counts = _recv_arrays(connection, np.int64,
+                np.int64)
+
+        if header.get('error') is not None:
+            raise RuntimeError(f'Shard {shard}: {header["error"]}')
+        return keys, counts
+
+
+def start_local_shards(shard_files, authkey = None):
+
+    '''start_local_shards: starts one shard node per shard file in local
+    processes, listening on free ports, e.g. to test a sharded setup on a
+    single machine. Unless authkey is given, the nodes use a random key.
+
+    Returns:
+        A tuple consisting of the list of the processes, to be terminated
+        when done, the list of the addresses of the nodes and their key.
+    '''
+
+    if authkey is None:
+        authkey = os.urandom(32)
+    processes = []
+    addresses = []
+
+    for shard_file in shard_files:
+        receiver, sender = Pipe(duplex=False)
+        process = Process(target=serve_shard, args=(shard_file,
+            ('localhost', 0), authkey, sender), daemon=True)
+        process.start()
+        sender.close()
+        processes.append(process)
+        addresses.append(receiver.recv())
+
+    return processes, addresses, authkey
+
+
+def _serve_connection(index, connection):
+
+    with connection:
+        connection.send_bytes(json.dumps(index.meta).encode())
+        while True:
+            try:
+                header, hashes, offsets = _recv_arrays(connection,
+                    np.uint32, np.int32)
+            except (EOFError, OSError):
+                return
+            error = None
+            try:
+                keys, counts = joint_counts(index, hashes, offsets,
+                    int(header['delta_bin']), header['max_postings'])
+            except Exception as exception:
+                error = repr(exception)
+                keys = counts = np.empty(0, dtype=np.int64)
+            _send_arrays(connection, {'error': error}, keys, counts)
+
+
+def _send_arrays(connection, header, *arrays):
+
+    # A JSON header followed by the raw bytes of each array; the receiver
+    # knows the dtypes, so nothing is unpickled on either side
+    connection.send_bytes(json.dumps(header).encode())
+    for array in arrays:
+        connection.send_bytes(np.ascontiguousarray(array).tobytes())
+
+
+def _recv_arrays(connection, *dtypes):
+
+    header = json.loads(connection.recv_bytes())
+    arrays = [np.frombuffer(connection.recv_bytes(), dtype=dtype)
+        for dtype in dtypes]
+    return (header, *arrays)
+
+
+def _parse_address(address):
+
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _is_loopback(host):
+
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Split the packed index in '
+        'shards, serve a shard or identify audio files against the shard '
+        'nodes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split')
+    split_parser.add_argument('--shards', type=int, required=True)
+    split_parser.add_argument('--index',
+        default='../resources/database/fingerprints_index.bin')
+    split_parser.add_argument('--shard-dir', default=SHARD_DIR)
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('shard_file')
+    serve_parser.add_argument('--address', default=f'localhost:{SHARD_PORT}')
+
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('audio_files', nargs='+')
+    query_parser.add_argument('--nodes',
+        help='comma separated host:port of the shard nodes (default: start '
+        'a local node for each file of --shard-dir)')
+    query_parser.add_argument('--shard-dir', default=SHARD_DIR)
+    query_parser.add_argument('--metadata',
+        default='../resources/database/metadata_db.csv')
+    query_parser.add_argument('--top-k', type=int, default=TOP_K)
+
+    args = parser.parse_args()
+    authkey = os.environ.get(SHARD_KEY_ENV, '').encode() or None
+
+    if args.command == 'split':
+        shard_files = split_index(FingerprintIndex.load(args.index),
+            args.shards, args.shard_dir)
+        print(f'Wrote {len(shard_files)} shards to {args.shard_dir}')
+
+    elif args.command == 'serve':
+        address = _parse_address(args.address)
+        if authkey is None:
+            if not _is_loopback(address[0]):
+                sys.exit(f'Set {SHARD_KEY_ENV} to serve on {args.address}')
+            # On loopback, a random key printed for the local coordinators
+            authkey = os.urandom(16).hex().encode()
+            print(f'{SHARD_KEY_ENV}={authkey.decode()}', flush=True)
+        serve_shard(args.shard_file, address, authkey)
+
+    else:
+        processes = []
+        if args.nodes:
+            if authkey is None:
+                sys.exit(f'Set {SHARD_KEY_ENV} to the key of the nodes')
+            addresses = [_parse_address(address)
+                for address in args.nodes.split(',')]
+        else:
+            shard_files = sorted(os.path.join(args.shard_dir, name) for name
+                in os.listdir(args.shard_dir) if name.endswith('.bin'))
+            processes, addresses, authkey = start_local_shards(shard_files,
+                authkey)
+
+        titles = load_titles(args.metadata)
+        coordinator = ShardCoordinator(addresses, authkey)
+        if coordinator.meta['hash'] != 'packed':
+            sys.exit('The shards must hold packed hashes')
+
+        for audio_file in args.audio_files:
+            hashes, offsets = make_packed_fingerprint(audio_file)
+            start = time.perf_counter()
+            ranking = coordinator.score_tracks(hashes, offsets, args.top_k)
+            end = time.perf_counter()
+            for match in ranking:
+                match['title'] = titles.get(match['track_id'])
+            print(json.dumps({'file': audio_file, 'ranking': ranking,
+                'search_time': end - start}))
+
+        coordinator.close()
+        for process in processes:
+            process.terminate()
@@ -1,35 +1,57 @@
 import json
+import logging
+import os
 import sys
-import pandas as pd
 
-from recorder import Recorder
 from fingerprints import fingerprint_recording
-from search import searching_matching_track
+from search import searching_matching_track, print_best_match, load_titles
+from index import FingerprintIndex
+
+# Environment variable with the folder of the database, if not the default
+# one
+DATABASE_ENV = 'SHAZIR_DATABASE'
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     AMP_THRES = 0.7
     record = False
+    database_dir = os.environ.get(DATABASE_ENV, '../resources/database')
 
-    with open("../resources/database/fingerprints_dict.json") as file:
-        fingerprints_db = json.load(file)
+    if os.path.exists(os.path.join(database_dir, 'fingerprints_index.bin')):
+        fingerprints_db = FingerprintIndex.load(
+            os.path.join(database_dir, 'fingerprints_index.bin'))
+        packed = fingerprints_db.meta['hash'] == 'packed'
+    else:
+        with open(os.path.join(database_dir,
+            "fingerprints_dict.json")) as file:
+            fingerprints_db = json.load(file)
+        packed = False
     
-    metadata_db = pd.read_csv('../resources/database/metadata_db.csv')
+    metadata_db = load_titles(os.path.join(database_dir, 'metadata_db.csv'))
 
     if len(sys.argv) == 2 and str(sys.argv[1]).endswith('.wav'):
         recording_file = str(sys.argv[1])
         fingerprints_recording = fingerprint_recording(recording_file,
-            amp_thresh=AMP_THRES)
+            amp_thresh=AMP_THRES, packed=packed)
         searching_matching_track(fingerprints_db, metadata_db, fingerprints_recording)
     else:
         record = True
+        # Only recording needs the microphone and the GUI (pyaudio, tkinter)
+        from recorder import Recorder
+        from streaming import StreamingRecognizer
     
     while record:
-        recorder = Recorder()
+        recognizer = StreamingRecognizer(fingerprints_db) if packed else None
+        recorder = Recorder(recognizer=recognizer)
         recorder.record()
+        if recognizer is not None and recognizer.match is not None:
+            print_best_match(recognizer.ranking(), metadata_db)
+            continue
         try:
             fingerprints_recording = fingerprint_recording(recorder.recording,
-                amp_thresh=AMP_THRES)
+                amp_thresh=AMP_THRES, packed=packed)
             searching_matching_track(fingerprints_db, metadata_db, fingerprints_recording)
         except:
             record = False
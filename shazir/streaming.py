@@ -0,0 +1,341 @@
+import numpy as np
+from scipy.ndimage import maximum_filter
+from scipy.signal import get_window
+
+from fingerprints import AMP_THRESH, DELTA_FREQ, DELTA_TIME, FAN_OUT, \
+    OFFSET_FREQ, OFFSET_TIME, make_combinatorial_pairs, pack_hashes
+from search import MINIMUM_SCORE, DELTA_BIN, MAX_POSTINGS, joint_counts, \
+    merge_joint_counts, rank_joint_counts
+
+
+STREAMING_MARGIN = 10
+STREAMING_HASH_INTERVAL = 0.5  # [s]
+
+
+class StreamingFingerprinter():
+
+    '''StreamingFingerprinter: computes the packed fingerprints of an audio
+    stream incrementally. Each block of samples passed to feed is turned into
+    new spectrogram frames and the peaks of the frames whose neighbours are
+    known are picked; take hashes the anchors whose target zone is complete,
+    so every hash is computed once however the stream is split in blocks.
+
+    The spectrogram is the one of process_audio_file, in dB; since the
+    maximum of the whole audio is not known in advance, the peaks threshold
+    is relative to the running maximum or, if max_time is given, to the
+    maximum of the last max_time seconds, so that in a long stream a loud
+    passage does not hide the peaks of the quieter ones that follow. Only
+    the last two frames, the pending peaks and the unconsumed samples are
+    kept in memory.
+    '''
+
+    def __init__(self, sample_rate = 22050, frame_size = 2048,
+        hop_size = 512, amp_thresh = AMP_THRESH, offset_time = OFFSET_TIME,
+        offset_freq = OFFSET_FREQ, delta_time = DELTA_TIME,
+        delta_freq = DELTA_FREQ, fan_out = FAN_OUT, max_time = None):
+
+        self._frame_size = frame_size
+        self._hop_size = hop_size
+        self._amp_thresh = amp_thresh
+        self._pairing = (offset_time, offset_freq, delta_time, delta_freq,
+            fan_out)
+
+        self.frame_time = hop_size / sample_rate
+        self._bin_freq = sample_rate / frame_size
+        # Frames are not padded as in librosa.stft: shift their index so that
+        # it refers to the frame centre, as in process_audio_file
+        self._frame_shift = frame_size // (2 * hop_size)
+        self._window = get_window('hann', frame_size).astype(np.float32)
+
+        self._samples = np.empty(0, dtype=np.float32)
+        self.n_frames = 0
+        self._context = None
+        self._max_db = -np.inf
+        self._max_frames = None
+        if max_time is not None:
+            self._max_frames = max(1, int(max_time * sample_rate / hop_size))
+            self._recent_max = np.empty(0, dtype=np.float32)
+
+        self._peaks_frames = np.empty(0, dtype=np.int64)
+        self._peaks_bins = np.empty(0, dtype=np.int64)
+        self._peaks_amps = np.empty(0, dtype=np.float32)
+
+        # All the anchors before this frame have been returned by take
+        self.committed_frame = 0
+
+    def feed(self, samples):
+
+        '''feed: computes the spectrogram frames and peaks of a new block of
+        mono samples.
+
+        Args:
+            samples: array of float samples at the fingerprinter sample rate
+
+        Returns:
+            The number of new frames.
+        '''
+
+        self._samples = np.concatenate((self._samples,
+            np.asarray(samples, dtype=np.float32).ravel()))
+        n_new = (len(self._samples) - self._frame_size) // self._hop_size + 1
+        if n_new <= 0:
+            return 0
+
+        frames = np.lib.stride_tricks.sliding_window_view(self._samples,
+            self._frame_size)[::self._hop_size][:n_new]
+        spectrum = np.fft.rfft(frames * self._window, axis=1)
+        columns = 10 * np.log10(np.maximum(np.abs(spectrum) ** 2,
+            1e-10)).T.astype(np.float32)  # Decibel, as librosa.power_to_db
+        self._samples = self._samples[n_new * self._hop_size:]
+
+        self._add_peaks(columns)
+        self.n_frames += n_new
+
+        return n_new
+
+    def take(self, final = False, pending = False):
+
+        '''take: hashes the anchors whose target zone is complete (all the
+        pending ones if final) and forgets them.
+
+        Args:
+            final: True at the end of the stream
+            pending: if True, the other anchors are also hashed with the
+                targets known so far, without forgetting them
+
+        Returns:
+            A tuple consisting of the arrays of hashes and offsets [frames]
+            of the complete anchors and, if pending, of the provisional
+            hashes and offsets of the other anchors.
+        '''
+
+        offset_time, offset_freq, delta_time, delta_freq, fan_out = \
+            self._pairing
+        peaks_times = self._peaks_frames * self.frame_time
+
+        # Peaks up to the second to last frame are known
+        known_time = ((self.n_frames - 2 + self._frame_shift) *
+            self.frame_time)
+        if final:
+            n_ready = len(peaks_times)
+            self.committed_frame = np.inf
+        else:
+            ready_time = known_time - offset_time - delta_time
+            n_ready = int(np.searchsorted(peaks_times, ready_time,
+                side='right'))
+            self.committed_frame = max(self.committed_frame,
+                int(np.floor(ready_time / self.frame_time)))
+
+        # Targets are the strongest peaks first, as with peak_local_max
+        if pending:
+            order = np.argsort(-self._peaks_amps, kind='stable')
+        else:
+            # Only the pairs of the ready anchors are needed
+            n_needed = int(np.searchsorted(peaks_times, (peaks_times[n_ready
+                - 1] if n_ready else -np.inf) + offset_time + delta_time,
+                side='left'))
+            order = np.argsort(-self._peaks_amps[:n_needed], kind='stable')
+        anchors, targets = make_combinatorial_pairs(peaks_times[order],
+            self._peaks_bins[order] * self._bin_freq, offset_time,
+            offset_freq, delta_time, delta_freq, fan_out)
+        anchors = order[anchors]
+        targets = order[targets]
+
+        hashes = pack_hashes(self._peaks_bins[anchors],
+            self._peaks_bins[targets],
+            self._peaks_frames[targets] - self._peaks_frames[anchors])
+        offsets = self._peaks_frames[anchors]
+        ready = anchors < n_ready
+
+        self._peaks_frames = self._peaks_frames[n_ready:]
+        self._peaks_bins = self._peaks_bins[n_ready:]
+        self._peaks_amps = self._peaks_amps[n_ready:]
+
+        if pending:
+            return hashes[ready], offsets[ready], hashes[~ready], \
+                offsets[~ready]
+
+        return hashes[ready], offsets[ready]
+
+    def _add_peaks(self, columns):
+
+        # Peaks are local maxima in a 3x3 neighbourhood above the threshold,
+        # excluding the border, as in make_peaks_constellation. The last two
+        # columns are kept: the last one is decided with the next block, the
+        # one before is its left neighbour
+        if self._max_frames is None:
+            self._max_db = max(self._max_db, float(columns.max()))
+            thresholds = np.full(columns.shape[1], self._max_db)
+        else:
+            # Maximum of the max_frames frames ending at each column
+            recent_max = np.concatenate((np.full(max(0, self._max_frames - 1
+                - len(self._recent_max)), -np.inf), self._recent_max,
+                columns.max(axis=0)))
+            thresholds = np.lib.stride_tricks.sliding_window_view(recent_max,
+                self._max_frames).max(axis=1)
+            self._recent_max = recent_max[len(recent_max) -
+                self._max_frames + 1:]
+        if self._context is None:
+            block = columns
+        else:
+            block = np.concatenate((self._context[0], columns), axis=1)
+            thresholds = np.concatenate((self._context[1], thresholds))
+        block_start = self.n_frames - (block.shape[1] - columns.shape[1])
+        self._context = (block[:, -2:], thresholds[-2:])
+
+        if block.shape[1] < 3:
+            return
+        if self._max_frames is None:
+            thresholds[:] = self._max_db
+
+        maxima = maximum_filter(block, size=3, mode='nearest')
+        is_peak = ((block == maxima) & (block > self._amp_thresh *
+            thresholds) & (thresholds > 0))
+        is_peak[[0, -1], :] = False
+        is_peak[:, [0, -1]] = False
+        bins, block_columns = np.nonzero(is_peak)
+        amps = block[bins, block_columns]
+        frames = block_start + block_columns + self._frame_shift
+
+        order = np.lexsort((-amps, frames))
+        self._peaks_frames = np.concatenate((self._peaks_frames,
+            frames[order]))
+        self._peaks_bins = np.concatenate((self._peaks_bins, bins[order]))
+        self._peaks_amps = np.concatenate((self._peaks_amps, amps[order]))
+
+
+class StreamingRecognizer():
+
+    '''StreamingRecognizer: recognizes a track while the audio is coming in.
+    The blocks passed to feed are fingerprinted by a StreamingFingerprinter
+    and the hashes of the complete anchors are matched against the index,
+    so the track scores grow with the audio (the anchors still waiting for
+    targets are counted provisionally). As soon as the best track scores at
+    least minimum_score and beats the runner-up by margin, match is set and
+    feed returns True. Hashing and scoring run every hash_interval seconds
+    of audio rather than at every block, since the provisional pairs are
+    recomputed each time. The hashes with more than max_postings postings
+    are skipped, as in score_tracks; the tracks are not pruned to the
+    candidates, since the counts of the successive blocks are added up.
+    '''
+
+    def __init__(self, index, sample_rate = 22050, frame_size = 2048,
+        hop_size = 512, amp_thresh = AMP_THRESH, offset_time = OFFSET_TIME,
+        offset_freq = OFFSET_FREQ, delta_time = DELTA_TIME,
+        delta_freq = DELTA_FREQ, fan_out = FAN_OUT,
+        minimum_score = MINIMUM_SCORE, margin = STREAMING_MARGIN,
+        delta_bin = DELTA_BIN, hash_interval = STREAMING_HASH_INTERVAL,
+        max_postings = MAX_POSTINGS):
+
+        self.index = index
+        self._fingerprinter = StreamingFingerprinter(sample_rate, frame_size,
+            hop_size, amp_thresh, offset_time, offset_freq, delta_time,
+            delta_freq, fan_out)
+        self._minimum_score = minimum_score
+        self._margin = margin
+        self._delta_bin = delta_bin
+        self._max_postings = max_postings
+        self._hash_frames = max(1, int(hash_interval * sample_rate / hop_size))
+        self._hashed_frames = 0
+
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending = (self.keys, self.counts)
+        self.n_hashes = 0
+        self.match = None
+
+    def feed(self, samples):
+
+        '''feed: processes a new block of mono samples.
+
+        Args:
+            samples: array of float samples at the recognizer sample rate
+
+        Returns:
+            True if a track has been recognized.
+        '''
+
+        if self.match is not None:
+            return True
+
+        self._fingerprinter.feed(samples)
+        if (self._fingerprinter.n_frames - self._hashed_frames >=
+            self._hash_frames):
+            self._score(final=False)
+            self._hashed_frames = self._fingerprinter.n_frames
+
+        return self.match is not None
+
+    def finish(self):
+
+        '''finish: hashes the pending anchors, at the end of the audio.
+
+        Returns:
+            The ranking of the tracks (see score_tracks).
+        '''
+
+        if self.match is None:
+            self._score(final=True)
+
+        return self.ranking()
+
+    def ranking(self, top_k = 5):
+
+        '''ranking: returns the current ranking of the tracks (see
+        score_tracks), including the provisional counts of the anchors whose
+        target zone is not complete yet.'''
+
+        keys, counts = merge_joint_counts(self.keys, self.counts,
+            *self._pending)
+
+        return rank_joint_counts(keys, counts, top_k, self._delta_bin,
+            self._fingerprinter.frame_time)
+
+    def _score(self, final):
+
+        # Anchors whose target zone is complete are committed; the other
+        # ones are only counted provisionally, so that a track can be
+        # recognized before the delta_time of its first anchors has elapsed
+        hashes, offsets, pending_hashes, pending_offsets = \
+            self._fingerprinter.take(final=final, pending=True)
+        self.n_hashes += len(hashes)
+
+        keys, counts = joint_counts(self.index, hashes, offsets,
+            self._delta_bin, self._max_postings)
+        self.keys, self.counts = merge_joint_counts(self.keys, self.counts,
+            keys, counts)
+        self._pending = joint_counts(self.index, pending_hashes,
+            pending_offsets, self._delta_bin, self._max_postings)
+
+        ranking = self.ranking(top_k=2)
+        if len(ranking) > 0:
+            runner_up = ranking[1]['score'] if len(ranking) > 1 else 0
+            if (ranking[0]['score'] >= self._minimum_score and
+                ranking[0]['score'] >= runner_up + self._margin):
+                self.match = ranking[0]
+
+
+def recognize_stream(index, blocks, **kwargs):
+
+    '''recognize_stream: feeds blocks of samples to a StreamingRecognizer,
+    stopping as soon as a track is recognized.
+
+    Args:
+        index: FingerprintIndex of the tracks
+        blocks: iterable of arrays of mono samples
+        kwargs: parameters of StreamingRecognizer
+
+    Returns:
+        A tuple consisting of the ranking of the tracks (see score_tracks)
+        and the number of samples consumed.
+    '''
+
+    recognizer = StreamingRecognizer(index, **kwargs)
+    n_samples = 0
+
+    for block in blocks:
+        n_samples += len(block)
+        if recognizer.feed(block):
+            return recognizer.ranking(), n_samples
+
+    return recognizer.finish(), n_samples
@@ -0,0 +1,279 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import PeaksCache
+from fingerprints import AMP_THRESH, DELTA_FREQ, DELTA_TIME, FAN_OUT, \
+    OFFSET_FREQ, OFFSET_TIME, make_packed_hashes, make_peaks, \
+    make_peaks_constellation, make_spectrogram
+from index import FingerprintIndex
+from search import MINIMUM_SCORE, score_tracks
+
+
+SWEEP_DIR = '../resources/benchmark/sweep'
+# Values of each parameter; the grid is their cartesian product
+SWEEP_GRID = {'amp_thresh': [0.6, 0.7, 0.8], 'fan_out': [5, 10, 15],
+    'delta_time': [5, 10], 'delta_freq': [500, 1000],
+    'minimum_score': [10, 20, 40]}
+SWEEP_DEFAULTS = {'amp_thresh': AMP_THRESH, 'offset_time': OFFSET_TIME,
+    'offset_freq': OFFSET_FREQ, 'delta_time': DELTA_TIME,
+    'delta_freq': DELTA_FREQ, 'fan_out': FAN_OUT,
+    'minimum_score': MINIMUM_SCORE}
+
+
+def run_sweep(corpus_dir, grid = SWEEP_GRID, workers = 1,
+    cache_dir = os.path.join(SWEEP_DIR, 'cache'), offset_tolerance = 0.5,
+    cache_max_bytes = None):
+
+    '''run_sweep: evaluates every configuration of a grid of fingerprinting
+    and matching parameters on a corpus made by make_synthetic_corpus (the
+    tracks in the wav subfolder, the queries with their known answers in
+    queries.json). Every file is decoded and transformed once for the whole
+    sweep: the spectrograms, and the peaks of each amp_thresh, are kept in a
+    PeaksCache shared by the processes, so a configuration only repeats the
+    pairing, the index build and the search; the configurations differing
+    only by minimum_score share even these, since it only decides which
+    rankings are matches.
+
+    Args:
+        corpus_dir: folder of the corpus
+        grid: dictionary with the values of each parameter (amp_thresh,
+            offset_time, offset_freq, delta_time, delta_freq, fan_out,
+            minimum_score); the missing ones take SWEEP_DEFAULTS
+        workers: number of processes
+        cache_dir: folder of the cache of spectrograms and peaks
+        offset_tolerance: maximum error on the offset of a query in its
+            track for it to be recognized correctly [s]
+        cache_max_bytes: maximum size of the cache (None for no limit: with
+            a limit smaller than the spectrograms and peaks of the corpus,
+            the configurations decode the files again)
+
+    Returns:
+        A list of dictionaries, one per configuration, with its parameters,
+        the recognition rate on the known queries, the false positive rate
+        on the unknown ones, the size of the index [bytes], the mean query
+        latency (peak picking, hashing and search, the spectrogram being
+        the same for all the configurations) [s] and whether it is on the
+        Pareto front of these four metrics (see pareto_front).
+    '''
+
+    wav_dir = os.path.join(corpus_dir, 'wav')
+    track_files = [os.path.join(wav_dir, track_file)
+        for track_file in sorted(os.listdir(wav_dir))]
+    with open(os.path.join(corpus_dir, 'queries.json')) as file:
+        queries = json.load(file)
+
+    grid = {name: grid.get(name, [value]) for name, value in
+        SWEEP_DEFAULTS.items()}
+    names = [name for name in SWEEP_DEFAULTS if name != 'minimum_score']
+    configurations = [dict(zip(names, values)) for values in
+        itertools.product(*(grid[name] for name in names))]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Fill the cache first, so that the configurations do not decode
+        # the same files concurrently
+        list(executor.map(_cache_spectrogram, track_files + [query['file']
+            for query in queries], itertools.repeat(cache_dir),
+            itertools.repeat(cache_max_bytes)))
+        list(executor.map(_cache_peaks, *zip(*itertools.product(track_files,
+            grid['amp_thresh'])), itertools.repeat(cache_dir),
+            itertools.repeat(cache_max_bytes)))
+
+        results = []
+        for evaluation in executor.map(evaluate_configuration,
+            configurations, itertools.repeat(track_files),
+            itertools.repeat(queries), itertools.repeat(cache_dir),
+            itertools.repeat(cache_max_bytes)):
+            for minimum_score in grid['minimum_score']:
+                results.append(_score_evaluation(evaluation, minimum_score,
+                    offset_tolerance))
+
+    for result, optimal in zip(results, pareto_front(results)):
+        result['pareto'] = optimal
+
+    return results
+
+
+def evaluate_configuration(params, track_files, queries, cache_dir,
+    cache_max_bytes = None):
+
+    '''evaluate_configuration: builds the index of the tracks with the given
+    fingerprinting parameters and searches every query in it.
+
+    Args:
+        params: dictionary with amp_thresh, offset_time, offset_freq,
+            delta_time, delta_freq and fan_out
+        track_files: paths of the tracks, whose track ids are their
+            positions in the list
+        queries: list of the queries, as dictionaries with the file, the
+            title (file name) of the track (None if unknown) and the
+            offset_time of the excerpt in the track [s]
+        cache_dir: folder of the cache of spectrograms and peaks
+        cache_max_bytes: maximum size of the cache (None for no limit)
+
+    Returns:
+        A dictionary with the parameters, the size of the index [bytes] and,
+        for each query, its answer, the best match (title, score and
+        offset_time, None if no track matches) and the latency [s].
+    '''
+
+    cache = PeaksCache(cache_dir, cache_max_bytes, spectrogram=True)
+    pairing = (params['offset_time'], params['offset_freq'],
+        params['delta_time'], params['delta_freq'], params['fan_out'])
+
+    postings = []
+    for track_id, track_file in enumerate(track_files):
+        times, frequencies, peaks_times, peaks_frequencies = make_peaks(
+            track_file, amp_thresh=params['amp_thresh'], cache=cache)
+        hashes, offsets = make_packed_hashes(peaks_times, peaks_frequencies,
+            times, frequencies, *pairing)
+        postings.append((hashes, np.full(len(hashes), track_id,
+            dtype=np.int32), offsets))
+    index = FingerprintIndex.from_postings(postings)
+
+    matches = []
+    for query in queries:
+        times, frequencies, amplitudes = make_spectrogram(query['file'],
+            cache=cache)
+        start = time.perf_counter()
+        peaks_times, peaks_frequencies = make_peaks_constellation(times,
+            frequencies, amplitudes, params['amp_thresh'])
+        hashes, offsets = make_packed_hashes(peaks_times, peaks_frequencies,
+            times, frequencies, *pairing)
+        ranking = score_tracks(index, hashes, offsets, top_k=1)
+        latency = time.perf_counter() - start
+
+        match = None
+        if len(ranking) > 0:
+            match = {'title': os.path.basename(track_files[
+                ranking[0]['track_id']]), 'score': ranking[0]['score'],
+                'offset_time': ranking[0]['offset_time']}
+        matches.append({'query': query, 'match': match, 'latency': latency})
+
+    return {'params': params, 'index_bytes': index.nbytes,
+        'index_postings': index.n_postings, 'matches': matches}
+
+
+def pareto_front(results, metrics = (('recognition_rate', -1),
+    ('false_positive_rate', 1), ('index_bytes', 1), ('query_latency', 1))):
+
+    '''pareto_front: tells which results are not dominated by another one,
+    i.e. no other result is at least as good on every metric and better on
+    one.
+
+    Args:
+        results: list of dictionaries with the metrics
+        metrics: names of the metrics, each with 1 if lower is better and
+            -1 if higher is better
+
+    Returns:
+        A list of booleans, True for the results on the Pareto front.
+    '''
+
+    values = np.array([[sign * (result[name] or 0) for name, sign in metrics]
+        for result in results], dtype=float).reshape(len(results),
+        len(metrics))
+    dominated = np.zeros(len(results), dtype=bool)
+    for i, value in enumerate(values):
+        dominated[i] = np.any(np.all(values <= value, axis=1) &
+            np.any(values < value, axis=1))
+
+    return (~dominated).tolist()
+
+
+def _score_evaluation(evaluation, minimum_score, offset_tolerance):
+
+    correct = n_known = false_positives = n_unknown = 0
+    for match in evaluation['matches']:
+        query = match['query']
+        recognized = (match['match'] is not None and
+            match['match']['score'] >= minimum_score)
+        if query['title'] is None:
+            n_unknown += 1
+            false_positives += recognized
+        else:
+            n_known += 1
+            correct += (recognized and match['match']['title'] ==
+                query['title'] and abs(match['match']['offset_time'] -
+                query['offset_time']) <= offset_tolerance)
+
+    return dict(evaluation['params'], minimum_score=minimum_score,
+        recognition_rate=correct / n_known if n_known else None,
+        false_positive_rate=false_positives / n_unknown if n_unknown
+            else None,
+        index_bytes=evaluation['index_bytes'],
+        index_postings=evaluation['index_postings'],
+        query_latency=float(np.mean([match['latency']
+            for match in evaluation['matches']])))
+
+
+def _cache_spectrogram(audio_file, cache_dir, cache_max_bytes):
+
+    make_spectrogram(audio_file, cache=PeaksCache(cache_dir, cache_max_bytes,
+        spectrogram=True))
+
+
+def _cache_peaks(audio_file, amp_thresh, cache_dir, cache_max_bytes):
+
+    make_peaks(audio_file, amp_thresh=amp_thresh, cache=PeaksCache(cache_dir,
+        cache_max_bytes, spectrogram=True))
+
+
+def _format_rate(rate):
+
+    return 'n/a' if rate is None else f'{rate:.3f}'
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Evaluate a grid of '
+        'fingerprinting and matching parameters on a corpus of tracks and '
+        'labelled queries.')
+    parser.add_argument('--corpus', default='../resources/benchmark/corpus',
+        help='folder of the corpus, as made by benchmark.py --suite '
+        '(generated if missing)')
+    parser.add_argument('--grid', type=json.loads, default=SWEEP_GRID,
+        help='JSON object with the list of values of each parameter '
+        f'(default: {json.dumps(SWEEP_GRID)})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=os.path.join(SWEEP_DIR,
+        'results.jsonl'), help='JSON lines file of the results')
+    parser.add_argument('--cache-max-mb', type=float,
+        help='maximum size of the cache of spectrograms and peaks [MiB] '
+        '(default: no limit, so that no file is decoded twice)')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.corpus, 'queries.json')):
+        from benchmark import make_synthetic_corpus
+        make_synthetic_corpus(args.corpus)
+
+    start = time.time()
+    cache_max_bytes = (None if args.cache_max_mb is None else
+        int(args.cache_max_mb * 2**20))
+    results = run_sweep(args.corpus, args.grid, args.workers,
+        cache_max_bytes=cache_max_bytes)
+    end = time.time()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        for result in results:
+            file.write(json.dumps(result) + '\n')
+
+    print(f'{len(results)} configurations in {end - start:.1f} s, Pareto '
+        'front:')
+    # The configurations without known queries (rate None) come last
+    for result in sorted((result for result in results if result['pareto']),
+        key=lambda result: (result['recognition_rate'] is None,
+        -(result['recognition_rate'] or 0))):
+        params = ', '.join(f'{name}={result[name]}'
+            for name in SWEEP_DEFAULTS)
+        print(f"{params}: recognition "
+            f"{_format_rate(result['recognition_rate'])}, false positives "
+            f"{_format_rate(result['false_positive_rate'])}, index "
+            f"{result['index_bytes'] / 2**20:.2f} MiB, latency "
+            f"{1000 * result['query_latency']:.1f} ms")
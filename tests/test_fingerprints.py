@@ -0,0 +1,108 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'shazir'))
+
+from fingerprints import HASH_DELTA_BITS, HASH_FREQ_BITS, PAIRING, \
+    make_combinatorial_hashes, make_combinatorial_hashes_loop, make_peaks, \
+    make_packed_fingerprint, make_peaks_constellation, pack_hashes
+from preprocess import process_audio_file
+
+try:
+    import skimage
+except ImportError:
+    skimage = None
+
+
+SAMPLE_RATE = 22050
+
+
+def synthetic_signal(seconds = 8, seed = 0):
+
+    # A sequence of notes of one to three tones over some noise, so that
+    # the spectrogram has well separated peaks
+    rng = np.random.default_rng(seed)
+    note = SAMPLE_RATE // 4
+    t = np.arange(note) / SAMPLE_RATE
+    notes = []
+    for _ in range(int(seconds * 4)):
+        tones = rng.uniform(100, 5000, rng.integers(1, 4))
+        notes.append(np.sin(2 * np.pi * tones[:, None] * t).sum(axis=0))
+    signal = np.concatenate(notes)
+
+    return (signal + 0.05 * rng.standard_normal(len(signal))).astype(
+        np.float32)
+
+
+class HashingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        times, frequencies, amplitudes = process_audio_file((
+            synthetic_signal(), SAMPLE_RATE))
+        cls.peaks = make_peaks_constellation(times, frequencies, amplitudes)
+
+    def test_vectorized_hashes_match_loop(self):
+        hashes = make_combinatorial_hashes(*self.peaks, *PAIRING)
+        self.assertGreater(len(hashes), 0)
+        self.assertEqual(hashes,
+            make_combinatorial_hashes_loop(*self.peaks, *PAIRING))
+
+    @unittest.skipIf(skimage is None, 'scikit-image is not installed')
+    def test_peaks_match_skimage(self):
+        from fingerprints import make_peaks_constellation_skimage
+        times, frequencies, amplitudes = process_audio_file((
+            synthetic_signal(seed=1), SAMPLE_RATE))
+        peaks = make_peaks_constellation(times, frequencies, amplitudes)
+        peaks_skimage = make_peaks_constellation_skimage(times, frequencies,
+            amplitudes)
+        for a, b in zip(peaks, peaks_skimage):
+            np.testing.assert_array_equal(np.ravel(a), np.ravel(b))
+
+
+class BlockPathTest(unittest.TestCase):
+
+    def test_blocks_match_full_spectrogram(self):
+        audio = (synthetic_signal(seconds=12, seed=2), SAMPLE_RATE)
+        full = make_peaks(audio)
+        for block_frames in (1, 7, 64):
+            with self.subTest(block_frames=block_frames):
+                for a, b in zip(full, make_peaks(audio,
+                    block_frames=block_frames)):
+                    np.testing.assert_array_equal(a, b)
+
+    def test_block_fingerprints_match(self):
+        audio = (synthetic_signal(seed=3), SAMPLE_RATE)
+        for a, b in zip(make_packed_fingerprint(audio),
+            make_packed_fingerprint(audio, block_frames=32)):
+            np.testing.assert_array_equal(a, b)
+
+
+class PackHashesTest(unittest.TestCase):
+
+    def test_fields_are_packed(self):
+        freq_max = (1 << HASH_FREQ_BITS) - 1
+        delta_max = (1 << HASH_DELTA_BITS) - 1
+        hashes = pack_hashes([freq_max, 1], [0, 2], [delta_max, 3])
+        self.assertEqual(hashes.dtype, np.uint32)
+        self.assertEqual(hashes[0] >> (HASH_FREQ_BITS + HASH_DELTA_BITS),
+            freq_max)
+        self.assertEqual(hashes[0] & delta_max, delta_max)
+        self.assertEqual(hashes[1], (1 << (HASH_FREQ_BITS +
+            HASH_DELTA_BITS)) | (2 << HASH_DELTA_BITS) | 3)
+        self.assertEqual(len(pack_hashes([], [], [])), 0)
+
+    def test_out_of_range_values_are_rejected(self):
+        for args in (([1 << HASH_FREQ_BITS], [0], [0]),
+            ([0], [1 << HASH_FREQ_BITS], [0]),
+            ([0], [0], [1 << HASH_DELTA_BITS]), ([0], [-1], [0])):
+            with self.subTest(args=args):
+                with self.assertRaises(ValueError):
+                    pack_hashes(*args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'shazir'))
+
+from index import FingerprintIndex, IndexBuilder
+
+
+def random_postings(track_ids, n_hashes = 500, seed = 0):
+
+    # Postings of each track, with many hashes shared between the tracks
+    rng = np.random.default_rng(seed)
+    postings = []
+    for track_id in track_ids:
+        n = int(rng.integers(100, 2000))
+        postings.append((rng.integers(0, n_hashes, n).astype(np.uint32),
+            np.full(n, track_id, dtype=np.int32),
+            rng.integers(0, 5000, n).astype(np.int32)))
+
+    return postings
+
+
+def assert_same_index(test, a, b):
+
+    for name in ('keys', 'starts', 'track_ids', 'offsets'):
+        np.testing.assert_array_equal(getattr(a, name), getattr(b, name),
+            err_msg=name)
+    test.assertEqual(a.meta, b.meta)
+
+
+class IndexBuilderTest(unittest.TestCase):
+
+    def test_builder_matches_from_postings(self):
+        postings = random_postings(range(20))
+        with tempfile.TemporaryDirectory() as directory:
+            reference_file = os.path.join(directory, 'reference.bin')
+            FingerprintIndex.from_postings(postings).save(reference_file)
+            # Limits giving one run, several runs and several merge passes
+            for memory_limit in (1 << 30, 1 << 16, 1 << 10):
+                with self.subTest(memory_limit=memory_limit):
+                    index_file = os.path.join(directory, 'built.bin')
+                    builder = IndexBuilder(memory_limit,
+                        temporary_dir=directory)
+                    for track_postings in postings:
+                        builder.append(track_postings)
+                    builder.build(index_file)
+                    with open(reference_file, 'rb') as reference, \
+                        open(index_file, 'rb') as built:
+                        self.assertEqual(reference.read(), built.read())
+
+
+class UpdateTest(unittest.TestCase):
+
+    def test_update_matches_rebuild(self):
+        postings = random_postings(range(10), seed=1)
+        new_postings = random_postings(range(10, 13), seed=2)
+        removed = [2, 5, 9]
+
+        updated = FingerprintIndex.from_postings(postings).update(removed,
+            new_postings)
+        rebuilt = FingerprintIndex.from_postings([track_postings
+            for track_postings in postings if track_postings[1][0] not in
+            removed] + new_postings)
+        assert_same_index(self, updated, rebuilt)
+
+    def test_new_track_ids_must_be_greater(self):
+        index = FingerprintIndex.from_postings(random_postings(range(3)))
+        with self.assertRaises(ValueError):
+            index.update((), random_postings([1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'shazir'))
+
+from recorder import PA_CONTINUE, Recorder, SampleBuffer
+
+
+def _chunks(count, frames, seed = 0):
+    # Synthetic float32 chunks, as delivered by the pyaudio stream
+    rng = np.random.default_rng(seed)
+    return [rng.standard_normal(frames).astype(np.float32)
+        for _ in range(count)]
+
+
+class SampleBufferTest(unittest.TestCase):
+
+    def test_append_grows_past_capacity(self):
+        buffer = SampleBuffer(capacity=100)
+        chunks = _chunks(10, 64)
+        for chunk in chunks:
+            buffer.append(chunk)
+        self.assertEqual(len(buffer), 640)
+        np.testing.assert_array_equal(buffer.view(), np.concatenate(chunks))
+
+    def test_view_does_not_copy(self):
+        buffer = SampleBuffer(capacity=1000)
+        buffer.append(np.ones(10, dtype=np.float32))
+        view = buffer.view()
+        buffer.append(np.zeros(10, dtype=np.float32))
+        self.assertEqual(len(view), 10)
+        self.assertTrue(np.shares_memory(view, buffer.view()))
+
+
+class RecorderCallbackTest(unittest.TestCase):
+
+    def test_callback_collects_chunks(self):
+        recorder = Recorder(rate=1000, frames=256, capacity_seconds=1)
+        chunks = _chunks(8, 256)
+        for chunk in chunks:
+            result = recorder.callback(chunk.tobytes(), len(chunk), None, 0)
+            self.assertEqual(result, (None, PA_CONTINUE))
+        np.testing.assert_array_equal(recorder.get_recording(),
+            np.concatenate(chunks))
+
+    def test_feed_recognizer_sends_new_samples_once(self):
+        fed = []
+
+        class Recognizer():
+            def feed(self, samples):
+                fed.append(samples.copy())
+                return len(fed) == 2
+
+        class Main():
+            def after(self, interval, function):
+                pass
+
+        recorder = Recorder(frames=128, recognizer=Recognizer())
+        recorder.main = Main()
+        recorder.stop = lambda: fed.append(None)
+        chunks = _chunks(3, 128)
+        recorder.callback(chunks[0].tobytes(), 128, None, 0)
+        recorder.feed_recognizer()
+        recorder.callback(chunks[1].tobytes(), 128, None, 0)
+        recorder.callback(chunks[2].tobytes(), 128, None, 0)
+        recorder.feed_recognizer()
+        np.testing.assert_array_equal(fed[0], chunks[0])
+        np.testing.assert_array_equal(fed[1], np.concatenate(chunks[1:]))
+        self.assertIsNone(fed[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'shazir'))
+
+from fingerprints import make_packed_fingerprint
+from index import FingerprintIndex
+from streaming import StreamingFingerprinter, recognize_stream
+
+from test_fingerprints import SAMPLE_RATE, synthetic_signal
+
+
+def stream_hashes(signal, block_size):
+
+    # All the hashes of a stream fed in blocks of block_size samples, sorted
+    fingerprinter = StreamingFingerprinter(SAMPLE_RATE)
+    taken = []
+    for start in range(0, len(signal), block_size):
+        fingerprinter.feed(signal[start:start + block_size])
+        taken.append(fingerprinter.take())
+    taken.append(fingerprinter.take(final=True))
+    hashes, offsets = (np.concatenate(arrays) for arrays in zip(*taken))
+    order = np.lexsort((hashes, offsets))
+
+    return hashes[order], offsets[order]
+
+
+class StreamingFingerprinterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signal = synthetic_signal(seconds=20, seed=4)
+        cls.reference = stream_hashes(cls.signal, len(cls.signal))
+
+    def test_hashes_do_not_depend_on_blocks(self):
+        for block_size in (1000, 4096, 7919, SAMPLE_RATE):
+            with self.subTest(block_size=block_size):
+                for a, b in zip(self.reference, stream_hashes(self.signal,
+                    block_size)):
+                    np.testing.assert_array_equal(a, b)
+
+    def test_hashes_close_to_offline(self):
+        # The frames are not padded and the threshold follows the running
+        # maximum, so only the edges can differ from make_packed_fingerprint
+        hashes, offsets = make_packed_fingerprint((self.signal,
+            SAMPLE_RATE))
+        stream_pairs = (self.reference[0].astype(np.int64) << 32) + \
+            self.reference[1]
+        offline_pairs = (hashes.astype(np.int64) << 32) + offsets
+        self.assertGreater(np.isin(stream_pairs, offline_pairs).mean(), 0.95)
+
+
+class RecognizeStreamTest(unittest.TestCase):
+
+    def test_excerpt_is_recognized(self):
+        tracks = [synthetic_signal(seconds=30, seed=seed)
+            for seed in range(10, 14)]
+        postings = []
+        for track_id, track in enumerate(tracks):
+            hashes, offsets = make_packed_fingerprint((track, SAMPLE_RATE))
+            postings.append((hashes, np.full(len(hashes), track_id,
+                dtype=np.int32), offsets))
+        index = FingerprintIndex.from_postings(postings)
+
+        start = 12 * SAMPLE_RATE
+        excerpt = tracks[2][start:start + 10 * SAMPLE_RATE]
+        ranking, _ = recognize_stream(index, (excerpt[i:i + 2048]
+            for i in range(0, len(excerpt), 2048)))
+        self.assertEqual(ranking[0]['track_id'], 2)
+        self.assertAlmostEqual(ranking[0]['offset_time'], 12, delta=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()